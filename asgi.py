@@ -0,0 +1,12 @@
+# ASGI入口：uvicorn asgi:app，说明见watchlist/asgi.py
+import os
+from dotenv import load_dotenv
+
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+
+from watchlist import create_app
+from watchlist.asgi import AsgiApp
+
+app = AsgiApp(create_app())
@@ -0,0 +1,179 @@
+# 对比WSGI和ASGI两种部署方式在大量保持连接(keep-alive)的客户端下的表现
+#
+#   python -m benchmarks.asgi --size 100000 --clients 1000
+#
+# 两种服务器都以子进程方式启动(默认分别是gunicorn的gthread worker和uvicorn，可以用--wsgi-cmd/--asgi-cmd修改)，
+# 客户端用asyncio建立--clients个HTTP/1.1长连接，每个连接依次发出--requests个请求。
+# 客户端数量很大时需要先调高打开文件数的限制(ulimit -n)。
+import asyncio
+import json
+import os
+import shlex
+import socket
+import subprocess
+import time
+from urllib.parse import urlencode
+
+import click
+
+from benchmarks.run import percentile
+from benchmarks.seed import BENCH_PASSWD, BENCH_USERNAME, seed_database, use_copy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WSGI_CMD = 'gunicorn --worker-class gthread --workers 1 --threads 32 --bind 127.0.0.1:{port} wsgi:app'
+ASGI_CMD = 'uvicorn --workers 1 --host 127.0.0.1 --port {port} --no-access-log asgi:app'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def read_response(reader):
+    """读取一个HTTP/1.1响应，返回(状态码, 响应头, 响应体)"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed by server')
+    status = int(status_line.split(b' ', 2)[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers.setdefault(name.strip().lower(), value.strip())
+    if headers.get('transfer-encoding') == 'chunked':
+        body = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            body.append(await reader.readexactly(size))
+            await reader.readline()
+        return status, headers, b''.join(body)
+    return status, headers, await reader.readexactly(int(headers.get('content-length', 0)))
+
+
+class Connection(object):
+    def __init__(self, port, cookie=None):
+        self.port = port
+        self.cookie = cookie
+        self.reader = self.writer = None
+
+    async def request(self, method, path, form=None):
+        if self.writer is None:  # 服务器关闭连接后重新连接，计入该请求的耗时
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        body = urlencode(form).encode() if form else b''
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: 127.0.0.1:%d' % self.port, 'Content-Length: %d' % len(body)]
+        if form:
+            lines.append('Content-Type: application/x-www-form-urlencoded')
+        if self.cookie:
+            lines.append('Cookie: ' + self.cookie)
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        status, headers, _ = await read_response(self.reader)
+        if 'set-cookie' in headers:
+            self.cookie = headers['set-cookie'].split(';', 1)[0]
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = self.reader = None
+
+
+async def run_load(port, paths, clients, requests, cookie):
+    latencies = []
+    errors = [0]
+
+    async def client(n):
+        conn = Connection(port, cookie)
+        try:
+            for i in range(requests):
+                path = paths[(n + i) % len(paths)]
+                start = time.perf_counter()
+                try:
+                    status = await conn.request('GET', path)
+                except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                    conn.close()
+                    errors[0] += 1
+                    continue
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status >= 400:
+                    errors[0] += 1
+        finally:
+            conn.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(n) for n in range(clients)])
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'p50': round(percentile(latencies, 50), 3),
+        'p95': round(percentile(latencies, 95), 3),
+        'p99': round(percentile(latencies, 99), 3),
+        'rps': round(len(latencies) / elapsed, 1),
+    }
+
+
+async def login(port):
+    conn = Connection(port)
+    await conn.request('POST', '/login', dict(username=BENCH_USERNAME, passwd=BENCH_PASSWD))
+    conn.close()
+    return conn.cookie
+
+
+def start_server(command, port, database, page_cache):
+    env = dict(os.environ, DATABASE_FILE=database, PAGE_CACHE_BACKEND=page_cache,
+               RATELIMIT_BACKEND='none', MAX_CONCURRENT_REQUESTS='0', MAX_CONCURRENT_WRITES='0')
+    process = subprocess.Popen(shlex.split(command.format(port=port)), cwd=ROOT, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:  # 等待服务器开始监听
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise click.ClickException('server exited: %s' % command)
+            time.sleep(0.2)
+    process.terminate()
+    raise click.ClickException('server did not start: %s' % command)
+
+
+@click.command()
+@click.option('--size', default=100000, show_default=True, help='Movies in the benchmark database.')
+@click.option('--clients', default=1000, show_default=True, help='Concurrent keep-alive connections.')
+@click.option('--requests', default=20, show_default=True, help='Requests per connection.')
+@click.option('--paths', default='/,/?after=1000,/movie/edit/1', show_default=True, help='Comma separated paths, requested in turn.')
+@click.option('--page-cache', default='none', show_default=True, help='PAGE_CACHE_BACKEND for both servers.')
+@click.option('--wsgi-cmd', default=WSGI_CMD, show_default=True, help='Command starting the WSGI server, {port} is substituted.')
+@click.option('--asgi-cmd', default=ASGI_CMD, show_default=True, help='Command starting the ASGI server, {port} is substituted.')
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON result.')
+def main(size, clients, requests, paths, page_cache, wsgi_cmd, asgi_cmd, output):
+    """Compare WSGI and ASGI serving under many keep-alive clients"""
+    filename = seed_database(size)
+    paths = paths.split(',')
+    result = {'meta': dict(size=size, clients=clients, requests=requests, paths=paths, page_cache=page_cache), 'results': {}}
+    for name, command in (('wsgi', wsgi_cmd), ('asgi', asgi_cmd)):
+        database = use_copy(filename)
+        port = free_port()
+        process = start_server(command, port, database, page_cache)
+        try:
+            cookie = asyncio.run(login(port))  # 所有连接共用一个登录会话，编辑页面需要登录
+            asyncio.run(run_load(port, paths, min(clients, 50), 2, cookie))  # 预热
+            stats = result['results'][name] = asyncio.run(run_load(port, paths, clients, requests, cookie))
+        finally:
+            process.terminate()
+            process.wait()
+        click.echo('  %-4s ' % name + 'p50=%(p50)8.2fms p95=%(p95)8.2fms p99=%(p99)8.2fms %(rps)8.1f req/s errors=%(errors)d'
+                   % stats, err=True)
+    json.dump(result, output, indent=2)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# 测量主页电影条目(movie_row.html)在片段缓存未命中时的渲染开销，对比打开和关闭URL缓存(URL_CACHE)
+#
+#   python -m benchmarks.rows --rows 10000 --repeat 5
+#
+# 每一轮渲染--rows个不同的电影条目(显示编辑和删除按钮)，取--repeat轮中最快的一轮，
+# 输出每个条目的平均耗时(微秒)和第一轮中调用werkzeug生成URL的次数，结果为JSON。
+import json
+import time
+
+import click
+from werkzeug.routing import MapAdapter
+
+from benchmarks.seed import app
+from watchlist.jinja import imdb_url
+from watchlist.models import Movie
+
+
+def render_rows(template, movies, repeat):
+    """返回(最快一轮的总耗时, 第一轮生成URL的次数)"""
+    builds = []
+    build = MapAdapter.build
+
+    def counting_build(adapter, *args, **kwargs):
+        builds.append(1)
+        return build(adapter, *args, **kwargs)
+
+    best = first = None
+    MapAdapter.build = counting_build
+    try:
+        for _ in range(repeat):
+            imdb_url.cache_clear()  # 每轮都是没见过的标题
+            began = time.perf_counter()
+            for movie in movies:
+                template.render(movie=movie, editable=True)
+            elapsed = time.perf_counter() - began
+            best = elapsed if best is None else min(best, elapsed)
+            if first is None:
+                first = len(builds)
+    finally:
+        MapAdapter.build = build
+    return best, first
+
+
+@click.command()
+@click.option('--rows', default=10000, show_default=True, help='Distinct movie rows rendered per round.')
+@click.option('--repeat', default=5, show_default=True, help='Rounds, the fastest one is reported.')
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON result.')
+def main(rows, repeat, output):
+    """Measure the per-row render cost with and without the URL cache"""
+    movies = [Movie(id=i, user_id=1, title='Movie %d & Friends' % i, year='2000') for i in range(1, rows + 1)]
+    result = {'meta': dict(rows=rows, repeat=repeat), 'results': {}}
+    with app.test_request_context('/'):
+        template = app.jinja_env.get_template('movie_row.html')
+        for name, enabled in (('url_for', False), ('url_cache', True)):
+            app.config['URL_CACHE'] = enabled
+            elapsed, builds = render_rows(template, movies, repeat)
+            stats = result['results'][name] = dict(us_per_row=elapsed / rows * 1000000, url_builds=builds)
+            click.echo('  %-10s ' % name + '%(us_per_row)8.2fus/row %(url_builds)8d url builds' % stats, err=True)
+    json.dump(result, output, indent=2)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+# 路由基准测试
+#
+#   python -m benchmarks.run --sizes 1000,100000 --mode client,server --output result.json
+#   python -m benchmarks.run --sizes 1000 --compare result.json
+#   python -m benchmarks.run --sizes 1000000 --users 10000 --mode client   # 多用户，每个用户只看到自己的电影
+#
+# client模式使用Flask测试客户端，server模式启动一个多线程WSGI服务器(模拟gunicorn)并发请求。
+# 每个路由输出p50/p95/p99延迟(毫秒)、每秒请求数，以及执行期间进程的峰值内存(RSS)和比开始时多占用的内存，结果为JSON，
+# 内存由一个线程每RSS_INTERVAL秒读取/proc/self/statm采样，没有/proc的系统(macOS、Windows)上为null。
+# 指定--compare时与保存的结果对比，p95变慢或吞吐量下降超过--threshold的路由标记为回归。
+import http.client
+import itertools
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import click
+
+from benchmarks.seed import BENCH_PASSWD, BENCH_USERNAME, app, seed_database, use_copy
+
+
+#要测试的路由：名称、请求方法、生成路径和表单的函数、是否需要登录
+def route_specs(size, users=1):
+    # 从中间开始删除登录用户的电影(id为1, 1+users, 1+2*users...)，每个请求删除不同的条目
+    delete_ids = itertools.count((size // 2) // users * users + 1, users)
+    return [
+        ('index', 'GET', lambda i: ('/', None), False),
+        ('index_page', 'GET', lambda i: ('/?after=%d' % (size // 2), None), False),
+        ('index_stream', 'GET', lambda i: ('/?stream=1', None), False),
+        ('search', 'GET', lambda i: ('/search?q=totoro', None), False),
+        ('login', 'GET', lambda i: ('/login', None), False),
+        ('login_post', 'POST', lambda i: ('/login', dict(username=BENCH_USERNAME, passwd=BENCH_PASSWD)), False),
+        ('edit', 'GET', lambda i: ('/movie/edit/1', None), True),
+        ('edit_post', 'POST', lambda i: ('/movie/edit/1', dict(title='Edited %d' % i, year='2000')), True),
+        ('create', 'POST', lambda i: ('/', dict(title='Created %d' % i, year='2000')), True),
+        ('delete', 'POST', lambda i: ('/movie/delete/%d' % next(delete_ids), None), True),
+    ]
+
+
+def percentile(values, p):
+    """最近秩法计算百分位数"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+RSS_INTERVAL = 0.005
+PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024 if hasattr(os, 'sysconf') else 4
+
+
+def current_rss_kb():
+    """进程当前的常驻内存，没有/proc时返回None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_KB
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+#在一个路由执行期间采样RSS；getrusage的ru_maxrss是整个进程的最高值，只升不降，不能区分路由
+class RssSampler(object):
+    def __init__(self):
+        self.start = self.peak = current_rss_kb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        if self.start is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+
+    def _run(self):
+        while not self._stop.wait(RSS_INTERVAL):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss_kb()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+    def stats(self):
+        if self.start is None:
+            return dict(peak_rss_kb=None, rss_growth_kb=None)
+        return dict(peak_rss_kb=self.peak, rss_growth_kb=self.peak - self.start)
+
+
+#Flask测试客户端，每个线程一个客户端
+class TestClient(object):
+    def __init__(self, login):
+        self.client = app.test_client()
+        if login:
+            self.request('POST', '/login', dict(username=BENCH_USERNAME, passwd=BENCH_PASSWD))
+
+    def request(self, method, path, data):
+        response = self.client.open(path, method=method, data=data)
+        response.get_data()  # 读完整个响应，流式响应也会在这里渲染
+        return response.status_code
+
+
+#通过HTTP访问真实的WSGI服务器，每个线程保存自己的会话cookie
+class HTTPClient(object):
+    def __init__(self, address, login):
+        self.address = address
+        self.cookie = None
+        if login:
+            self.request('POST', '/login', dict(username=BENCH_USERNAME, passwd=BENCH_PASSWD))
+
+    def request(self, method, path, data):
+        from urllib.parse import urlencode
+        conn = http.client.HTTPConnection(*self.address)
+        headers = {}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        response.read()
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        conn.close()
+        return response.status
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def run_route(make_client, spec, requests, concurrency):
+    """用concurrency个线程发出requests个请求，返回该路由的统计结果"""
+    name, method, make_request, login = spec
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker():
+        client = make_client(login)
+        local = []
+        for i in counter:
+            if i >= requests:
+                break
+            path, data = make_request(i)
+            start = time.perf_counter()
+            status = client.request(method, path, data)
+            local.append((time.perf_counter() - start) * 1000)
+            if status >= 400:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            for future in [executor.submit(worker) for _ in range(concurrency)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+    return dict({
+        'requests': len(latencies),
+        'errors': errors[0],
+        'p50': round(percentile(latencies, 50), 3),
+        'p95': round(percentile(latencies, 95), 3),
+        'p99': round(percentile(latencies, 99), 3),
+        'rps': round(len(latencies) / elapsed, 1),
+    }, **rss.stats())
+
+
+def run_mode(mode, size, users, requests, concurrency):
+    if mode == 'server':
+        server = make_server('127.0.0.1', 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        make_client = lambda login: HTTPClient(server.server_address, login)
+    else:
+        server = None
+        make_client = TestClient
+    try:
+        results = {}
+        for spec in route_specs(size, users):
+            run_route(make_client, spec, max(1, requests // 10), concurrency)  # 预热
+            results[spec[0]] = run_route(make_client, spec, requests, concurrency)
+            click.echo('  %-7s %-13s ' % (mode, spec[0]) +
+                       'p50=%(p50)8.2fms p95=%(p95)8.2fms p99=%(p99)8.2fms %(rps)8.1f req/s '
+                       'peak_rss=%(peak_rss_kb)sKB +%(rss_growth_kb)sKB' % results[spec[0]], err=True)
+        return results
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+def compare(result, baseline, threshold):
+    """对比两次结果，返回回归的列表"""
+    regressions = []
+    for size, modes in result['results'].items():
+        for mode, routes in modes.items():
+            for route, stats in routes.items():
+                base = baseline.get('results', {}).get(size, {}).get(mode, {}).get(route)
+                if base is None:
+                    continue
+                if stats['p95'] > base['p95'] * (1 + threshold):
+                    regressions.append((size, mode, route, 'p95', base['p95'], stats['p95']))
+                if stats['rps'] < base['rps'] * (1 - threshold):
+                    regressions.append((size, mode, route, 'rps', base['rps'], stats['rps']))
+    return regressions
+
+
+@click.command()
+@click.option('--sizes', default='1000', show_default=True, help='Comma separated movie counts, e.g. 1000,100000,1000000.')
+@click.option('--users', default=1, show_default=True, help='Users sharing the movies, the benchmark logs in as the first one.')
+@click.option('--mode', 'modes', default='client,server', show_default=True, help='client (test client) and/or server (threaded WSGI server).')
+@click.option('--requests', default=200, show_default=True, help='Requests per route.')
+@click.option('--concurrency', default=8, show_default=True, help='Concurrent clients.')
+@click.option('--fresh', is_flag=True, help='Re-seed databases instead of reusing them.')
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON result.')
+@click.option('--compare', 'baseline', type=click.File('r'), help='Saved result to compare against.')
+@click.option('--threshold', default=0.1, show_default=True, help='Allowed relative slowdown before flagging a regression.')
+def main(sizes, users, modes, requests, concurrency, fresh, output, baseline, threshold):
+    """Benchmark every route of the watchlist app"""
+    result = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'requests': requests,
+            'concurrency': concurrency,
+            'users': users,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': {},
+    }
+    for size in [int(s) for s in sizes.split(',')]:
+        click.echo('seeding %d movies' % size, err=True)
+        filename = seed_database(size, fresh=fresh, users=users)
+        result['results'][str(size)] = {}
+        for mode in modes.split(','):
+            use_copy(filename)  # 写操作会修改数据，每种模式都从同一份数据开始
+            result['results'][str(size)][mode] = run_mode(mode, size, users, requests, concurrency)
+    json.dump(result, output, indent=2)
+    output.write('\n')
+    if baseline is not None:
+        regressions = compare(result, json.load(baseline), threshold)
+        for size, mode, route, metric, before, after in regressions:
+            click.echo('REGRESSION size=%s mode=%s route=%s %s: %s -> %s' % (size, mode, route, metric, before, after), err=True)
+        if regressions:
+            sys.exit(1)
+        click.echo('no regressions', err=True)
+
+
+if __name__ == '__main__':
+    main()
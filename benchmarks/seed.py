@@ -0,0 +1,61 @@
+# 生成基准测试用的数据库，复用forge命令的虚拟数据
+import os
+import shutil
+
+from watchlist import create_app, db
+from watchlist.cache import user_cache, invalidate_pages
+from watchlist.commands import FORGE_NAME, fake_movies, insert_movies
+from watchlist.models import User
+
+BENCH_USERNAME = 'bench'
+BENCH_PASSWD = 'bench'
+
+app = create_app(dict(RATELIMIT_BACKEND='none', MAX_CONCURRENT_REQUESTS=0, MAX_CONCURRENT_WRITES=0))  # 测的是程序本身的速度
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.data')
+
+
+def use_database(filename):
+    """让app使用指定的数据库文件，并清空和旧数据库相关的缓存"""
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(filename)
+    with app.app_context():
+        user_cache.invalidate()
+        invalidate_pages()
+
+
+def seed_database(size, data_dir=DATA_DIR, fresh=False, users=1):
+    """生成一个有size条电影、users个用户的数据库文件，已经存在时直接复用
+    电影轮流分给各个用户，第一个用户是基准测试中登录的用户"""
+    os.makedirs(data_dir, exist_ok=True)
+    name = 'movies-%d.db' % size if users == 1 else 'movies-%d-users-%d.db' % (size, users)
+    filename = os.path.join(data_dir, name)
+    if fresh and os.path.exists(filename):
+        os.remove(filename)
+    if not os.path.exists(filename):
+        use_database(filename)
+        with app.app_context():
+            db.create_all()
+            user = User(name=FORGE_NAME, username=BENCH_USERNAME)
+            user.set_passwd(BENCH_PASSWD)
+            db.session.add(user)
+            db.session.commit()
+            if users > 1:  # 其他用户不需要登录，不计算密码哈希
+                db.session.execute(User.__table__.insert(),
+                                   [dict(name='User %d' % i, username='user%d' % i) for i in range(2, users + 1)])
+                db.session.commit()
+            movies = (dict(movie, user_id=i % users + user.id) for i, movie in enumerate(fake_movies(size)))
+            insert_movies(movies, chunk_size=10000)
+            db.session.remove()
+            db.engine.dispose()  # 关闭连接，WAL中的数据写回主文件
+    return filename
+
+
+def use_copy(filename):
+    """复制一份数据库给本轮测试使用，原始文件保持不变"""
+    copy = filename[:-len('.db')] + '.work.db'
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(copy + suffix):
+            os.remove(copy + suffix)
+    shutil.copyfile(filename, copy)
+    use_database(copy)
+    return copy
@@ -0,0 +1,101 @@
+# 对比各种会话方式(SESSION_BACKEND)下登录用户GET请求的开销
+#
+#   python -m benchmarks.sessions --requests 2000 --threads 4
+#
+# 每种方式创建一个程序实例，--threads个线程各自登录后依次请求/settings(需要登录、页面很小，耗时主要是会话和用户的加载)。
+# cookie模式分别测量用户缓存命中(USER_CACHE_TTL=60)和不使用用户缓存(USER_CACHE_TTL=0)两种情况。
+# 输出每种方式的延迟、每秒请求数、每个请求查询用户表的次数和会话cookie的长度，结果为JSON。
+import json
+import os
+import tempfile
+import threading
+import time
+
+import click
+from sqlalchemy import event
+
+from benchmarks.run import percentile
+from benchmarks.seed import BENCH_PASSWD, BENCH_USERNAME, app, seed_database, use_copy
+from watchlist import create_app, db
+from watchlist.cache import user_cache
+
+#名称 -> 覆盖的配置
+MODES = [
+    ('cookie', dict(SESSION_BACKEND='cookie')),
+    ('cookie_no_cache', dict(SESSION_BACKEND='cookie', USER_CACHE_TTL=0)),
+    ('token', dict(SESSION_BACKEND='token')),
+    ('memory', dict(SESSION_BACKEND='memory')),
+    ('sqlite', dict(SESSION_BACKEND='sqlite')),
+]
+
+
+def run_requests(mode_app, threads, requests):
+    """返回(耗时, 每个请求的延迟, 出错的请求数, 查询用户表的次数, cookie长度)，登录之后才开始计时和计数"""
+    latencies, errors, user_queries, cookies = [], [], [], []
+    measuring = threading.Event()
+    start = threading.Barrier(threads + 1, action=measuring.set)
+
+    def worker():
+        client = mode_app.test_client()
+        client.post('/login', data=dict(username=BENCH_USERNAME, passwd=BENCH_PASSWD))
+        cookies.extend(len(c.value) for c in client.cookie_jar if c.name == mode_app.config['SESSION_COOKIE_NAME'])
+        client.get('/settings')  # 读掉登录成功的flash消息
+        start.wait()
+        for _ in range(requests):
+            began = time.perf_counter()
+            response = client.get('/settings')
+            response.get_data()
+            latencies.append((time.perf_counter() - began) * 1000)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    def listener(conn, cursor, statement, *args):
+        if measuring.is_set() and 'FROM user' in statement:
+            user_queries.append(1)
+
+    with mode_app.app_context():
+        engine = db.engine
+        user_cache.invalidate()  # 用户缓存是全局的，不能用上一种方式留下的数据
+    event.listen(engine, 'before_cursor_execute', listener)
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    try:
+        start.wait()
+        began = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - began
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+        engine.dispose()
+    return elapsed, latencies, len(errors), len(user_queries), max(cookies) if cookies else 0
+
+
+@click.command()
+@click.option('--size', default=1000, show_default=True, help='Movies in the benchmark database.')
+@click.option('--threads', default=4, show_default=True, help='Concurrent clients.')
+@click.option('--requests', default=2000, show_default=True, help='GET requests per client.')
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON result.')
+def main(size, threads, requests, output):
+    """Compare the per-request cost of the session backends"""
+    use_copy(seed_database(size))
+    tmpdir = tempfile.mkdtemp()
+    result = {'meta': dict(size=size, threads=threads, requests=requests), 'results': {}}
+    for name, config in MODES:
+        mode_app = create_app(dict(app.config, SESSION_DB=os.path.join(tmpdir, '%s.db' % name), **config))
+        elapsed, latencies, errors, user_queries, cookie = run_requests(mode_app, threads, requests)
+        total = threads * requests
+        stats = result['results'][name] = dict(
+            p50=percentile(latencies, 50), p95=percentile(latencies, 95), p99=percentile(latencies, 99),
+            requests_per_second=total / elapsed, user_queries_per_request=user_queries / float(total),
+            cookie_bytes=cookie, errors=errors)
+        click.echo('  %-16s ' % name + 'p50=%(p50)7.3fms p95=%(p95)7.3fms %(requests_per_second)8.1f req/s '
+                   '%(user_queries_per_request)5.2f user queries/req cookie=%(cookie_bytes)dB errors=%(errors)d'
+                   % stats, err=True)
+    json.dump(result, output, indent=2)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
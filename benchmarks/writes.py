@@ -0,0 +1,103 @@
+# 对比同步提交和写合并(WRITE_BEHIND)两种方式下编辑电影的吞吐量
+#
+#   python -m benchmarks.writes --size 100000 --threads 32 --requests 200
+#
+# --threads个线程各自登录，用Flask测试客户端依次提交编辑表单(每个请求修改一部不同的电影)，
+# 写合并模式在计时结束之前等队列全部写完，所以两种方式比较的都是已经提交到数据库的修改。
+# 输出每秒完成的修改数、数据库事务提交次数和请求延迟，结果为JSON。
+import json
+import threading
+import time
+
+import click
+from sqlalchemy import event
+
+from benchmarks.run import percentile
+from benchmarks.seed import BENCH_PASSWD, BENCH_USERNAME, app, seed_database, use_copy
+from watchlist import db
+from watchlist.models import Movie, User
+from watchlist.writes import WriteQueue
+
+
+def run_edits(engine, threads, requests, movie_ids):
+    """每个线程提交requests个编辑请求，返回(耗时, 每个请求的延迟, 出错的请求数, 事务提交次数)
+    登录之后才开始计时和计数"""
+    latencies, errors, commits = [], [], []
+    start = threading.Barrier(threads + 1)
+
+    def worker(n):
+        client = app.test_client()
+        client.post('/login', data=dict(username=BENCH_USERNAME, passwd=BENCH_PASSWD))
+        ids = movie_ids[n * requests:(n + 1) * requests]
+        start.wait()
+        for i, movie_id in enumerate(ids):
+            began = time.perf_counter()
+            response = client.post('/movie/edit/%d' % movie_id, data=dict(title='Edited %d' % i, year='2000'))
+            latencies.append((time.perf_counter() - began) * 1000)
+            if response.status_code != 302:
+                errors.append(response.status_code)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    listener = lambda conn: commits.append(1)
+    event.listen(engine, 'commit', listener)
+    try:
+        start.wait()
+        began = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        writes = app.extensions.get('write_queue')
+        if writes is not None:
+            writes.flush()
+        elapsed = time.perf_counter() - began
+    finally:
+        event.remove(engine, 'commit', listener)
+    return elapsed, latencies, len(errors), len(commits)
+
+
+@click.command()
+@click.option('--size', default=100000, show_default=True, help='Movies in the benchmark database.')
+@click.option('--threads', default=32, show_default=True, help='Concurrent clients.')
+@click.option('--requests', default=200, show_default=True, help='Edits per client.')
+@click.option('--interval', default=10, show_default=True, help='WRITE_BATCH_INTERVAL in milliseconds.')
+@click.option('--batch-size', default=500, show_default=True, help='WRITE_BATCH_SIZE.')
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON result.')
+def main(size, threads, requests, interval, batch_size, output):
+    """Compare synchronous commits with write-behind batching"""
+    filename = seed_database(size)
+    result = {'meta': dict(size=size, threads=threads, requests=requests, interval=interval, batch_size=batch_size),
+              'results': {}}
+    app.config.update(WRITE_BATCH_INTERVAL=interval, WRITE_BATCH_SIZE=batch_size)
+    for name in ('sync', 'write_behind'):
+        use_copy(filename)
+        with app.app_context():
+            user_id = User.query.filter_by(username=BENCH_USERNAME).first().id
+            movie_ids = [row.id for row in db.session.query(Movie.id).filter_by(user_id=user_id)
+                         .order_by(Movie.id).limit(threads * requests)]
+            engine = db.engine
+            db.session.remove()
+        if len(movie_ids) < threads * requests:
+            raise click.ClickException('need %d movies, use a larger --size' % (threads * requests))
+        if name == 'write_behind':
+            app.extensions['write_queue'] = WriteQueue(app)
+        try:
+            elapsed, latencies, errors, commits = run_edits(engine, threads, requests, movie_ids)
+        finally:
+            writes = app.extensions.pop('write_queue', None)
+            if writes is not None:
+                writes.close()
+            engine.dispose()  # 下一轮覆盖同名的数据库副本，不能留着旧文件的连接
+        edits = threads * requests
+        stats = result['results'][name] = dict(
+            p50=percentile(latencies, 50), p95=percentile(latencies, 95), p99=percentile(latencies, 99),
+            edits_per_second=edits / elapsed, commits=commits, commits_per_second=commits / elapsed,
+            errors=errors)
+        click.echo('  %-12s ' % name + 'p50=%(p50)8.2fms p95=%(p95)8.2fms %(edits_per_second)8.1f edits/s '
+                   '%(commits)6d commits errors=%(errors)d' % stats, err=True)
+    json.dump(result, output, indent=2)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,88 @@
+import asyncio
+import gzip
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
 import unittest
-from watchlist import app, db
+from unittest import mock
+from flask import g, url_for
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+from watchlist import create_app, db, migrations
+from watchlist.asgi import AsgiApp
+from watchlist.compress import CompressMiddleware
+from watchlist.database import _needs_write_lock, setup_sqlite_engine
+from watchlist.jinja import get_fragment_cache
+from watchlist.profiling import request_stats
+from watchlist.ratelimit import Admission, AdmissionMiddleware, MemoryBucketStore, SqliteBucketStore, get_bucket_store
+from watchlist.passwords import get_password_verifier
+from watchlist.writes import WriteQueue
+from watchlist.replica import ReadReplica
+from watchlist.catalogue import CatalogueStore, write_segment
+from watchlist.jobs import TASKS, Worker, enqueue, get_job, task
+from werkzeug.routing import MapAdapter
+from werkzeug.security import generate_password_hash
+from werkzeug.test import Client
 from watchlist.models import User, Movie
-from watchlist.commands import forge, initdb
+from watchlist.commands import forge, initdb, insert_movies, compile_templates, build_assets_command, build_catalogue
+import tempfile
+
+from watchlist.cache import user_cache, invalidate_pages, FilePageStore, MemoryPageStore
 
 class WatchlistTestCase(unittest.TestCase):
     #在测试之前设定
     def setUp(self):
-        # 更新配置
-        app.config.update(
+        # 使用测试配置创建程序实例
+        self.app = create_app(dict(
             # 开启测试模式
             TESTING=True,
             # 使用内存型数据库，不会干扰已存在数据库，且速度快
-            SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'
-        )
+            SQLALCHEMY_DATABASE_URI='sqlite:///:memory:',
+            PAGE_CACHE_DIR=self.make_tmpdir(),
+            PROFILE_ENABLED=False
+        ))
+        # 推送程序上下文，测试中可以直接操作数据库
+        self.context = self.app.app_context()
+        self.context.push()
         # 创建数据库和表
         db.create_all()
+        user_cache.invalidate()  # 每个测试都会重建数据库，清除上一个测试缓存的用户和页面
+        invalidate_pages()
         # 创建测试数据，一个用户，一个电影条目
         user = User(name='Test',username='test')
         user.set_passwd('123')
-        movie = Movie(title='Test Movie Title',year='2019')
+        movie = Movie(user_id=1, title='Test Movie Title',year='2019')
         # 使用add_all一次添加多个模型实例，传入列表
         db.session.add_all([user, movie])
         db.session.commit()
 
-        self.client = app.test_client()   # 创建测试客户端，模拟客户端请求
-        self.runner = app.test_cli_runner()   # 创建测试命令运行器，触发自定义命令
+        self.client = self.app.test_client()   # 创建测试客户端，模拟客户端请求
+        self.runner = self.app.test_cli_runner()   # 创建测试命令运行器，触发自定义命令
 
     # 在测试之后做清理工作
     def tearDown(self):
         db.session.remove()  # 清除数据库会话
         db.drop_all()    # 删除数据库表
+        self.context.pop()
+
+    # 创建临时目录，测试结束后连同其中的文件一起删除
+    def make_tmpdir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, True)
+        return path
 
     # 测试程序实例是否存在
     def test_app_exists(self):
-        self.assertIsNotNone(app)
+        self.assertIsNotNone(self.app)
 
     # 测试是否处于测试模式
     def test_app_is_testing(self):
-        self.assertTrue(app.config['TESTING'])
+        self.assertTrue(self.app.config['TESTING'])
 
     # 测试客户端
     # 测试404页面
@@ -55,6 +100,319 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Test\'s Watchlist', data)
         self.assertEqual(response.status_code, 200)
 
+    # 测试主页游标分页
+    def test_index_pagination(self):
+        self.app.config['MOVIES_PER_PAGE'] = 1
+        db.session.add(Movie(user_id=1, title='Second Movie', year='2020'))
+        db.session.commit()
+
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('2 Titles', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Second Movie', data)
+        self.assertIn('/?after=1', data)
+
+        response = self.client.get('/?after=1')
+        data = response.get_data(as_text=True)
+        self.assertIn('Second Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertNotIn('Next page', data)
+        self.assertIn('First page', data)
+
+    # 测试主页流式渲染
+    def test_index_stream(self):
+        self.app.config['MOVIES_PER_PAGE'] = 1
+        db.session.add(Movie(user_id=1, title='Second Movie', year='2020'))
+        db.session.commit()
+
+        response = self.client.get('/?stream=1')
+        self.assertTrue(response.is_streamed)
+        data = response.get_data(as_text=True)
+        self.assertIn('Test\'s Watchlist', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Second Movie', data)
+        self.assertNotIn('Next page', data)
+
+    # 测试用户缓存
+    def test_user_cache(self):
+        self.client.get('/login')
+        before = user_cache.stats()
+        response = self.client.get('/login')
+        self.assertIn('Test\'s Watchlist', response.get_data(as_text=True))
+        after = user_cache.stats()
+        self.assertEqual(after['hits'], before['hits'] + 1)
+        self.assertEqual(after['misses'], before['misses'])
+
+        self.assertEqual(after['size'], 1)
+        self.assertEqual(self.client.get('/_cache').status_code, 404)  # 统计只在/_metrics中输出
+        self.assertIn('watchlist_user_cache_size 1', self.client.get('/_metrics').get_data(as_text=True))
+
+        # 设置用户名后缓存失效，页面显示新名字
+        self.login()
+        self.client.post('/settings', data=dict(name='Cached'))
+        response = self.client.get('/')
+        self.assertIn('Cached\'s Watchlist', response.get_data(as_text=True))
+
+    # 测试页面缓存和条件GET
+    def test_page_cache(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        self.assertIsNotNone(response.last_modified)
+
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # 创建条目后缓存失效
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2019'))
+        self.client.get('/logout', follow_redirects=True)
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('New Movie', response.get_data(as_text=True))
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    # 测试文件页面缓存
+    def test_file_page_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = FilePageStore(path, 2)
+            generation = store.generation()
+            store.set('a', (generation, 'etag-a', b'page a'))
+            self.assertEqual(FilePageStore(path, 2).get('a'), (generation, 'etag-a', b'page a'))
+            store.bump()
+            self.assertGreater(FilePageStore(path, 2).generation(), generation)
+            store.set('b', (generation, 'etag-b', b'page b'))
+            store.set('c', (generation, 'etag-c', b'page c'))
+            self.assertEqual(len([name for name in os.listdir(path) if name.endswith('.page')]), 2)
+
+            # 淘汰每写入max_entries/8个页面才做一次
+            store = FilePageStore(path, 16)
+            with mock.patch('watchlist.cache.os.listdir', wraps=os.listdir) as listdir:
+                for i in range(32):
+                    store.set(str(i), (generation, 'etag', b'page'))
+            self.assertEqual(listdir.call_count, 16)
+            self.assertEqual(len([name for name in os.listdir(path) if name.endswith('.page')]), 16)
+
+    # 测试进程内页面缓存的版本号在worker之间共享
+    def test_memory_page_store(self):
+        path = self.make_tmpdir()
+        store, other = MemoryPageStore(path, 2), MemoryPageStore(path, 2)  # 两个worker
+        generation = store.generation()
+        self.assertEqual(other.generation(), generation)
+        other.set('a', (generation, 'etag-a', b'page a'))
+        store.bump()
+        self.assertGreater(other.generation(), generation)  # other缓存的页面失效
+        self.assertEqual(other.get('a')[0], generation)
+        self.assertIsNone(store.get('a'))
+
+    # 测试全文搜索
+    def test_search(self):
+        db.session.add_all([Movie(user_id=1, title='Another Film', year='1990'), Movie(user_id=1, title='Testing Day', year='2001')])
+        db.session.commit()
+
+        response = self.client.get('/search?q=Tes')
+        data = response.get_data(as_text=True)
+        self.assertIn('2 Results', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Testing Day', data)
+        self.assertNotIn('Another Film', data)
+
+        response = self.client.get('/search?q=test&from=2010&format=json')
+        self.assertEqual(response.get_json()['movies'], [dict(id=1, title='Test Movie Title', year='2019')])
+
+        response = self.client.get('/search?to=1995&format=json')
+        self.assertEqual([m['title'] for m in response.get_json()['movies']], ['Another Film'])
+
+        response = self.client.get('/search?from=1900&limit=-1&format=json')  # 负数不能绕过上限
+        self.assertEqual(len(response.get_json()['movies']), 1)
+        for value in ('99', '19999', 'abcd', '-199'):  # 年份只接受4位数字
+            self.assertEqual(self.client.get('/search?from=%s&format=json' % value).status_code, 400)
+            self.assertEqual(self.client.get('/search?to=%s' % value).status_code, 400)
+
+        # 修改和删除后索引同步更新
+        movie = Movie.query.get(1)
+        movie.title = 'Renamed'
+        db.session.delete(Movie.query.get(3))
+        db.session.commit()
+        response = self.client.get('/search?q=tes&format=json')
+        self.assertEqual(response.get_json()['movies'], [])
+        response = self.client.get('/search?q="renamed&format=json')
+        self.assertEqual(len(response.get_json()['movies']), 1)
+
+    # 测试响应压缩
+    def test_compression(self):
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertTrue(response.headers['ETag'].endswith('-gzip"'))
+        self.assertIn(b'Test Movie Title', gzip.decompress(response.get_data()))
+        self.assertEqual(int(response.headers['Content-Length']), len(response.get_data()))
+
+        # 带后缀的ETag依然可以命中
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertTrue(response.headers['ETag'].endswith('-gzip"'))
+
+        # 不支持的压缩方式、太小的响应和不在列表中的类型都不压缩
+        self.assertIsNone(self.client.get('/', headers={'Accept-Encoding': 'compress'}).content_encoding)
+        self.app.config['COMPRESS_MIN_SIZE'] = 1000000
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.content_encoding)
+        # 没有压缩的版本也带Vary，代理不会把它缓存给支持压缩的客户端
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn('Accept-Encoding', self.client.get('/').headers['Vary'])
+        self.app.config['COMPRESS_MIN_SIZE'] = 10
+        response = self.client.get('/static/images/totoro.gif', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.content_encoding)
+        response.close()
+
+        # 流式响应边生成边压缩
+        db.session.bulk_save_objects([Movie(user_id=1, title='Movie %d' % i, year='2000') for i in range(1000)])
+        db.session.commit()
+        response = self.client.get('/?stream=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        chunks = list(response.response)
+        self.assertGreater(len(chunks), 2)
+        self.assertIn(b'Movie 999', gzip.decompress(b''.join(chunks)))
+
+        # 生成器形式的WSGI程序在第一次迭代时才调用start_response
+        def generator_app(environ, start_response):
+            yield b''
+            start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+            yield b'<p>generated</p>' * 100
+
+        client = Client(CompressMiddleware(generator_app, self.app.config))
+        response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()), b'<p>generated</p>' * 100)
+        response = client.get('/')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.get_data(), b'<p>generated</p>' * 100)
+
+    # 测试请求性能分析
+    def test_profiling(self):
+        self.app.config.update(PROFILE_ENABLED=True, PROFILE_SAMPLE_RATE=1.0)
+        request_stats.clear()
+        response = self.client.get('/login')
+        timing = response.headers['Server-Timing']
+        self.assertIn('app;dur=', timing)
+        self.assertIn('db;dur=', timing)
+        self.assertIn('tpl;dur=', timing)
+
+        response = self.client.get('/_metrics')
+        data = response.get_data(as_text=True)
+        self.assertIn('watchlist_request_duration_seconds_count{endpoint="login"} 1', data)
+        self.assertIn('watchlist_sql_queries_total{endpoint="login"}', data)
+        self.assertNotIn('endpoint="metrics"', data)
+
+        # 不抽样时不记录
+        self.app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        response = self.client.get('/login')
+        self.assertNotIn('Server-Timing', response.headers)
+
+    # 测试ASGI入口
+    def test_asgi_app(self):
+        asgi_app = AsgiApp(self.app)
+        messages = []
+
+        async def request(path, query=b'', app=asgi_app, disconnect_after=None, fail_after=None):
+            scope = dict(type='http', method='GET', path=path, query_string=query, headers=[(b'host', b'localhost')])
+            incoming = [dict(type='http.request', body=b'', more_body=False)]
+            disconnected = asyncio.Event()
+
+            async def receive():
+                if incoming:
+                    return incoming.pop(0)
+                await disconnected.wait()  # 请求体读完之后，客户端断开时才返回
+                return dict(type='http.disconnect')
+
+            async def send(message):
+                messages.append(message)
+                if len(messages) == fail_after:
+                    raise OSError('Connection reset')
+                if len(messages) == disconnect_after:
+                    disconnected.set()
+
+            await app(scope, receive, send)
+
+        asyncio.run(request('/'))
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/html; charset=utf-8'), messages[0]['headers'])
+        body = b''.join(m['body'] for m in messages[1:])
+        self.assertFalse(messages[-1]['more_body'])
+        self.assertIn(b'Test Movie Title', body)
+
+        # 流式响应分多块发送
+        db.session.bulk_save_objects([Movie(user_id=1, title='Movie %d' % i, year='2000') for i in range(3000)])
+        db.session.commit()
+        del messages[:]
+        asyncio.run(request('/', b'stream=1'))
+        self.assertGreater(len(messages), 2)
+        self.assertIn(b'Movie 2999', b''.join(m['body'] for m in messages[1:]))
+
+        # 客户端中途断开或者发送失败时，生成响应的线程不会一直等待队列的空位
+        for kwargs in (dict(disconnect_after=2), dict(fail_after=2)):
+            del messages[:]
+            app = AsgiApp(self.app)
+            try:
+                asyncio.run(request('/', b'stream=1', app, **kwargs))
+            except OSError:
+                pass
+            self.assertEqual(len(messages), 2)
+            shutdown = threading.Thread(target=app.executor.shutdown)
+            shutdown.start()
+            shutdown.join(5)
+            self.assertFalse(shutdown.is_alive())
+
+    # 测试视图使用ASGI入口预先查询的数据
+    def test_prefetched_data(self):
+        self.login()
+        prefetch = {'movie': dict(id=1, title='Prefetched Title', year='2000', user_id=1)}
+        response = self.client.get('/movie/edit/1', environ_base={'watchlist.prefetch': prefetch})
+        self.assertIn('Prefetched Title', response.get_data(as_text=True))
+
+        prefetch = {'index': (1, 0, 1, [dict(id=1, title='Prefetched Title', year='2000', user_id=1)])}
+        response = self.client.get('/', environ_base={'watchlist.prefetch': prefetch})
+        data = response.get_data(as_text=True)
+        self.assertIn('Prefetched Title', data)
+        self.assertNotIn('Test Movie Title', data)
+
+    # 测试每个用户只能看到和修改自己的电影
+    def test_multiple_users(self):
+        other = User(name='Other', username='other')
+        other.set_passwd('456')
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(Movie(user_id=other.id, title='Other Movie', year='2000'))
+        db.session.commit()
+
+        # 匿名用户的主页显示第一个用户的清单，/user/<username>显示指定用户的清单
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Other Movie', data)
+        data = self.client.get('/user/other').get_data(as_text=True)
+        self.assertIn("Other's watchlist", data)
+        self.assertIn('Other Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertEqual(self.client.get('/user/nobody').status_code, 404)
+
+        # 按用户名登录，主页显示自己的清单
+        self.client.post('/login', data=dict(username='other', passwd='456'))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Other Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.client.post('/', data=dict(title='New Other Movie', year='2001'))
+        self.assertEqual(Movie.query.filter_by(title='New Other Movie').first().user_id, other.id)
+
+        # 其他用户的电影不能编辑和删除，也不显示编辑按钮
+        self.assertEqual(self.client.get('/movie/edit/1').status_code, 404)
+        self.assertEqual(self.client.post('/movie/delete/1').status_code, 404)
+        self.assertNotIn('/movie/edit/1', self.client.get('/user/test').get_data(as_text=True))
+        self.assertEqual(self.client.delete('/api/v1/movies/1').status_code, 404)
+        response = self.client.get('/api/v1/movies?user=test')
+        self.assertEqual([m['title'] for m in response.get_json()['movies']], ['Test Movie Title'])
+
     # 辅助方法，用于登录用户
     def login(self):
         self.client.post('/login', data=dict(
@@ -141,6 +499,412 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Item deleted', data)
         self.assertNotIn('Test Mpvie Title', data)
 
+    # 测试写合并：修改放入队列后马上能看到，flush之后合并成一个事务提交
+    def test_write_behind(self):
+        writes = self.app.extensions['write_queue'] = WriteQueue(self.app)
+        writes.interval = 60  # 只在flush时提交
+        self.login()
+        # 放进队列的请求在加载用户(用户缓存未命中时查询数据库)之前就不再需要写锁
+        write_locks = []
+        load_user = user_cache.get
+        with mock.patch.object(user_cache, 'get', side_effect=lambda user_id: write_locks.append(_needs_write_lock()) or load_user(user_id)):
+            for path, data in (('/', dict(title='Queued Movie', year='2020')),
+                               ('/movie/edit/1', dict(title='Queued Edit', year='2019'))):
+                user_cache.invalidate()
+                g.pop('_login_user', None)  # 测试中请求共用setUp推送的程序上下文，Flask-Login会沿用上次加载的用户
+                self.client.post(path, data=data)
+        self.assertEqual(write_locks, [False, False])
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Queued Movie', data)
+        self.assertIn('Queued Edit', data)
+        self.assertIn('2 Titles', data)
+        self.assertIn('Queued Edit', self.client.get('/movie/edit/1').get_data(as_text=True))
+        self.assertEqual(Movie.query.count(), 1)  # 还没有提交
+        self.assertEqual(db.session.get(Movie, 1).title, 'Test Movie Title')
+        db.session.remove()
+
+        self.client.post('/movie/delete/1')
+        self.assertEqual(self.client.get('/movie/edit/1').status_code, 404)
+        # API先等自己的修改写完
+        self.assertEqual([m['title'] for m in self.client.get('/api/v1/movies?user=test').get_json()['movies']], ['Queued Movie'])
+        self.assertEqual(writes.batches, 1)
+        self.assertEqual(writes.writes, 3)
+        self.assertEqual(writes.pending(1), [])
+        self.assertEqual([m.title for m in Movie.query.all()], ['Queued Movie'])
+        db.session.remove()
+
+        # 数据库暂时被锁住时重试
+        errors = [OperationalError('INSERT', {}, sqlite3.OperationalError('database is locked'))]
+        apply = writes._apply
+
+        def locked_once(batch):
+            if errors:
+                raise errors.pop()
+            return apply(batch)
+
+        with mock.patch.object(writes, '_apply', side_effect=locked_once), mock.patch('watchlist.writes.RETRY_DELAY', 0):
+            self.client.post('/', data=dict(title='Retried', year='2021'))
+            writes.flush(5)
+        self.assertEqual((writes.writes, writes.failed), (4, 0))
+        self.assertEqual(Movie.query.filter_by(title='Retried').count(), 1)
+        db.session.remove()
+
+        # 仍然失败的修改计数，并在该用户的下一个页面上提示
+        broken = OperationalError('INSERT', {}, sqlite3.OperationalError('no such column: title'))
+        with mock.patch.object(writes, '_apply', side_effect=broken):
+            self.client.post('/', data=dict(title='Lost', year='2021'))
+            writes.flush(5)
+        self.assertEqual(writes.failed, 1)
+        self.assertIn('Item could not be created', self.client.get('/').get_data(as_text=True))
+        self.assertNotIn('Item could not be created', self.client.get('/').get_data(as_text=True))
+        self.assertIn('watchlist_write_behind_failed_total 1', self.client.get('/_metrics').get_data(as_text=True))
+        writes.close()
+
+    # 测试读副本：GET请求读快照，刚写过数据的用户和快照太旧时读主库
+    def test_read_replica(self):
+        tmpdir = self.make_tmpdir()
+        app = create_app(dict(self.app.config, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmpdir, 'data.db'),
+                              SQLITE_READ_REPLICA='snapshot', SQLITE_SNAPSHOT_DIR=os.path.join(tmpdir, 'snapshots'),
+                              SQLITE_REPLICA_MAX_AGE=60, PAGE_CACHE_BACKEND='none'))
+        replica = app.extensions['read_replica']
+        db.session.remove()  # 会话按线程共用，换成新程序实例的数据库
+
+        def add_movie(title):
+            with app.app_context():
+                db.session.add(Movie(user_id=1, title=title, year='2020'))
+                db.session.commit()
+                db.session.remove()
+
+        with app.app_context():
+            db.create_all()
+            user = User(name='Test', username='test')
+            user.set_passwd('123')
+            db.session.add(user)
+            db.session.commit()
+            db.session.remove()
+        add_movie('Before Snapshot')
+        replica.refresh()
+        add_movie('After Snapshot')
+        client = app.test_client()
+        data = client.get('/').get_data(as_text=True)
+        self.assertIn('Before Snapshot', data)
+        self.assertNotIn('After Snapshot', data)
+
+        # 匿名和失败的请求、没有提交数据的请求都不会让用户改读主库
+        client.post('/login', data=dict(username='test', passwd='wrong'))
+        client.post('/login', data=dict(username='test', passwd='123'))
+        client.post('/', data=dict(title='', year=''))
+        with client.session_transaction() as sess:
+            self.assertNotIn('_wrote_at', sess)
+        self.assertNotIn('After Snapshot', client.get('/').get_data(as_text=True))
+        client.post('/', data=dict(title='Mine', year='2021'))  # 提交了数据之后读主库
+        self.assertIn('After Snapshot', client.get('/').get_data(as_text=True))
+        app.config['SQLITE_REPLICA_STICKY'] = 0
+        snapshots = os.path.join(tmpdir, 'snapshots')
+        first = replica._snapshot[2]
+        replica.refresh()  # 快照还够新，不复制
+        self.assertEqual(replica._snapshot[2], first)
+        self.assertEqual(replica.refreshes, 1)
+
+        replica.max_age = 0.2
+        time.sleep(0.2)  # 快照太旧，改读主库，后台复制新的快照
+        add_movie('Newest')
+        self.assertIn('Newest', client.get('/').get_data(as_text=True))
+        while replica._refreshing:
+            time.sleep(0.01)
+        self.assertEqual(replica.refreshes, 2)
+        self.assertIn('Newest', client.get('/').get_data(as_text=True))
+
+        # 另一个worker直接使用同一份快照；主库没有变化时只更新时间，不复制
+        other = ReadReplica(replica.path, 'snapshot', 0.2, {}, 1, 0, snapshots)
+        other.refresh()
+        self.assertEqual((other.refreshes, other._snapshot[2]), (0, replica._snapshot[2]))
+        taken = replica._snapshot[1]
+        time.sleep(0.5)
+        replica.refresh()
+        self.assertEqual(replica.refreshes, 2)
+        self.assertGreater(replica._snapshot[1], taken)
+        self.assertNotIn(os.path.basename(first), os.listdir(snapshots))  # 替换超过2*max_age秒的快照已经删除
+        latest = replica._snapshot[2]
+        other.close()
+        replica.close()
+        self.assertTrue(os.path.exists(latest))  # 其他worker还在使用，关闭时不删除
+
+        # readonly模式下副本的连接不能写入
+        readonly = ReadReplica(os.path.join(tmpdir, 'data.db'), 'readonly', 5, {}, 1, 0)
+        with readonly.engine()[0].connect() as conn:
+            self.assertEqual(conn.execute(text('SELECT count(*) FROM movie')).scalar(), 4)
+            self.assertRaises(Exception, conn.execute, text("DELETE FROM movie"))
+
+    # 测试电影目录：主页的列表和总数不查询movie表，修改之后增量更新，其他worker重新映射
+    def test_catalogue(self):
+        tmpdir = self.make_tmpdir()
+        app = create_app(dict(self.app.config, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmpdir, 'data.db'),
+                              CATALOGUE=True, CATALOGUE_DIR=os.path.join(tmpdir, 'catalogue'), CATALOGUE_DELTA_SIZE=3,
+                              MOVIES_PER_PAGE=3, PAGE_CACHE_BACKEND='none'))
+        db.session.remove()
+        with app.app_context():
+            db.create_all()
+            user = User(name='Test', username='test')
+            user.set_passwd('123')
+            db.session.add(user)
+            db.session.commit()
+            insert_movies([dict(title='Movie %d' % i, year='2000', user_id=1) for i in range(1, 6)] +
+                          [dict(title='Odd Year', year='19x', user_id=1)])
+            db.session.remove()
+        client = app.test_client()
+        client.post('/login', data=dict(username='test', passwd='123'))
+        statements = []
+        with app.app_context():
+            engine = db.engine
+        # 还没有生成目录时，请求查询数据库，目录在后台线程中生成
+        self.assertIn('6 Titles', client.get('/').get_data(as_text=True))
+        store = app.extensions['catalogue']
+        store._builder.join(5)
+        self.assertEqual(store.builds, 1)
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', listener)
+        data = client.get('/').get_data(as_text=True)
+        self.assertIn('6 Titles', data)
+        self.assertIn('Movie 3', data)
+        self.assertNotIn('Movie 4', data)
+        data = client.get('/?after=3').get_data(as_text=True)
+        self.assertIn('Movie 4', data)
+        self.assertIn('19x', data)
+        self.assertEqual([s for s in statements if 'FROM movie' in s], [])
+        event.remove(engine, 'before_cursor_execute', listener)
+
+        other = CatalogueStore(store.path, store.database, store.delta_size)  # 另一个worker
+        self.assertEqual(other.get().count(1), 6)
+        client.post('/', data=dict(title='Added', year='2021'))
+        client.post('/movie/edit/4', data=dict(title='Edited', year='2001'))
+        client.post('/movie/delete/5')
+        self.assertEqual(store.builds, 1)
+        catalogue = other.get()
+        self.assertEqual(catalogue.count(1), 6)
+        self.assertEqual([m.title for m in catalogue.movies(1, 3)], ['Edited', 'Odd Year', 'Added'])
+        self.assertEqual(catalogue.movies(1, 3).__next__().year, '2001')
+        self.assertIn('Added', client.get('/?after=3').get_data(as_text=True))
+
+        client.post('/movie/delete/1')  # 增量部分超过CATALOGUE_DELTA_SIZE，在后台重新生成
+        store._builder.join(5)
+        self.assertEqual(store.builds, 2)
+        self.assertEqual(len(other.get().delta), 0)
+        self.assertEqual([m.id for m in other.get().movies(1)], [2, 3, 4, 6, 7])
+
+        # 读取CURRENT之后段文件被其他worker替换并删除，重新读取CURRENT
+        stale = other._names()
+        with app.app_context():
+            result = app.test_cli_runner().invoke(build_catalogue)
+        self.assertIn('Built catalogue of 5 movies', result.output)
+        reader = CatalogueStore(store.path, store.database, store.delta_size)
+        names = [stale]
+        reader._names = lambda: names.pop() if names else CatalogueStore._names(reader)
+        self.assertEqual(reader.get().count(1), 5)
+
+        # 生成base时不拿写锁：扫描期间其他连接可以立即写入，这些改动在发布时补进新的delta
+        def write_during_build(filename, rows, tombstones=()):
+            if os.path.basename(filename).startswith('base-'):
+                conn = sqlite3.connect(store.database, timeout=0)
+                conn.execute("UPDATE movie SET title = 'During Build' WHERE id = 2")
+                conn.commit()
+                conn.close()
+                store.changed([(1, 2)])
+            return write_segment(filename, rows, tombstones)
+
+        with mock.patch('watchlist.catalogue.write_segment', side_effect=write_during_build):
+            self.assertEqual(store.rebuild(), 5)
+        catalogue = other.get()
+        self.assertEqual(catalogue.delta.tombstones, [(1, 2)])
+        self.assertEqual([m.title for m in catalogue.movies(1)][:2], ['During Build', 'Movie 3'])
+        self.assertEqual(catalogue.count(1), 5)
+        self.assertFalse(os.path.exists(os.path.join(store.path, 'PENDING')))
+
+    # 测试统计页面和统计表的维护
+    def test_stats(self):
+        self.login()
+        self.client.post('/', data=dict(title='Old Movie', year='1994'))
+        self.client.post('/', data=dict(title='Another', year='1999'))
+        self.client.post('/', data=dict(title='Odd Year', year='19x'))
+        self.client.post('/movie/edit/1', data=dict(title='Test Movie Title', year='1999'))
+        self.client.post('/movie/delete/2')
+        data = self.client.get('/stats').get_data(as_text=True)
+        self.assertIn('3 Titles', data)
+        self.assertIn('1990s', data)
+        data = self.client.get('/api/v1/stats').get_json()
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(data['years'], [dict(year='1999', count=2), dict(year='19x', count=1)])
+        self.assertEqual(data['decades'], [dict(decade='1990s', count=2), dict(decade='Other', count=1)])
+        self.assertEqual([m['title'] for m in data['recent']], ['Odd Year', 'Another', 'Test Movie Title'])
+        self.assertEqual(self.client.get('/api/v1/stats?user=nobody').status_code, 404)
+
+        db.session.execute(text('DELETE FROM movie_year_stat'))
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/v1/stats').get_json()['total'], 0)
+        result = self.runner.invoke(args=['rebuild-stats', '--batch-size', '1'])
+        self.assertIn('Counted 3 movies', result.output)
+        self.assertEqual(self.client.get('/api/v1/stats').get_json()['years'][0], dict(year='1999', count=2))
+
+    # 测试JSON API的读取接口
+    def test_api_list_and_get(self):
+        db.session.add_all([Movie(user_id=1, title='Second Movie', year='2020'), Movie(user_id=1, title='Third Movie', year='2021')])
+        db.session.commit()
+
+        response = self.client.get('/api/v1/movies?limit=2&fields=title')
+        data = response.get_json()
+        self.assertEqual(data['movies'], [dict(title='Test Movie Title'), dict(title='Second Movie')])
+        self.assertEqual(data['next'], 2)
+
+        data = self.client.get('/api/v1/movies?after=2').get_json()
+        self.assertEqual(data['movies'], [dict(id=3, title='Third Movie', year='2021')])
+        self.assertIsNone(data['next'])
+
+        self.assertEqual(self.client.get('/api/v1/movies?fields=secret').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/movies/1').get_json()['title'], 'Test Movie Title')
+        self.assertEqual(self.client.get('/api/v1/movies/99').status_code, 404)
+
+    # 测试JSON API的修改接口
+    def test_api_mutations(self):
+        response = self.client.post('/api/v1/movies', json=dict(title='Api Movie', year='2020'))
+        self.assertEqual(response.status_code, 401)
+
+        self.login()
+        response = self.client.post('/api/v1/movies', json=dict(title='Api Movie', year='2020'))
+        self.assertEqual(response.status_code, 201)
+        movie_id = response.get_json()['id']
+        response = self.client.post('/api/v1/movies', json=dict(title='', year='2020'))
+        self.assertEqual(response.status_code, 400)
+        for data in (dict(title='X', year=1994), dict(title=['a'], year='1994')):  # 不是字符串的值
+            response = self.client.post('/api/v1/movies', json=data)
+            self.assertEqual(response.get_json(), dict(error='Invalid input'))
+            response = self.client.patch('/api/v1/movies/%d' % movie_id, json=data)
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.patch('/api/v1/movies/%d' % movie_id, json=dict(year='2021'))
+        self.assertEqual(response.get_json(), dict(id=movie_id, title='Api Movie', year='2021'))
+
+        response = self.client.delete('/api/v1/movies/%d' % movie_id)
+        self.assertEqual(response.status_code, 204)
+        self.assertIsNone(Movie.query.get(movie_id))
+
+    # 测试JSON API的批量操作
+    def test_api_batch(self):
+        db.session.add(Movie(user_id=1, title='Second Movie', year='2020'))
+        db.session.commit()
+        self.login()
+        operations = [dict(op='create', title='Movie %d' % i, year='2000') for i in range(200)]
+        operations += [dict(op='update', id=1, title='Updated'), dict(op='delete', id=2)]
+        response = self.client.post('/api/v1/movies/batch', json=dict(operations=operations))
+        results = response.get_json()['results']
+        self.assertEqual(len(results), 202)
+        self.assertEqual(results[200], dict(op='update', id=1, title='Updated', year='2019'))
+        self.assertEqual(Movie.query.count(), 201)
+
+        # 任何一个操作失败时整个批次回滚
+        operations = [dict(op='create', title='Rolled Back', year='2000'), dict(op='delete', id=999)]
+        response = self.client.post('/api/v1/movies/batch', json=dict(operations=operations))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['index'], 1)
+        self.assertEqual(Movie.query.filter_by(title='Rolled Back').count(), 0)
+
+        # 不是字符串的值返回400，之后的请求不受影响
+        for op in (dict(op='create', title='X', year=1994), dict(op='update', id=1, title=['a'])):
+            response = self.client.post('/api/v1/movies/batch', json=dict(operations=[op]))
+            self.assertEqual((response.status_code, response.get_json()['index']), (400, 0))
+        self.assertEqual(self.client.get('/api/v1/movies/1').get_json()['title'], 'Updated')
+
+    # 测试后台任务：命令和批量操作放进队列，由worker执行，失败后退避重试
+    def test_jobs(self):
+        self.login()
+        result = self.runner.invoke(forge, ['--count', '25', '--background'])
+        self.assertIn('Queued job 1', result.output)
+        self.assertEqual(Movie.query.count(), 1)
+        self.assertEqual(self.client.get('/jobs/1').get_json()['state'], 'queued')
+        operations = [dict(op='create', title='Queued %d' % i, year='2000') for i in range(3)]
+        response = self.client.post('/api/v1/movies/batch?background=1', json=dict(operations=operations))
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.headers['Location'].endswith('/jobs/2'))
+        self.client.post('/api/v1/movies/batch?background=1', json=dict(operations=[dict(op='delete', id=999)]))
+        worker = Worker(self.app, threads=1, name='test')
+        worker.run(burst=True)  # 在自己的线程中执行，直到没有到期的任务
+        self.assertEqual((worker.done, worker.failed), (2, 1))
+        job = self.client.get('/jobs/1').get_json()
+        self.assertEqual((job['state'], job['progress'], job['result']), ('done', dict(done=25, total=25), dict(movies=25)))
+        self.assertEqual(len(self.client.get('/jobs/2').get_json()['result']['results']), 3)
+        job = self.client.get('/jobs/3').get_json()
+        self.assertEqual((job['state'], job['attempts']), ('failed', 1))  # 操作不合法，不重试
+        self.assertIn('Movie not found', job['error'])
+        self.assertEqual(Movie.query.count(), 29)
+        self.assertEqual(self.client.get('/jobs/99').status_code, 404)
+
+        @task('flaky')
+        def flaky(job):
+            if job.attempts < 2:
+                raise ValueError('try again')
+            return 'ok'
+        try:
+            job_id = enqueue('flaky')
+            worker.run(burst=True)
+            job = get_job(job_id)
+            self.assertEqual((job['state'], job['attempts'], job['error']), ('queued', 1, 'ValueError: try again'))
+            self.assertGreater(job['run_at'], time.time())  # 退避之后才重试
+            db.session.execute(text('UPDATE job SET run_at = 0 WHERE id = :id'), dict(id=job_id))
+            db.session.commit()
+            worker.run(burst=True)
+            self.assertEqual(get_job(job_id)['result'], 'ok')
+
+            # 执行任务的worker失去响应，租约过期后次数已经用完的任务标记为失败
+            job_id = enqueue('flaky', max_attempts=1)
+            db.session.execute(text("UPDATE job SET state = 'running', attempts = 1, worker = 'lost', run_at = 0 "
+                                    "WHERE id = :id"), dict(id=job_id))
+            db.session.commit()
+            worker.run(burst=True)
+            self.assertEqual(get_job(job_id)['state'], 'failed')
+            self.assertEqual(get_job(job_id)['error'], 'Worker lost stopped responding')
+
+            # 取任务时数据库被锁住，线程记录错误、退避之后继续执行
+            locked = OperationalError('UPDATE job', {}, sqlite3.OperationalError('database is locked'))
+            job_id = enqueue('flaky')
+            db.session.execute(text('UPDATE job SET attempts = 1 WHERE id = :id'), dict(id=job_id))
+            db.session.commit()
+            errors = [locked]
+
+            def claim():
+                if errors:
+                    raise errors.pop()
+                return Worker._claim(worker)
+
+            with mock.patch.object(worker, '_claim', side_effect=claim), mock.patch('watchlist.jobs.ERROR_DELAY', 0.01):
+                worker.run(burst=True)
+            self.assertEqual(worker.errors, 1)
+            self.assertEqual(get_job(job_id)['result'], 'ok')
+
+            # 写结果失败的任务留在running，心跳只续约正在执行的任务，租约过期后重新执行
+            job_id = enqueue('flaky')
+            db.session.execute(text('UPDATE job SET attempts = 1 WHERE id = :id'), dict(id=job_id))
+            db.session.commit()
+            with mock.patch.object(worker, '_finish', side_effect=locked), mock.patch('watchlist.jobs.ERROR_DELAY', 0.01):
+                worker.run(burst=True)
+            self.assertEqual(worker.errors, 2)
+            job = get_job(job_id)
+            self.assertEqual((job['state'], job['attempts']), ('running', 2))
+            db.session.execute(text('UPDATE job SET run_at = 1 WHERE id = :id'), dict(id=job_id))
+            db.session.commit()
+            worker._beat()
+            self.assertEqual(db.session.execute(text('SELECT run_at FROM job WHERE id = :id'), dict(id=job_id)).scalar(), 1)
+            worker._running.add(job_id)
+            worker._beat()
+            self.assertGreater(db.session.execute(text('SELECT run_at FROM job WHERE id = :id'), dict(id=job_id)).scalar(),
+                               time.time())
+            worker._running.clear()
+            db.session.execute(text('UPDATE job SET run_at = 1 WHERE id = :id'), dict(id=job_id))
+            db.session.commit()
+            worker.run(burst=True)
+            job = get_job(job_id)
+            self.assertEqual((job['state'], job['attempts'], job['result']), ('done', 3, 'ok'))
+        finally:
+            del TASKS['flaky']
+
     ## 测试认证相关功能
     # 测试登陆保护
     def  test_login_protect(self):
@@ -194,6 +958,192 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Login success', data)
         self.assertIn('Invalid input', data)
 
+    # 测试登录时用新的哈希参数重新计算密码哈希
+    def test_login_rehash(self):
+        user = User.query.first()
+        user.passwd_hash = generate_password_hash('123', method='pbkdf2:sha256:1000')
+        db.session.commit()
+        self.assertTrue(user.passwd_needs_rehash())
+
+        self.login()
+        user = User.query.first()
+        self.assertTrue(user.passwd_hash.startswith(self.app.config['PASSWORD_HASH_METHOD'] + '$'))
+        self.assertFalse(user.passwd_needs_rehash())
+        self.assertTrue(user.check_passwd('123'))
+
+        # 省略迭代次数的配置按werkzeug的默认值比较，不会每次登录都重新计算；重新计算在密码校验的线程池中执行
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256'
+        self.assertFalse(user.passwd_needs_rehash())
+        verifier = get_password_verifier()
+        with mock.patch.object(verifier, 'hash', wraps=verifier.hash) as hash_passwd:
+            self.login()
+            self.assertFalse(hash_passwd.called)
+            self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+            self.login()
+            hash_passwd.assert_called_once_with('123', 'pbkdf2:sha256:2000')
+        self.assertTrue(User.query.first().passwd_hash.startswith('pbkdf2:sha256:2000$'))
+
+    # 测试密码校验队列已满时快速拒绝
+    def test_login_overloaded(self):
+        verifier = get_password_verifier()
+        slots = self.app.config['LOGIN_VERIFY_WORKERS'] + self.app.config['LOGIN_VERIFY_QUEUE']
+        for _ in range(slots):
+            verifier._slots.acquire()
+        try:
+            response = self.client.post('/login', data=dict(username='test', passwd='123'))
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], str(self.app.config['LOGIN_RETRY_AFTER']))
+            self.assertIn('Too Many Requests', response.get_data(as_text=True))
+        finally:
+            for _ in range(slots):
+                verifier._slots.release()
+        response = self.client.post('/login', data=dict(username='test', passwd='123'), follow_redirects=True)
+        self.assertIn('Login success', response.get_data(as_text=True))
+
+    # 测试按endpoint限流，登录用户按用户ID计数
+    def test_rate_limit(self):
+        self.app.config['RATELIMIT_RULES'] = dict(login='3/minute', api_create_movie='2/minute')
+        for _ in range(3):
+            response = self.client.post('/login', data=dict(username='test', passwd='wrong'))
+            self.assertEqual(response.status_code, 302)
+        response = self.client.post('/login', data=dict(username='test', passwd='123'))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '20')
+        self.assertEqual(self.client.get('/login').status_code, 200)  # 只限制修改数据的请求
+
+        get_bucket_store()._buckets.clear()
+        self.login()
+        for _ in range(2):
+            self.assertEqual(self.client.post('/api/v1/movies', json=dict(title='Api', year='2000')).status_code, 201)
+        response = self.client.post('/api/v1/movies', json=dict(title='Api', year='2000'))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.get_json(), dict(error='Too many requests', retry_after=30))
+        self.assertIn('api_create_movie user:1', get_bucket_store()._buckets)
+
+    # 测试令牌桶的补充和淘汰，SQLite后端在多个实例(worker)之间共享
+    def test_bucket_stores(self):
+        store = MemoryBucketStore(max_entries=2)
+        self.assertEqual(store.take('a', 2, 1, now=100), 0)
+        self.assertEqual(store.take('a', 2, 1, now=100), 0)
+        self.assertEqual(store.take('a', 2, 1, now=100), 1)
+        self.assertEqual(store.take('a', 2, 1, now=100.5), 0.5)
+        self.assertEqual(store.take('a', 2, 1, now=101), 0)
+        store.take('b', 2, 1, now=101)
+        self.assertEqual(len(store), 2)
+        store.take('c', 2, 1, now=105)  # a和b都已经补满，被淘汰
+        self.assertEqual(len(store), 1)
+
+        path = os.path.join(self.make_tmpdir(), 'ratelimit.db')
+        first, second = SqliteBucketStore(path), SqliteBucketStore(path)
+        self.assertEqual(first.take('a', 1, 0.5, now=100), 0)
+        self.assertEqual(second.take('a', 1, 0.5, now=101), 1)
+        self.assertEqual(second.take('b', 1, 0.5, now=200), 0)
+        self.assertEqual(len(second), 1)  # 已经补满的a被删除
+
+    # 测试并发上限：名额用完时直接返回503，响应关闭后释放名额
+    def test_admission(self):
+        admission = Admission(max_requests=2, max_writes=1, retry_after=3)
+
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return iter([b'ok'])
+
+        middleware = AdmissionMiddleware(wsgi_app, admission)
+        statuses = []
+
+        def call(method):
+            environ = {'REQUEST_METHOD': method}
+            return middleware(environ, lambda status, headers, exc_info=None: statuses.append((status, dict(headers))))
+
+        first = call('POST')
+        call('POST')
+        self.assertTrue(statuses[-1][0].startswith('503'))
+        self.assertEqual(statuses[-1][1]['Retry-After'], '3')
+        second = call('GET')
+        call('GET')
+        self.assertTrue(statuses[-1][0].startswith('503'))
+        first.close()
+        second.close()
+        call('POST')
+        self.assertTrue(statuses[-1][0].startswith('200'))
+
+        # ASGI入口在进入线程池之前拒绝
+        app = create_app(dict(self.app.config, MAX_CONCURRENT_REQUESTS=1))
+        asgi_app = AsgiApp(app)
+        slots = app.extensions['admission'].enter('GET')
+        messages = []
+
+        async def receive():
+            return dict(type='http.request', body=b'', more_body=False)
+
+        async def send(message):
+            messages.append(message)
+
+        scope = dict(type='http', method='GET', path='/', query_string=b'', headers=[(b'host', b'localhost')])
+        asyncio.run(asgi_app(scope, receive, send))
+        self.assertEqual(messages[0]['status'], 503)
+        app.extensions['admission'].leave(slots)
+
+    #用指定的配置创建另一个程序实例和一个用户，返回(程序实例, 引擎)
+    def session_app(self, **config):
+        app = create_app(dict(self.app.config, USER_CACHE_TTL=0, **config))
+        db.session.remove()
+        with app.app_context():
+            db.create_all()
+            user = User(name='Test', username='test')
+            user.set_passwd('123')
+            db.session.add(user)
+            db.session.commit()
+            engine = db.engine
+            db.session.remove()
+        return app, engine
+
+    # 测试token会话：GET请求用会话中的字段构造登录用户，改密码后其他地方登录的会话失效
+    def test_token_session(self):
+        app, engine = self.session_app(SESSION_BACKEND='token')
+        client, other = app.test_client(), app.test_client()
+        for c in (client, other):
+            c.post('/login', data=dict(username='test', passwd='123'))
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', listener)
+        self.assertIn('value="Test"', client.get('/settings').get_data(as_text=True))
+        event.remove(engine, 'before_cursor_execute', listener)
+        self.assertEqual([s for s in statements if 'FROM user' in s], [])
+
+        client.post('/settings', data=dict(name='Renamed'))
+        self.assertIn('value="Renamed"', client.get('/settings').get_data(as_text=True))
+        with app.app_context():
+            app.test_cli_runner().invoke(args=['admin', '--username', 'test', '--passwd', '456'])
+        response = other.post('/settings', data=dict(name='Stale'))
+        self.assertIn('/login', response.headers['Location'])
+        self.assertNotIn('Logout', other.get('/').get_data(as_text=True))
+        db.session.remove()
+
+    # 测试服务端会话：cookie中只有会话id，flash消息保存在服务端，可以从命令行撤销
+    def test_server_session(self):
+        tmpdir = self.make_tmpdir()
+        app, engine = self.session_app(SESSION_BACKEND='sqlite', SESSION_DB=os.path.join(tmpdir, 'sessions.db'))
+        store = app.extensions['session_store']
+        client = app.test_client()
+        client.post('/login', data=dict(username='test', passwd='123'))
+        cookie = [c.value for c in client.cookie_jar if c.name == 'session'][0]
+        self.assertLess(len(cookie), 64)
+        data = client.get('/').get_data(as_text=True)
+        self.assertIn('Login success.', data)
+        self.assertIn('Logout', data)
+        self.assertEqual(len(store), 1)
+
+        client.get('/logout')  # 登出时更换会话id，旧的会话删除
+        self.assertNotEqual([c.value for c in client.cookie_jar if c.name == 'session'][0], cookie)
+        self.assertEqual(len(store), 1)
+        client.post('/login', data=dict(username='test', passwd='123'))
+        with app.app_context():
+            result = app.test_cli_runner().invoke(args=['revoke-sessions', 'test'])
+        self.assertIn('Revoked 1 sessions', result.output)
+        self.assertNotIn('Logout', client.get('/').get_data(as_text=True))
+        db.session.remove()
+
     # 测试登出
     def test_logout(self):
         self.login()
@@ -240,6 +1190,186 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Done', result.output)
         self.assertNotEqual(Movie.query.count(),0)
 
+    # 测试重建搜索索引
+    def test_reindex_search_command(self):
+        db.session.execute(text("INSERT INTO movie_fts(movie_fts) VALUES ('delete-all')"))
+        db.session.commit()
+        self.assertEqual(len(Movie.search('test')), 0)
+        result = self.runner.invoke(args=['reindex-search'])
+        self.assertIn('Done', result.output)
+        self.assertEqual(len(Movie.search('test')), 1)
+
+    # 测试预编译模板
+    def test_compile_templates_command(self):
+        target = self.make_tmpdir()
+        self.app.config.update(TEMPLATES_COMPILED_DIR=os.path.join(target, 'compiled'),
+                               TEMPLATES_CACHE_DIR=os.path.join(target, 'bytecode'))
+        result = self.runner.invoke(compile_templates)
+        self.assertIn('Compiled', result.output)
+        self.assertTrue(os.listdir(os.path.join(target, 'compiled')))
+        result = self.runner.invoke(compile_templates, ['--mode', 'bytecode'])
+        self.assertTrue(os.listdir(os.path.join(target, 'bytecode')))
+
+        # compiled模式下从编译好的模块加载模板
+        app = create_app(dict(self.app.config, TEMPLATES_MODE='compiled'))
+        module_loader = app.jinja_env.loader.loaders[0]
+        self.assertEqual(module_loader.load(app.jinja_env, 'index.html').name, 'index.html')
+        with app.app_context():
+            response = app.test_client().get('/')
+        self.assertIn('Test Movie Title', response.get_data(as_text=True))
+
+    # 测试电影条目的片段缓存
+    def test_fragment_cache(self):
+        self.login()
+        self.client.get('/')
+        cache = get_fragment_cache()
+        self.assertEqual(len(cache), 1)
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertEqual(len(cache), 1)
+        self.assertIn('/movie/edit/1', data)
+
+        # 修改电影之后使用新的片段
+        self.client.post('/movie/edit/1', data=dict(title='Fragment Title', year='2019'))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Fragment Title', data)
+        self.assertEqual(len(cache), 2)
+
+    # 测试URL缓存：渲染电影条目时每个endpoint只用werkzeug生成一次URL，输出与url_for相同
+    def test_url_cache(self):
+        movies = [Movie(id=i, user_id=1, title='Movie & %d' % i, year='2000') for i in range(1, 51)]
+        template = self.app.jinja_env.get_template('movie_row.html')
+        builds = []
+        build = MapAdapter.build
+
+        def counting_build(adapter, endpoint, *args, **kwargs):
+            builds.append(endpoint)
+            return build(adapter, endpoint, *args, **kwargs)
+        with self.app.test_request_context('/'), mock.patch.object(MapAdapter, 'build', counting_build):
+            self.app.config['URL_CACHE'] = False
+            before = [template.render(movie=movie, editable=True) for movie in movies]
+            self.assertEqual(len(builds), 100)  # 每个条目两次
+            del builds[:]
+            self.app.config['URL_CACHE'] = True
+            after = [template.render(movie=movie, editable=True) for movie in movies]
+            self.assertEqual(sorted(builds), ['delete', 'edit'])
+            self.assertEqual(url_for('static', filename='css/style.css'), '/static/css/style.css')
+        self.assertEqual(before, after)
+        self.assertIn('action="/movie/delete/50"', after[-1])
+        self.assertIn('href="https://www.imdb.com/find?q=Movie+%26+50"', after[-1])
+
+    # 测试构建静态文件
+    def test_build_assets_command(self):
+        target = self.make_tmpdir()
+        self.app.config['ASSETS_DIR'] = target
+        result = self.runner.invoke(build_assets_command)
+        self.assertIn('Built 4 assets', result.output)
+
+        app = create_app(dict(self.app.config))
+        client = app.test_client()
+        with app.app_context():
+            db.create_all()
+        with app.test_request_context():
+            url = url_for('static', filename='css/style.css')
+        self.assertRegex(url, r'^/static/css/style\.[0-9a-f]{12}\.css$')
+        self.assertIn(url, client.get('/login').get_data(as_text=True))
+
+        response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        with open(os.path.join(app.static_folder, 'css', 'style.css'), 'rb') as f:
+            self.assertEqual(gzip.decompress(response.get_data()), f.read())
+        response.close()
+
+        response = client.get(url, headers={'Accept-Encoding': 'identity'})
+        self.assertIsNone(response.content_encoding)
+        response.close()
+        # 没有带哈希的文件名时仍然由static目录提供
+        response = client.get('/static/images/totoro.gif')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    # 测试把单用户的旧数据库升级到最新版本
+    def test_db_upgrade_command(self):
+        self.assertEqual(db.session.execute(text('PRAGMA user_version')).scalar(), migrations.head())
+        db.session.execute(text('DROP INDEX ix_movie_user_id_id'))
+        db.session.execute(text('DROP INDEX ix_user_username'))
+        db.session.execute(text('UPDATE movie SET user_id = NULL'))
+        db.session.execute(text('PRAGMA user_version = 1'))
+        db.session.commit()
+        db.session.add_all([Movie(title='Orphan %d' % i, year='2000') for i in range(5)])
+        db.session.add_all([User(name='User %d' % i, username='user%d' % i) for i in range(2)])
+        db.session.commit()
+        result = self.runner.invoke(args=['db', 'status'])
+        self.assertIn('Version 1, latest %d' % migrations.head(), result.output)
+        self.assertIn('pending 2: Give every movie an owner', result.output)
+
+        result = self.runner.invoke(args=['db', 'upgrade', '--batch-size', '2', '--rows-per-second', '0'])
+        self.assertIn('Rebuilding movie to index it without blocking writes', result.output)  # 超过一批，不直接建索引
+        self.assertIn('Rebuilding user to index it without blocking writes', result.output)
+        # 重建user表之后movie表的外键仍然指向user，而不是已经删除的user__old
+        movie_sql = db.session.execute(text("SELECT sql FROM sqlite_master WHERE name = 'movie'")).scalar()
+        self.assertIn('REFERENCES user ', movie_sql)
+        self.assertNotIn('user__old', movie_sql)
+        self.assertIn('Assigned 6 movies to test', result.output)
+        self.assertIn('Upgraded to version %d' % migrations.head(), result.output)
+        self.assertEqual(Movie.query.filter_by(user_id=1).count(), 6)
+        indexes = [row[1] for row in db.session.execute(text('PRAGMA index_list(movie)'))]
+        self.assertEqual(sorted(indexes), ['ix_movie_user_id_id', 'ix_movie_year'])  # 已有的索引同名建在新表上
+        self.assertEqual(len(Movie.search('orphan')), 5)
+        result = self.runner.invoke(args=['db', 'upgrade'])
+        self.assertIn('Already at version', result.output)
+
+    # 测试在线重建表：复制过程中的写入同步到新表，全文搜索的触发器移到新表上
+    def test_rebuild_table(self):
+        db.session.add_all([Movie(user_id=1, title='Movie %d' % i, year='2000') for i in range(9)])
+        db.session.commit()
+        db.session.remove()
+
+        class ConcurrentWrites(migrations.Migrator):
+            batches = 0
+
+            def throttle(self, rows, elapsed):
+                self.batches += 1
+                if self.batches == 1:  # 第一批复制完成后，修改已经复制和还没复制的行
+                    self.execute("UPDATE movie SET title = 'Renamed' WHERE id = 1")
+                    self.execute("UPDATE movie SET title = 'Renamed Later' WHERE id = 8")
+                    self.execute('DELETE FROM movie WHERE id IN (2, 9)')
+                    self.execute("INSERT INTO movie (title, year, user_id) VALUES ('Inserted', '1999', 1)")
+
+        connection = db.engine.raw_connection()
+        connection.connection.isolation_level = None
+        m = ConcurrentWrites(connection.connection, batch_size=3)
+        m.rebuild_table('movie', 'CREATE TABLE {table} (id INTEGER PRIMARY KEY, title VARCHAR(60), '
+                                 'year INTEGER, user_id INTEGER REFERENCES user(id))',
+                        ['CREATE INDEX ix_movie_year_int ON {table} (year)'],
+                        dict(year='CAST(year AS INTEGER)'))
+        connection.close()
+
+        rows = db.session.execute(text('SELECT id, title, year FROM movie ORDER BY id')).fetchall()
+        self.assertEqual(len(rows), 9)
+        self.assertEqual([row[0] for row in rows], [1, 3, 4, 5, 6, 7, 8, 10, 11])
+        self.assertEqual(rows[0], (1, 'Renamed', 2019))
+        self.assertEqual(rows[6], (8, 'Renamed Later', 2000))
+        self.assertEqual(rows[8], (11, 'Inserted', 1999))
+        tables = [row[0] for row in db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))]
+        self.assertNotIn('movie__new', tables)
+        self.assertNotIn('movie__old', tables)
+        indexes = [row[1] for row in db.session.execute(text('PRAGMA index_list(movie)'))]
+        self.assertEqual(indexes, ['ix_movie_year_int'])
+        self.assertEqual([row.id for row in Movie.search('renamed')], [1, 8])
+        db.session.execute(text("INSERT INTO movie (title, year, user_id) VALUES ('After Rebuild', 2001, 1)"))
+        db.session.commit()
+        self.assertEqual(len(Movie.search('after rebuild')), 1)
+
+    # 测试命令不会导入视图模块
+    def test_commands_do_not_import_views(self):
+        code = ("import sys; from watchlist import create_app; create_app(); "
+                "print('watchlist.views' in sys.modules, 'watchlist.errors' in sys.modules)")
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.decode().split(), ['False', 'False'])
+
     # 测试初始化数据
     def test_initdb_command(self):
         result = self.runner.invoke(initdb)
@@ -259,13 +1389,74 @@ class WatchlistTestCase(unittest.TestCase):
     # 测试更新管理员账户
     def test_admin_command_update(self):
 
-        result = self.runner.invoke(args=['admin', '--username', 'garfield', '--passwd', '456'])
+        result = self.runner.invoke(args=['admin', '--username', 'test', '--passwd', '456'])
         self.assertIn('Update the admin account', result.output)
         self.assertIn('Done', result.output)
         self.assertEqual(User.query.count(),1)
-        self.assertEqual(User.query.first().username, 'garfield')
+        self.assertEqual(User.query.first().username, 'test')
         self.assertTrue(User.query.first().check_passwd('456'))
 
+        # 新的用户名会创建另一个用户
+        result = self.runner.invoke(args=['admin', '--username', 'garfield', '--passwd', '456'])
+        self.assertIn('Create the admin account', result.output)
+        self.assertEqual(User.query.count(),2)
+
+    # 测试批量导入导出
+    def test_import_export_commands(self):
+        with tempfile.TemporaryDirectory() as path:
+            source = os.path.join(path, 'movies.csv')
+            with open(source, 'w') as f:
+                f.write('title,year\nImported One,2001\n,2002\nImported Two,2003\n')
+            result = self.runner.invoke(args=['import-movies', source, '--chunk-size', '1'])
+            self.assertIn('Imported 2 movies', result.output)
+            self.assertEqual(Movie.query.count(), 3)
+
+            target = os.path.join(path, 'movies.jsonl')
+            result = self.runner.invoke(args=['export-movies', target])
+            self.assertIn('Exported 3 movies', result.output)
+            with open(target) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(len(lines), 3)
+            self.assertIn('"title": "Imported Two"', lines[2])
+
+            result = self.runner.invoke(args=['import-movies', target])
+            self.assertIn('Imported 3 movies', result.output)
+            self.assertEqual(Movie.query.count(), 6)
+
+            # 格式不对和数据不合法的行跳过并计数，不会中断导入
+            with open(target, 'a') as f:
+                f.write('{"title": \n{"title": 1984, "year": 1949}\n["x"]\n{"title": ["a"], "year": "2000"}\n')
+            result = self.runner.invoke(args=['import-movies', target])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Imported 4 movies', result.output)
+            self.assertIn('3 skipped', result.output)
+            self.assertEqual(Movie.query.filter_by(title='1984', year='1949').count(), 1)
+
+    # 测试分块写入
+    def test_insert_movies(self):
+        movies = ({'title': 'Movie %d' % i, 'year': '2000'} for i in range(10))
+        self.assertEqual(insert_movies(movies, chunk_size=3), 10)
+        self.assertEqual(Movie.query.count(), 11)
+
+    # 测试SQLite调优设置
+    def test_sqlite_engine_setup(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'tuned.db')
+            engine = setup_sqlite_engine(create_engine('sqlite:///' + filename),
+                                         self.app.config['SQLITE_PRAGMAS'], 'immediate')
+            with engine.connect() as conn:
+                self.assertEqual(conn.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(conn.exec_driver_sql('PRAGMA busy_timeout').scalar(),
+                                 self.app.config['SQLITE_PRAGMAS']['busy_timeout'])
+            # 写请求的事务一开始就持有写锁
+            with self.app.test_request_context('/', method='POST'):
+                with engine.begin():
+                    other = sqlite3.connect(filename, timeout=0)
+                    with self.assertRaises(sqlite3.OperationalError):
+                        other.execute('BEGIN IMMEDIATE')
+                    other.close()
+            engine.dispose()
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,44 +1,68 @@
-# 包构造文件，创建程序实例
-import os
-import sys
-
+# 包构造文件，提供创建程序实例的工厂函数
 from flask import Flask
-from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
-
-#判断系统类型并做出前缀的改变
-WIN = sys.platform.startswith('win')
-if WIN:
-    prefix = "sqlite:///"
-else:
-    prefix = "sqlite:////"
-
-app = Flask(__name__)
-app.config['SECRET_KEY']=os.getenv('SECRET_KEY', 'dev') # app.secrect_key = 'dev',从环境变量中读取密钥
-# windows系统sqlite:///，其他系统sqlite:////
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(app.root_path), \
-                                                              os.getenv('DATABASE_FILE', 'data.db'))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # 关闭对模型修改的监控
-
-#在扩展类实例化之前加载配置
-db = SQLAlchemy(app)
+from flask_login import LoginManager, current_user
+
+from watchlist.database import SQLAlchemy
+
+#扩展类先实例化，在create_app()中再绑定到程序实例
+db = SQLAlchemy()
 # 实例化扩展类之外，还要实现一个“用户加载回调函数”
-login_manager = LoginManager(app)  # 实例化扩展类
+login_manager = LoginManager()  # 实例化扩展类
+login_manager.login_view = 'login' # 未登录用户访问需要登录的网站，则重定向到login
+# 使用login_manager.login_message来定义错误提示消息
 
 @login_manager.user_loader
 def load_user(user_id):    # 创建用户加载回调函数，用户ID作为参数
-    from watchlist.models import User
-    user = User.query.get(int(user_id))  # 用ID作为User模型的主键查询对应的用户
+    from watchlist.sessions import session_user
+    user = session_user(int(user_id))  # 按SESSION_BACKEND从会话中的字段或者用户缓存构造用户，见watchlist/sessions.py
     return user
 
-login_manager.login_view = 'login' # 未登录用户访问需要登录的网站，则重定向到login
-# 使用login_manager.login_message来定义错误提示消息
+#页面显示的是谁的观影清单：登录用户看自己的，匿名用户看第一个用户的
+def page_owner():
+    from watchlist.cache import user_cache
+    if current_user.is_authenticated:
+        return current_user._get_current_object()
+    return user_cache.first()
 
-#注册一个上下文处理器函数，使得user在模板上下文中可用
-@app.context_processor
+#上下文处理器函数，使得user在模板上下文中可用，视图传入的user优先
 def inject_user():
-    from watchlist.models import User
-    user = User.query.first()
+    user = page_owner()
     return dict(user=user)  #等同于返回{'user':user}
 
-from watchlist import errors,commands,views
\ No newline at end of file
+
+def create_app(config=None):
+    """创建程序实例，config可以是字典或配置对象，覆盖watchlist/settings.py中的默认配置"""
+    app = Flask(__name__)
+    app.config.from_object('watchlist.settings')
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    #在扩展类绑定之前加载配置
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.context_processor(inject_user)
+
+    # 视图和错误处理函数在第一次请求时才导入，命令只导入模型
+    from watchlist.urls import register_urls
+    from watchlist.commands import register_commands
+    from watchlist.profiling import init_profiling
+    from watchlist.jinja import init_templates
+    from watchlist.assets import init_assets
+    from watchlist.compress import init_compression
+    from watchlist.ratelimit import init_ratelimit
+    from watchlist.writes import init_writes
+    from watchlist.replica import init_replica
+    from watchlist.sessions import init_sessions
+    init_templates(app)
+    init_assets(app)
+    register_urls(app)
+    register_commands(app)
+    init_sessions(app)
+    init_writes(app)
+    init_replica(app)
+    init_profiling(app)
+    init_compression(app)
+    init_ratelimit(app)  # 最外层，超载时最先拒绝
+    return app
@@ -0,0 +1,235 @@
+# JSON API，URL前缀为/api/v1，规则见watchlist/urls.py
+from functools import wraps
+
+from flask import current_app, jsonify, request, url_for
+from flask_login import current_user
+
+from watchlist import db, page_owner
+from watchlist.cache import invalidate_pages
+from watchlist.models import Movie, User, valid_movie
+from watchlist.writes import flush_writes
+from watchlist.catalogue import catalogue_changed
+from watchlist.stats import owner_stats
+from watchlist.jobs import enqueue, get_job
+
+MOVIE_FIELDS = ('id', 'title', 'year')
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 1000
+MAX_BACKGROUND_BATCH_SIZE = 50000  # 后台执行的批量操作
+
+
+def api_error(status, message, **extra):
+    response = jsonify(error=message, **extra)
+    response.status_code = status
+    return response
+
+
+#修改数据的接口需要登录，未登录时返回401而不是重定向到登录页面
+def api_login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return api_error(401, 'Authentication required')
+        return view(*args, **kwargs)
+    return wrapper
+
+
+#API同步读写数据库，先等当前用户在写合并队列中的修改提交，见watchlist/writes.py
+def flush_own_writes():
+    if current_user.is_authenticated:
+        flush_writes(current_user.id)
+
+
+def movie_dict(movie):
+    return dict(id=movie.id, title=movie.title, year=movie.year)
+
+
+def get_json():
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else None
+
+
+#列出一个用户(user参数，缺省时同主页)的电影：按id做游标分页，fields参数选择返回的字段
+def list_movies():
+    flush_own_writes()
+    fields = request.args.get('fields')
+    fields = [f for f in fields.split(',') if f] if fields else list(MOVIE_FIELDS)
+    if not fields or any(f not in MOVIE_FIELDS for f in fields):
+        return api_error(400, 'fields must be chosen from %s' % ','.join(MOVIE_FIELDS))
+    limit = request.args.get('limit', current_app.config['MOVIES_PER_PAGE'], type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    after = request.args.get('after', 0, type=int)
+    username = request.args.get('user')
+    owner = User.query.filter_by(username=username).first() if username else page_owner()
+    if owner is None:
+        return api_error(404, 'User not found')
+    columns = [Movie.id] + [getattr(Movie, f) for f in fields if f != 'id']  # 只查询需要的列，不创建ORM对象
+    rows = (db.session.query(*columns).filter(Movie.user_id == owner.id, Movie.id > after)
+            .order_by(Movie.id).limit(limit + 1).all())
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    movies = [dict((f, getattr(row, f)) for f in fields) for row in rows[:limit]]
+    return jsonify(movies=movies, next=next_cursor)
+
+
+def get_movie(movie_id):
+    flush_own_writes()
+    movie = Movie.query.get(movie_id)
+    if movie is None:
+        return api_error(404, 'Movie not found')
+    return jsonify(movie_dict(movie))
+
+
+@api_login_required
+def create_movie():
+    flush_own_writes()
+    data = get_json()
+    if data is None or not valid_movie(data.get('title'), data.get('year')):
+        return api_error(400, 'Invalid input')
+    movie = Movie(title=data['title'], year=data['year'], user_id=current_user.id)
+    db.session.add(movie)
+    db.session.commit()
+    catalogue_changed(current_user.id, movie.id)
+    invalidate_pages()
+    return jsonify(movie_dict(movie)), 201
+
+
+#当前用户自己的电影，不存在或者属于其他用户时返回None
+def own_movie(movie_id):
+    return Movie.query.filter_by(id=movie_id, user_id=current_user.id).first()
+
+
+@api_login_required
+def update_movie(movie_id):
+    flush_own_writes()
+    movie = own_movie(movie_id)
+    if movie is None:
+        return api_error(404, 'Movie not found')
+    data = get_json()
+    if data is None or not _apply_update(movie, data):
+        return api_error(400, 'Invalid input')
+    db.session.commit()
+    catalogue_changed(current_user.id, movie_id)
+    invalidate_pages()
+    return jsonify(movie_dict(movie))
+
+
+@api_login_required
+def delete_movie(movie_id):
+    flush_own_writes()
+    movie = own_movie(movie_id)
+    if movie is None:
+        return api_error(404, 'Movie not found')
+    db.session.delete(movie)
+    db.session.commit()
+    catalogue_changed(current_user.id, movie_id)
+    invalidate_pages()
+    return '', 204
+
+
+#观影统计：?user=用户名，缺省时与list_movies相同
+def stats():
+    flush_own_writes()
+    username = request.args.get('user')
+    owner = User.query.filter_by(username=username).first() if username else page_owner()
+    if owner is None:
+        return api_error(404, 'User not found')
+    data = owner_stats(owner.id)
+    return jsonify(total=data['total'], years=[dict(year=year, count=count) for year, count in data['years']],
+                   decades=[dict(decade=decade, count=count) for decade, count in data['decades']],
+                   recent=[dict(id=m.id, title=m.title, year=m.year) for m in data['recent']])
+
+
+#PATCH只修改传入的字段，修改后的数据不合法时返回False
+def _apply_update(movie, data):
+    title = data.get('title', movie.title)
+    year = data.get('year', movie.year)
+    if not valid_movie(title, year):
+        return False
+    movie.title = title
+    movie.year = year
+    return True
+
+
+#批量操作：一个请求中的所有操作在同一个事务中执行，任何一个失败时全部回滚
+#请求体格式 {"operations": [{"op": "create", "title": ..., "year": ...},
+#                         {"op": "update", "id": 1, "title": ...}, {"op": "delete", "id": 2}]}
+#加上?background=1时放进后台任务队列，立即返回202和任务的状态，结果从Location中的/jobs/<id>查询
+@api_login_required
+def batch():
+    flush_own_writes()
+    data = get_json()
+    operations = data.get('operations') if data is not None else None
+    background = request.args.get('background', type=int)
+    if not isinstance(operations, list) or not operations:
+        return api_error(400, 'operations must be a non-empty list')
+    limit = MAX_BACKGROUND_BATCH_SIZE if background else MAX_BATCH_SIZE
+    if len(operations) > limit:
+        return api_error(400, 'At most %d operations per batch' % limit)
+    if background:
+        job_id = enqueue('batch', user_id=current_user.id, operations=operations)
+        response = jsonify(get_job(job_id))
+        response.status_code = 202
+        response.headers['Location'] = url_for('job_status', job_id=job_id)
+        return response
+    try:
+        body = apply_batch(current_user.id, operations)
+    except BatchError as e:
+        return api_error(e.status, e.message, index=e.index)
+    return jsonify(results=body)
+
+
+class BatchError(Exception):
+    def __init__(self, index, message, status=400):
+        Exception.__init__(self, 'Operation %d: %s' % (index, message))
+        self.index = index
+        self.message = message
+        self.status = status
+
+
+def apply_batch(user_id, operations):
+    """在一个事务中执行user_id的批量操作，返回每个操作的结果，失败时回滚并抛出BatchError，后台任务也使用"""
+    # 需要修改和删除的电影一次查询出来，只能操作自己的电影
+    ids = set(op['id'] for op in operations if isinstance(op, dict) and isinstance(op.get('id'), int))
+    movies = {}
+    if ids:
+        movies = dict((m.id, m) for m in Movie.query.filter(Movie.user_id == user_id, Movie.id.in_(ids)))
+    results = []
+    try:
+        for index, op in enumerate(operations):
+            kind = op.get('op') if isinstance(op, dict) else None
+            if kind == 'create':
+                if not valid_movie(op.get('title'), op.get('year')):
+                    raise BatchError(index, 'Invalid input')
+                movie = Movie(title=op['title'], year=op['year'], user_id=user_id)
+                db.session.add(movie)
+                results.append(movie)
+            elif kind in ('update', 'delete'):
+                movie = movies.get(op.get('id'))
+                if movie is None:
+                    raise BatchError(index, 'Movie not found', 404)
+                if kind == 'update' and not _apply_update(movie, op):
+                    raise BatchError(index, 'Invalid input')
+                if kind == 'delete':
+                    db.session.delete(movie)
+                    del movies[movie.id]
+                results.append(movie)
+            else:
+                raise BatchError(index, 'Unknown op')
+    except BatchError:
+        db.session.rollback()
+        raise
+    db.session.flush()  # 生成新建电影的id
+    body = [dict(op=op['op'], **movie_dict(movie)) for op, movie in zip(operations, results)]
+    db.session.commit()
+    catalogue_changed(user_id, *set(item['id'] for item in body))
+    invalidate_pages()
+    return body
+
+
+#后台任务的状态，字段见jobs.job_dict()，只能查看自己的任务和命令行放进队列的任务
+@api_login_required
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None or job['user_id'] not in (None, current_user.id):
+        return api_error(404, 'Job not found')
+    return jsonify(job)
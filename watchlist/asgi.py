@@ -0,0 +1,305 @@
+# ASGI入口，用法见项目根目录的asgi.py(uvicorn asgi:app)
+#
+# Flask本身是同步的WSGI程序，这里把它桥接到ASGI：事件循环负责接收请求和发送响应，
+# 视图在线程池(ASGI_THREADS)中执行，保持连接(keep-alive)的空闲连接和慢客户端不再占用线程。
+#
+# 安装了aiosqlite时，主要是读操作的几个路由(主页和用户清单页、编辑页面的GET请求、登录时查询用户)
+# 在进入线程池之前先用SQLAlchemy的异步引擎查询好数据，放在environ中交给视图使用，
+# 线程只负责渲染模板，密码校验仍然在passwords.py的线程池中进行。
+# 没有安装aiosqlite或者使用内存数据库时，所有请求都直接交给线程池，视图自己查询数据库。
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import parse_qs
+
+from flask import request
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RoutingException
+
+try:
+    import aiosqlite
+except ImportError:  # 可选依赖
+    aiosqlite = None
+
+from watchlist.database import setup_sqlite_engine
+from watchlist.models import Movie, User
+from watchlist.ratelimit import ADMITTED_KEY
+
+PREFETCH_KEY = 'watchlist.prefetch'
+BUFFER_SIZE = 65536  # 响应体攒够这么多字节再发送一次
+QUEUE_SIZE = 4       # 线程最多领先事件循环几块响应体，慢客户端会让线程等待而不是占用内存
+PUT_POLL_INTERVAL = 0.1  # 线程等待队列空位时，每隔这么多秒检查一次客户端是否已经断开
+
+
+class ClientDisconnected(Exception):
+    """客户端已经断开或者发送失败，生成响应的线程不再继续"""
+
+
+def prefetched(name):
+    """读取ASGI入口预先查询的数据，以WSGI方式运行或者没有预先查询时返回None"""
+    return request.environ.get(PREFETCH_KEY, {}).get(name)
+
+
+def build_environ(scope, body):
+    """根据ASGI的scope生成WSGI的environ"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:  # 重复的请求头合并成一个，Cookie用分号分隔
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+        environ[name] = value
+    return environ
+
+
+class AsgiApp(object):
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(app.config['ASGI_THREADS'], thread_name_prefix='asgi')
+        self.engine = None
+        self._started = False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise RuntimeError('Unsupported ASGI scope type %r' % scope['type'])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                writes = self.app.extensions.get('write_queue')
+                if writes is not None:  # 先把写合并队列中的修改提交
+                    await asyncio.get_running_loop().run_in_executor(None, writes.close)
+                if self.engine is not None:
+                    await self.engine.dispose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _startup(self):
+        if not self._started:
+            self.engine = self._create_engine()
+            self._started = True
+
+    def _create_engine(self):
+        url = make_url(self.app.config['SQLALCHEMY_DATABASE_URI'])
+        if aiosqlite is None or url.drivername != 'sqlite' or url.database in (None, '', ':memory:'):
+            return None
+        from sqlalchemy.ext.asyncio import create_async_engine
+        from sqlalchemy.pool import AsyncAdaptedQueuePool
+        config = self.app.config
+        engine = create_async_engine(url.set(drivername='sqlite+aiosqlite'), poolclass=AsyncAdaptedQueuePool,
+                                     pool_size=config['SQLITE_POOL_SIZE'], max_overflow=config['SQLITE_POOL_OVERFLOW'])
+        setup_sqlite_engine(engine.sync_engine, dict(config['SQLITE_PRAGMAS']), 'deferred')  # 只读，不需要写锁
+        return engine
+
+    async def _http(self, scope, receive, send):
+        self._startup()  # 服务器不支持lifespan时在第一个请求中初始化
+        # 并发上限在进入线程池之前检查，超载时不读取请求体、不查询数据库，直接返回503
+        admission = self.app.extensions.get('admission')
+        slots = admission.enter(scope['method']) if admission is not None else None
+        if admission is not None and slots is None:
+            response = admission.overloaded()
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response.headers]})
+            await send({'type': 'http.response.body', 'body': response.get_data()})
+            return
+        try:
+            await self._serve(scope, receive, send, slots is not None)
+        finally:
+            if slots is not None:
+                admission.leave(slots)
+
+    async def _serve(self, scope, receive, send, admitted):
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        environ = build_environ(scope, b''.join(body))
+        if admitted:
+            environ[ADMITTED_KEY] = True
+        if self.engine is not None:
+            data = await self._prefetch(environ)
+            if data:
+                environ[PREFETCH_KEY] = data
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(QUEUE_SIZE)
+        response = {}
+        cancelled = threading.Event()
+
+        # 队列满时线程在这里等待；客户端断开、发送失败或者请求被取消之后不再等待，抛出ClientDisconnected
+        def put(item):
+            if cancelled.is_set():
+                raise ClientDisconnected()
+            waiter = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            while True:
+                try:
+                    return waiter.result(PUT_POLL_INTERVAL)
+                except FutureTimeoutError:
+                    if cancelled.is_set():
+                        waiter.cancel()
+                        raise ClientDisconnected()
+
+        future = loop.run_in_executor(self.executor, self._run_wsgi, environ, response, put)
+        disconnect = asyncio.ensure_future(self._wait_disconnect(receive))
+        finished = False
+        try:
+            started = False
+            while True:
+                get = asyncio.ensure_future(queue.get())
+                await asyncio.wait((get, disconnect), return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():  # 客户端在响应发完之前断开
+                    get.cancel()
+                    return
+                item = get.result()
+                if item is None:  # 视图之外出现异常(Flask已经处理了视图中的异常)
+                    finished = True
+                    await future
+                    return
+                data, more = item
+                if not started:
+                    await send({'type': 'http.response.start', 'status': response['status'],
+                                'headers': response['headers']})
+                    started = True
+                await send({'type': 'http.response.body', 'body': data, 'more_body': more})
+                if not more:
+                    break
+            finished = True
+            await future
+        finally:
+            disconnect.cancel()
+            if not finished:  # 让线程停止生成响应、关闭WSGI的返回值，结果不再等待
+                cancelled.set()
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    #请求体读完之后receive()只会返回http.disconnect
+    async def _wait_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    #在线程池中执行，同一个响应的所有块都在同一个线程中生成，stream_with_context依赖这一点
+    def _run_wsgi(self, environ, response, put):
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                chunks, size = [], 0
+                for chunk in result:
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= BUFFER_SIZE:
+                        put((b''.join(chunks), True))
+                        chunks, size = [], 0
+                put((b''.join(chunks), False))
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except ClientDisconnected:
+            return
+        except BaseException:
+            try:
+                put(None)
+            except ClientDisconnected:
+                pass
+            raise
+
+    def _session_user_id(self, environ):
+        """从会话cookie中读出登录用户的ID，没有登录时返回None"""
+        session = self.app.session_interface.open_session(self.app, self.app.request_class(environ))
+        user_id = session.get('_user_id') if session is not None else None
+        return int(user_id) if user_id is not None else None
+
+    async def _prefetch(self, environ):
+        """用异步引擎查询视图需要的数据，返回放入environ的字典"""
+        try:
+            endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+        except (HTTPException, RoutingException):  # 404、405和重定向都交给Flask处理
+            return None
+        method = environ['REQUEST_METHOD']
+        config = self.app.config
+        if endpoint in ('index', 'user_index') and method == 'GET':
+            query = parse_qs(environ['QUERY_STRING'])
+            if query.get('stream', ['1' if config['INDEX_STREAM'] else '0'])[0] != '0' or config['CATALOGUE']:
+                return None  # 流式渲染和电影目录都不需要预先查询
+            # 匿名用户的页面命中页面缓存时根本不查询数据库，只为登录用户或者关闭页面缓存时预先查询
+            # 服务端会话要读取会话存储，是阻塞的I/O，放到线程池中执行
+            user_id = await asyncio.get_running_loop().run_in_executor(self.executor, self._session_user_id, environ)
+            if user_id is None and config['PAGE_CACHE_BACKEND'] != 'none':
+                return None
+            try:
+                after = int(query.get('after', ['0'])[0])
+            except ValueError:
+                after = 0
+            per_page = config['MOVIES_PER_PAGE']
+            async with self.engine.connect() as conn:
+                # 与views.movie_list()中的page_owner()相同：指定的用户、登录用户或第一个用户
+                if endpoint == 'user_index':
+                    owner_id = (await conn.execute(select(User.id).where(User.username == args['username']))).scalar()
+                elif user_id is not None:
+                    owner_id = user_id
+                else:
+                    owner_id = (await conn.execute(select(User.id).order_by(User.id).limit(1))).scalar()
+                if owner_id is None:
+                    return None
+                count = (await conn.execute(select(func.count()).select_from(Movie.__table__)
+                                            .where(Movie.user_id == owner_id))).scalar()
+                rows = await conn.execute(select(Movie.id, Movie.title, Movie.year, Movie.user_id)
+                                          .where(Movie.user_id == owner_id, Movie.id > after)
+                                          .order_by(Movie.id).limit(per_page + 1))
+                return {'index': (owner_id, after, count, [dict(row._mapping) for row in rows])}
+        if endpoint == 'edit' and method == 'GET':
+            async with self.engine.connect() as conn:
+                rows = await conn.execute(select(Movie.id, Movie.title, Movie.year, Movie.user_id)
+                                          .where(Movie.id == args['movie_id']))
+                row = rows.first()
+            return {'movie': dict(row._mapping)} if row is not None else None
+        if endpoint == 'login' and method == 'POST':
+            if not environ.get('CONTENT_TYPE', '').startswith('application/x-www-form-urlencoded'):
+                return None
+            form = parse_qs(environ['wsgi.input'].getvalue().decode('utf-8', 'replace'))
+            username = form.get('username', [None])[0]
+            if not username:
+                return None
+            async with self.engine.connect() as conn:
+                row = (await conn.execute(select(User.__table__).where(User.username == username))).first()
+            return {'user': dict(row._mapping)} if row is not None else None
+        return None
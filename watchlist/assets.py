@@ -0,0 +1,125 @@
+# 静态文件：构建时按内容哈希重命名并预压缩，运行时url_for('static')自动使用带哈希的文件名
+#
+# flask build-assets把static目录中的文件复制到ASSETS_DIR，文件名中加入内容哈希
+# (css/style.css -> css/style.1a2b3c4d5e6f.css)，可压缩的文件同时生成.gz和.br(安装了brotli时)，
+# 对应关系写入manifest.json。程序启动时读取manifest，url_for('static', filename=...)返回带哈希的URL。
+# 这些URL的内容永远不会变，响应带一年的max-age和immutable，浏览器再次访问页面时不会发出任何静态文件请求。
+# 响应按Accept-Encoding选择预压缩的文件，用send_file发送文件路径，
+# gunicorn等提供wsgi.file_wrapper的服务器会用sendfile零拷贝发送，前面有nginx时可以打开USE_X_SENDFILE。
+# 旧版本的文件不会被删除，页面缓存和浏览器中的旧页面依然能加载到对应的文件。重新构建之后需要重启worker。
+# 没有构建过时和原来一样由Flask直接提供static目录中的文件。
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import current_app, request, send_file
+
+try:
+    import brotli
+except ImportError:  # 可选依赖，没有安装时只生成gzip
+    brotli = None
+
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = frozenset(['.css', '.js', '.svg', '.ico', '.txt', '.json', '.html'])  # gif、png等已经压缩过
+#按优先级排列的压缩方式：Content-Encoding、文件后缀、压缩函数
+CODECS = [('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+if brotli is not None:
+    CODECS.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+SUFFIXES = dict((encoding, suffix) for encoding, suffix, _ in CODECS)
+
+
+def _write(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+
+def build_assets(source, target):
+    """把source目录中的静态文件构建到target目录，返回manifest"""
+    manifest = {}
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, source).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            base, ext = os.path.splitext(filename)
+            hashed = '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:12], ext)
+            output = os.path.join(target, hashed)
+            _write(output, data)
+            encodings = []
+            if ext.lower() in COMPRESSIBLE:
+                for encoding, suffix, compress in CODECS:
+                    packed = compress(data)
+                    if len(packed) < len(data) * 0.9:  # 压缩效果不明显时不生成
+                        _write(output + suffix, packed)
+                        encodings.append(encoding)
+            manifest[filename] = dict(path=hashed, encodings=encodings)
+    _write(os.path.join(target, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+#构建结果，urls用于生成URL，files用于提供文件
+class Assets(object):
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.urls = dict((filename, entry['path']) for filename, entry in manifest.items())
+        self.files = dict((entry['path'], (filename, entry['encodings'])) for filename, entry in manifest.items())
+
+
+def load_assets(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return Assets(directory, json.load(f))
+    except (IOError, ValueError):
+        return None
+
+
+#url_for('static', filename=...)换成带哈希的文件名
+def fingerprint_url(endpoint, values):
+    if endpoint == 'static':
+        hashed = current_app.extensions['assets'].urls.get(values.get('filename'))
+        if hashed is not None:
+            values['filename'] = hashed
+
+
+def _negotiate(encodings):
+    for encoding in encodings:
+        if request.accept_encodings.quality(encoding) > 0:
+            return encoding
+    return None
+
+
+#替换Flask默认的static视图，带哈希的文件从ASSETS_DIR提供，其他文件仍然从static目录提供
+def static(filename):
+    entry = current_app.extensions['assets'].files.get(filename)
+    if entry is None:
+        return current_app.send_static_file(filename)
+    source, encodings = entry
+    path = os.path.join(current_app.extensions['assets'].directory, filename)  # filename来自manifest，不需要safe_join
+    encoding = _negotiate([e for e in SUFFIXES if e in encodings])
+    if encoding is not None:
+        path += SUFFIXES[encoding]
+    mimetype = mimetypes.guess_type(source)[0] or 'application/octet-stream'
+    response = send_file(path, mimetype=mimetype, max_age=current_app.config['ASSETS_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if encodings:
+        response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.content_encoding = encoding
+    return response
+
+
+def init_assets(app):
+    assets = load_assets(app.config['ASSETS_DIR'])
+    if assets is None:
+        return
+    app.extensions['assets'] = assets
+    app.url_defaults(fingerprint_url)
+    app.view_functions['static'] = static
@@ -0,0 +1,254 @@
+# 缓存
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+from sqlalchemy.orm import make_transient_to_detached
+
+from watchlist import db
+from watchlist.replica import read_data_time
+
+
+#进程内的用户缓存，按用户ID保存用户的列值，避免每个页面都查询一次用户表。
+#每个worker(以及命令行进程)各有一份，invalidate()只清除当前进程的缓存：flask admin等命令修改用户之后，
+#网页worker仍然使用旧的名字和密码哈希，直到USER_CACHE_TTL秒后过期，进程之间的不一致只由这个时间限制
+class UserCache(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}      # user_id -> (过期时间, 列值字典)
+        self._first_id = None   # 第一个用户的ID，匿名用户看到的是这个用户的清单
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """按ID读取用户，等同于User.query.get(user_id)"""
+        from watchlist.models import User
+        data = self._lookup(user_id)
+        if data is not None:
+            return self._attach(data)
+        user = User.query.get(user_id)
+        self._store(user)
+        return user
+
+    def first(self):
+        """读取第一个用户，等同于User.query.order_by(User.id).first()"""
+        from watchlist.models import User
+        data = self._lookup(self._first_id)
+        if data is not None:
+            return self._attach(data)
+        user = User.query.order_by(User.id).first()
+        self._store(user, first=True)
+        return user
+
+    def invalidate(self, user_id=None):
+        """写入用户后调用，不传user_id时清空整个缓存，只影响当前进程"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._first_id = None
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+    def _lookup(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id) if user_id is not None else None
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def _store(self, user, first=False):
+        ttl = current_app.config['USER_CACHE_TTL']
+        if user is None or ttl <= 0:
+            return
+        data = dict((c.key, getattr(user, c.key)) for c in user.__table__.columns)
+        with self._lock:
+            self._entries[user.id] = (time.time() + ttl, data)
+            if first:
+                self._first_id = user.id
+
+    def _attach(self, data):
+        return attach_user(data)
+
+
+user_cache = UserCache()
+
+
+#用列值重建用户对象并合并进当前会话，load=False不会发出SELECT，
+#这样current_user被修改后依然可以正常db.session.commit()
+def attach_user(data):
+    from watchlist.models import User
+    user = User(**data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+#页面缓存的版本号取当前微秒时间戳，单调递增，同时可以换算成Last-Modified
+def _next_generation(generation):
+    return max(generation + 1, int(time.time() * 1000000))
+
+
+#先写临时文件再原子替换，其他worker不会读到写了一半的文件
+def _write_file(filename, data):
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+
+#版本号保存在缓存目录的GENERATION文件中，所有worker共享：任何一个worker修改数据之后，
+#其他worker缓存的页面和发出的ETag同时失效。每次读取缓存都要读一次这个小文件
+class SharedGeneration(object):
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.filename = os.path.join(path, 'GENERATION')
+
+    def get(self):
+        try:
+            with open(self.filename) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return self.bump()
+
+    def bump(self):
+        try:
+            with open(self.filename) as f:
+                generation = int(f.read())
+        except (IOError, ValueError):
+            generation = 0
+        generation = _next_generation(generation)
+        _write_file(self.filename, str(generation).encode())
+        return generation
+
+
+#进程内的页面缓存，超出容量时淘汰最久未使用的页面，版本号与其他worker共享
+class MemoryPageStore(object):
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()   # key -> (版本号, etag, 页面内容)
+        self._generation = SharedGeneration(path)
+
+    def generation(self):
+        return self._generation.get()
+
+    def bump(self):
+        self._generation.bump()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def set(self, key, page):
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+
+
+#基于文件的页面缓存，多个gunicorn worker共享同一个目录，按文件修改时间淘汰。
+#淘汰要列出整个目录，每个worker每写入max_entries/8个页面才做一次，页面数最多暂时超出这么多
+class FilePageStore(object):
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._generation = SharedGeneration(path)
+        self._evict_every = max(1, max_entries // 8)
+        self._writes = 0
+
+    def generation(self):
+        return self._generation.get()
+
+    def bump(self):
+        self._generation.bump()
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                header, body = f.read().split(b'\n', 1)
+            os.utime(filename)  # 记录最近一次使用
+        except (IOError, ValueError):
+            return None
+        generation, etag = header.decode().split(' ')
+        return int(generation), etag, body
+
+    def set(self, key, page):
+        generation, etag, body = page
+        _write_file(self._filename(key), ('%d %s\n' % (generation, etag)).encode() + body)
+        self._writes += 1
+        if self._writes % self._evict_every == 0:
+            self._evict()
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.page')
+
+    def _evict(self):
+        pages = [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith('.page')]
+        if len(pages) <= self.max_entries:
+            return
+        pages.sort(key=lambda name: os.stat(name).st_mtime)
+        for name in pages[:len(pages) - self.max_entries]:
+            try:
+                os.remove(name)
+            except OSError:  # 可能已经被其他worker删除
+                pass
+
+
+def get_page_store():
+    store = current_app.extensions.get('page_cache')
+    if store is None:
+        if current_app.config['PAGE_CACHE_BACKEND'] == 'file':
+            store = FilePageStore(current_app.config['PAGE_CACHE_DIR'], current_app.config['PAGE_CACHE_SIZE'])
+        else:
+            store = MemoryPageStore(current_app.config['PAGE_CACHE_DIR'], current_app.config['PAGE_CACHE_SIZE'])
+        current_app.extensions['page_cache'] = store
+    return store
+
+
+#电影或用户数据发生变化后调用，使所有缓存的页面失效
+def invalidate_pages():
+    get_page_store().bump()
+
+
+#只缓存匿名用户的GET请求，并且没有待显示的flash消息
+def _page_cacheable():
+    return (current_app.config['PAGE_CACHE_BACKEND'] != 'none' and request.method == 'GET'
+            and not current_user.is_authenticated and not session.get('_flashes'))
+
+
+def cached_page(render, *args, status=200):
+    """返回render(*args)渲染的页面，缓存命中时既不渲染也不查询数据库"""
+    if not _page_cacheable():
+        return make_response(render(*args), status)
+    store = get_page_store()
+    generation = store.generation()
+    key = '%d %s' % (status, request.full_path)
+    page = store.get(key)
+    if page is None or page[0] != generation:
+        body = render(*args).encode('utf-8')
+        page = (generation, hashlib.sha1(body).hexdigest(), body)
+        data_time = read_data_time()
+        if data_time is None or data_time * 1000000 >= generation:  # 快照比最近一次修改旧时不缓存
+            store.set(key, page)
+    response = make_response(page[2], status)
+    if status == 200:
+        # 强ETag和Last-Modified，条件GET命中时返回304
+        response.set_etag(page[1])
+        response.last_modified = datetime.fromtimestamp(generation // 1000000, timezone.utc)
+        response.make_conditional(request)
+    return response
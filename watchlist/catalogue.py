@@ -0,0 +1,415 @@
+# 电影目录：主页的列表和总数从内存映射的列式文件中读取，不查询SQLite，也不创建ORM对象
+#
+# CATALOGUE打开后，CATALOGUE_DIR中保存两个段文件，所有worker用mmap共享同一份只读数据(零拷贝)：
+#   base   全部电影，按(user_id, id)排序
+#   delta  base生成之后修改过的电影：tombstones是(user_id, id)对，base中这些电影作废；
+#          rows是这些电影现在的数据(已经删除的没有)
+# CURRENT文件记录当前的base和delta，写入新文件后原子替换，读取时按CURRENT的修改时间判断是否需要重新映射。
+#
+# 段文件的格式(本机字节序，每节按8字节对齐)：
+#   头部  magic、行数、用户数、tombstone数、标题缓冲区字节数、非数字年份的JSON字节数
+#   ids(q) owners(q) starts(Q，每个用户的起始行) title_offsets(I) title_lengths(H) years(H)
+#   tombstone_users(q) tombstone_ids(q) 非数字年份({行号: 年份}的JSON) 标题缓冲区(UTF-8，相同的标题只存一份)
+#
+# 网页和API修改电影之后调用catalogue_changed()增量更新：拿到目录中的publish.lock文件锁(多个worker依次进行)，
+# 只查询改动过的电影，和delta中其他的电影一起写成新的delta。这里只读数据库，不拿SQLite的写锁，不阻塞其他写入。
+# delta中的电影超过CATALOGUE_DELTA_SIZE时在后台线程中重新生成base。
+# 命令行的批量写入调用invalidate_catalogue()删除CURRENT，下一次读取时在后台线程中重新生成，生成好之前主页改为查询数据库；
+# 也可以用flask build-catalogue预先生成。
+# 生成base同样不拿写锁(同一时间只有一个，由build.lock保证)：先建PENDING文件，再在一个读事务中扫描整张表，
+# WAL模式下读事务看到的是开始时的快照；扫描期间catalogue_changed()除了更新delta还把改动记到PENDING中，
+# 扫描完成后在publish.lock中重新查询PENDING中的电影作为新的delta，再发布CURRENT。
+# 发布新的段文件后旧的段文件马上删除，读取时如果CURRENT中的文件已经不在了，重新读取CURRENT再映射一次。
+# 内存数据库不使用目录。
+import array
+import bisect
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from heapq import merge
+
+from flask import current_app
+from sqlalchemy.engine import make_url
+
+from watchlist import db
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，只在进程内加锁
+    fcntl = None
+
+MAGIC = b'WLCAT\x00\x01\x00'
+HEADER = struct.Struct('=8sQQQQQ')
+ODD_YEAR = 0xFFFF  # years中的这个值表示年份不是普通的数字，实际的值在JSON中
+CHUNK_SIZE = 500   # 增量更新时每条SQL查询的电影数
+
+#目录中的一部电影，属性与Movie相同，模板和写合并的覆盖层可以直接使用
+CatalogueMovie = namedtuple('CatalogueMovie', 'id title year user_id')
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def write_segment(filename, rows, tombstones=()):
+    """把按(user_id, id)排序的(id, user_id, title, year)写成段文件，先写临时文件再改名"""
+    ids, owners, starts = array.array('q'), array.array('q'), array.array('Q')
+    offsets, lengths, years = array.array('I'), array.array('H'), array.array('H')
+    titles, interned, odd_years = bytearray(), {}, {}
+    for index, (movie_id, user_id, title, year) in enumerate(rows):
+        ids.append(movie_id)
+        if not owners or owners[-1] != user_id:
+            owners.append(user_id)
+            starts.append(index)
+        data = (title or '').encode('utf-8')
+        offset = interned.get(data)
+        if offset is None:
+            offset = interned[data] = len(titles)
+            titles += data
+        offsets.append(offset)
+        lengths.append(len(data))
+        if isinstance(year, str) and year.isdigit() and str(int(year)) == year and int(year) < ODD_YEAR:
+            years.append(int(year))
+        else:
+            years.append(ODD_YEAR)
+            odd_years[index] = year
+    starts.append(len(ids))
+    tombstones = sorted(tombstones)
+    odd = json.dumps(odd_years).encode('utf-8')
+    sections = [ids, owners, starts, offsets, lengths, years,
+                array.array('q', [t[0] for t in tombstones]), array.array('q', [t[1] for t in tombstones]), odd, titles]
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(ids), len(owners), len(tombstones), len(titles), len(odd)))
+        for section in sections:
+            f.write(b'\0' * (_align(f.tell()) - f.tell()))
+            f.write(section if isinstance(section, (bytes, bytearray)) else section.tobytes())
+    os.replace(tmp, filename)
+    return len(ids)
+
+
+#一个段文件，数组都是内存映射上的memoryview，不复制数据
+class Segment(object):
+    def __init__(self, buf):
+        view = memoryview(buf)
+        magic, rows, owners, tombstones, title_size, odd_size = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError('Not a catalogue segment')
+        offset = HEADER.size
+
+        def section(size, fmt=None):
+            nonlocal offset
+            offset = _align(offset)
+            data = view[offset:offset + size * (struct.calcsize(fmt) if fmt else 1)]
+            offset += len(data)
+            return data.cast(fmt) if fmt else data
+
+        self.ids = section(rows, 'q')
+        self.owners = section(owners, 'q')
+        self.starts = section(owners + 1, 'Q')
+        self.offsets = section(rows, 'I')
+        self.lengths = section(rows, 'H')
+        self.years = section(rows, 'H')
+        self.tombstones = list(zip(section(tombstones, 'q'), section(tombstones, 'q')))
+        self.odd_years = dict((int(k), v) for k, v in json.loads(bytes(section(odd_size)).decode('utf-8')).items())
+        self.titles = section(title_size)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def owner_range(self, user_id):
+        """该用户的电影所在的行[lo, hi)"""
+        i = bisect.bisect_left(self.owners, user_id)
+        if i == len(self.owners) or self.owners[i] != user_id:
+            return 0, 0
+        return self.starts[i], self.starts[i + 1]
+
+    def contains(self, user_id, movie_id):
+        lo, hi = self.owner_range(user_id)
+        i = bisect.bisect_left(self.ids, movie_id, lo, hi)
+        return i < hi and self.ids[i] == movie_id
+
+    def movie(self, i, user_id):
+        offset = self.offsets[i]
+        title = bytes(self.titles[offset:offset + self.lengths[i]]).decode('utf-8')
+        year = self.years[i]
+        return CatalogueMovie(self.ids[i], title, self.odd_years[i] if year == ODD_YEAR else str(year), user_id)
+
+    def movies(self, user_id, after=0):
+        """该用户id大于after的电影，按id排序"""
+        lo, hi = self.owner_range(user_id)
+        for i in range(bisect.bisect_right(self.ids, after, lo, hi), hi):
+            yield self.movie(i, user_id)
+
+    def rows(self):
+        """全部电影，格式与write_segment()的rows相同"""
+        for k, user_id in enumerate(self.owners):
+            for i in range(self.starts[k], self.starts[k + 1]):
+                movie = self.movie(i, user_id)
+                yield movie.id, user_id, movie.title, movie.year
+
+
+#base加上delta，读取时合并
+class Catalogue(object):
+    def __init__(self, base, delta):
+        self.base = base
+        self.delta = delta
+        self._dead = {}        # user_id -> base中作废的电影id
+        self._dead_counts = {}
+        for user_id, movie_id in delta.tombstones:
+            self._dead.setdefault(user_id, set()).add(movie_id)
+            if base.contains(user_id, movie_id):
+                self._dead_counts[user_id] = self._dead_counts.get(user_id, 0) + 1
+
+    def count(self, user_id):
+        """该用户的电影总数"""
+        lo, hi = self.base.owner_range(user_id)
+        delta_lo, delta_hi = self.delta.owner_range(user_id)
+        return hi - lo - self._dead_counts.get(user_id, 0) + delta_hi - delta_lo
+
+    def movies(self, user_id, after=0):
+        """该用户id大于after的电影，按id排序"""
+        dead = self._dead.get(user_id, ())
+        base = (m for m in self.base.movies(user_id, after) if m.id not in dead)
+        return merge(base, self.delta.movies(user_id, after), key=lambda m: m.id)
+
+    def page(self, user_id, after, limit):
+        movies = []
+        for movie in self.movies(user_id, after):
+            movies.append(movie)
+            if len(movies) == limit:
+                break
+        return movies
+
+
+#每个worker一个，负责映射当前的段文件和更新目录
+class CatalogueStore(object):
+    def __init__(self, path, database, delta_size):
+        self.path = path
+        self.database = database
+        self.delta_size = delta_size
+        self._current = os.path.join(path, 'CURRENT')
+        self._pending = os.path.join(path, 'PENDING')
+        self._lock = threading.Lock()
+        self._locks = dict(build=threading.Lock(), publish=threading.Lock())
+        self._state = (None, None)  # (CURRENT的修改时间和inode, Catalogue)
+        self._builder = None  # 生成目录的后台线程
+        self.builds = 0
+
+    def get(self):
+        """当前的目录；还没有生成时启动后台线程生成并返回None，调用方改为查询数据库"""
+        stamp = self._stamp()
+        state = self._state
+        if stamp is not None and state[0] == stamp:
+            return state[1]
+        with self._lock:
+            stamp = self._stamp()
+            if stamp is not None and self._state[0] != stamp:
+                try:
+                    catalogue = self._load()
+                except FileNotFoundError:  # 读取CURRENT之后其他worker发布了新的段文件，旧的已经删除
+                    stamp = self._stamp()
+                    catalogue = self._load() if stamp is not None else None
+                if catalogue is not None:
+                    self._state = (stamp, catalogue)
+                else:
+                    stamp = None
+            if stamp is None:
+                self._build_in_background()
+                return None
+            return self._state[1]
+
+    def _build_in_background(self):
+        if self._builder is not None and self._builder.is_alive():
+            return
+        self._builder = threading.Thread(target=self._build_if_needed, name='catalogue-builder', daemon=True)
+        self._builder.start()
+
+    def _build_if_needed(self):
+        with self._locked('build'):
+            if self._needs_build():  # 其他worker可能已经生成好了
+                self._build()
+
+    #还没有生成过，或者delta太大
+    def _needs_build(self):
+        names = self._names()
+        if names is None:
+            return True
+        try:
+            return len(Segment(self._map(names[1])).tombstones) > self.delta_size
+        except FileNotFoundError:  # 刚被替换，新的delta是空的
+            return False
+
+    def changed(self, pairs):
+        """这些(user_id, movie_id)的电影被新建、修改或删除并提交之后调用，增量更新delta"""
+        if not pairs:
+            return
+        with self._locked('publish'):
+            names = self._names()
+            if names is None:  # 还没有生成过，下一次读取时完整生成
+                return
+            delta = Segment(self._map(names[1]))
+            tombstones = set(delta.tombstones) | set(pairs)
+            ids = set(movie_id for user_id, movie_id in pairs)
+            rows = [row for row in delta.rows() if row[0] not in ids]
+            with snapshot(self.database) as conn:
+                rows.extend(self._query(conn, ids))
+            rows.sort(key=lambda row: (row[1], row[0]))
+            self._publish(names[0], self._new_name('delta'), rows, tombstones)
+            if os.path.exists(self._pending):  # 正在生成base，扫描完成后重新查询这些电影
+                with open(self._pending, 'a') as f:
+                    f.writelines('%d %d\n' % pair for pair in pairs)
+        if len(tombstones) > self.delta_size:
+            self._build_in_background()
+
+    def rebuild(self):
+        """从数据库完整生成base，返回电影数"""
+        with self._locked('build'):
+            return self._build()
+
+    #调用方持有build锁
+    def _build(self):
+        with self._locked('publish'):
+            open(self._pending, 'w').close()
+        base = self._new_name('base')
+        with snapshot(self.database) as conn:
+            rows = conn.execute('SELECT id, user_id, title, year FROM movie WHERE user_id IS NOT NULL '
+                                'ORDER BY user_id, id')
+            count = write_segment(os.path.join(self.path, base), rows)
+        with self._locked('publish'):
+            with open(self._pending) as f:
+                pairs = set(tuple(int(n) for n in line.split()) for line in f if line.strip())
+            with snapshot(self.database) as conn:
+                rows = sorted(self._query(conn, set(movie_id for user_id, movie_id in pairs)),
+                              key=lambda row: (row[1], row[0]))
+            self._publish(base, self._new_name('delta'), rows, pairs)
+            os.remove(self._pending)
+        self.builds += 1
+        return count
+
+    def _query(self, conn, ids):
+        ids = sorted(ids)
+        rows = []
+        for i in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[i:i + CHUNK_SIZE]
+            rows.extend(conn.execute('SELECT id, user_id, title, year FROM movie WHERE id IN (%s) '
+                                     'AND user_id IS NOT NULL' % ','.join('?' * len(chunk)), chunk))
+        return rows
+
+    #目录中的文件锁，多个worker(以及同一个worker的多个线程)依次进行
+    @contextmanager
+    def _locked(self, name):
+        with self._locks[name], open(os.path.join(self.path, name + '.lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)  # 关闭文件时释放
+            yield
+
+    def _publish(self, base, delta, rows, tombstones):
+        old = self._names()
+        write_segment(os.path.join(self.path, delta), rows, tombstones)
+        tmp = '%s.%d.tmp' % (self._current, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('%s %s\n' % (base, delta))
+        os.replace(tmp, self._current)
+        for name in old or ():
+            if name not in (base, delta):
+                try:
+                    os.remove(os.path.join(self.path, name))  # 其他worker已经映射的文件仍然可以读取
+                except OSError:
+                    pass
+
+    def _names(self):
+        try:
+            with open(self._current) as f:
+                return f.read().split()
+        except IOError:
+            return None
+
+    def _new_name(self, kind):
+        return '%s-%s.seg' % (kind, uuid.uuid4().hex)
+
+    def _stamp(self):
+        try:
+            st = os.stat(self._current)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_ino, st.st_size
+
+    def _load(self):
+        names = self._names()
+        if names is None:
+            return None
+        base, delta = names
+        return Catalogue(Segment(self._map(base)), Segment(self._map(delta)))
+
+    def _map(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+#只读的事务，WAL模式下整个事务读到的是同一个快照，不阻塞写入
+@contextmanager
+def snapshot(database):
+    conn = sqlite3.connect(database, timeout=30, isolation_level=None)
+    try:
+        conn.execute('BEGIN')
+        try:
+            yield conn
+        finally:
+            conn.execute('ROLLBACK')  # 只读取，不修改数据库
+    finally:
+        conn.close()
+
+
+def _database_file(config):
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.drivername != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return os.path.abspath(url.database)
+
+
+def get_catalogue_store():
+    """CATALOGUE打开并且使用数据库文件时返回CatalogueStore，否则返回None"""
+    if 'catalogue' not in current_app.extensions:
+        config = current_app.config
+        database = _database_file(config) if config['CATALOGUE'] else None
+        store = None
+        if database is not None:
+            os.makedirs(config['CATALOGUE_DIR'], exist_ok=True)
+            store = CatalogueStore(config['CATALOGUE_DIR'], database, config['CATALOGUE_DELTA_SIZE'])
+        current_app.extensions['catalogue'] = store
+    return current_app.extensions['catalogue']
+
+
+def get_catalogue():
+    store = get_catalogue_store()
+    return store.get() if store is not None else None
+
+
+def catalogue_changed(user_id, *movie_ids):
+    """修改电影并提交之后调用"""
+    changed_movies([(user_id, movie_id) for movie_id in movie_ids])
+
+
+def changed_movies(pairs):
+    store = get_catalogue_store()
+    if store is not None:
+        # 提交之后读取movie.id等属性会重新开始事务，写请求中这个事务拿着写锁，先结束它
+        db.session.commit()
+        store.changed(pairs)
+    else:
+        invalidate_catalogue()  # 关闭时留下的旧目录不能在重新打开后使用
+
+
+def invalidate_catalogue():
+    """批量修改电影之后调用，下一次读取时重新生成"""
+    try:
+        os.remove(os.path.join(current_app.config['CATALOGUE_DIR'], 'CURRENT'))
+    except OSError:
+        pass
@@ -1,61 +1,513 @@
 # 命令函数
+import csv
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from itertools import islice
+
 import click
-from watchlist import db,app
-from watchlist.models import User,Movie
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from flask import current_app
+from flask.cli import with_appcontext
+
+from watchlist import db, migrations
+from watchlist.assets import build_assets
+from watchlist.models import User,Movie,valid_movie
+from watchlist.cache import user_cache, invalidate_pages
+from watchlist.catalogue import get_catalogue_store, invalidate_catalogue
+from watchlist.stats import rebuild_stats
+from watchlist.jobs import Worker, enqueue
+from watchlist.sessions import revoke_sessions
 
 #编写自定义命令完成自动执行数据库表操作
-@app.cli.command()  #注册为命令
+@click.command()  #注册为命令，见register_commands
+@with_appcontext
 @click.option('--drop',is_flag=True,help='Create after drop.')  #设置选择项
-def initdb(drop):
+@click.option('--background', is_flag=True, help='Queue it for flask worker.')
+def initdb(drop, background):
     """Initialize the db"""
+    if background:
+        return run_in_background('initdb', drop=drop)
+    init_database(drop)
+    click.echo("Initialized db") #输出提示信息
+
+
+def init_database(drop=False):
     if drop:
         db.drop_all()
     db.create_all()
-    click.echo("Initialized db") #输出提示信息
+    user_cache.invalidate()
+    invalidate_catalogue()
+    invalidate_pages()
+
+
+#放进后台任务队列，由flask worker执行，说明见watchlist/jobs.py
+def run_in_background(name, max_attempts=None, **args):
+    db.create_all()
+    try:
+        job_id = enqueue(name, max_attempts=max_attempts, **args)
+    except OperationalError:
+        db.session.rollback()
+        raise click.ClickException('No job table yet, run flask db upgrade first')
+    click.echo("Queued job %d, run flask worker to process it" % job_id)
 
 
 #自定义命令行生成管理员账号
-@app.cli.command()
+@click.command()
+@with_appcontext
 @click.option('--username',prompt=True,help='The username used to login')     #prompt?
 @click.option('--passwd',prompt=True ,hide_input=True ,confirmation_prompt=True,help='The passwd used to login')
 def admin(username,passwd):
     """Generate the admin account"""
     db.create_all()
-    user = User.query.first()
+    user = User.query.filter_by(username=username).first()  # 用户名已经存在时只修改密码
     if user is not None:
         click.echo("Update the admin account")
-        user.username = username
         user.set_passwd(passwd)
+        revoke_sessions(user.id)  # 用旧密码登录的会话作废，token模式下由版本戳判断
     else:
         click.echo("Create the admin account")
         user = User(username=username,name='Admin')
         user.set_passwd(passwd)
         db.session.add(user)
     db.session.commit()
+    user_cache.invalidate()
+    invalidate_pages()
     click.echo('Done')
 
+#虚拟数据
+FORGE_NAME = "Garfield Zhan"
+FORGE_MOVIES = [
+    {'title': 'My Neighbor Totoro', 'year': '1988'},
+    {'title': 'Dead Poets Society', 'year': '1989'},
+    {'title': 'A Perfect World', 'year': '1993'},
+    {'title': 'Leon', 'year': '1994'},
+    {'title': 'Mahjong', 'year': '1996'},
+    {'title': 'Swallowtail Butterfly', 'year': '1996'},
+    {'title': 'King of Comedy', 'year': '1999'},
+    {'title': 'Devils on the Doorstep', 'year': '1999'},
+    {'title': 'WALL-E', 'year': '2008'},
+    {'title': 'The Pork of Music', 'year': '2012'},
+]
+
+
+#生成count条虚拟电影，超过FORGE_MOVIES的部分在标题后加编号
+def fake_movies(count):
+    for i in range(count):
+        movie = FORGE_MOVIES[i % len(FORGE_MOVIES)]
+        if i < len(FORGE_MOVIES):
+            yield movie
+        else:
+            yield {'title': '%s #%d' % (movie['title'], i // len(FORGE_MOVIES)), 'year': movie['year']}
+
+
 #自定义 生成虚拟数据并存入数据库 的命令
-@app.cli.command()
-def forge():
+@click.command()
+@with_appcontext
+@click.option('--count', default=len(FORGE_MOVIES), show_default=True, help='Number of movies to generate.')
+@click.option('--background', is_flag=True, help='Queue it for flask worker.')
+def forge(count, background):
     """Generate fake data"""
+    if background:
+        return run_in_background('forge', max_attempts=1, count=count)  # 重试会再生成一个用户
+    forge_data(count)
+    click.echo("Done")
+
+
+def forge_data(count, progress=None):
     db.create_all()
-    name = "Garfield Zhan"
-    movies = [
-        {'title': 'My Neighbor Totoro', 'year': '1988'},
-        {'title': 'Dead Poets Society', 'year': '1989'},
-        {'title': 'A Perfect World', 'year': '1993'},
-        {'title': 'Leon', 'year': '1994'},
-        {'title': 'Mahjong', 'year': '1996'},
-        {'title': 'Swallowtail Butterfly', 'year': '1996'},
-        {'title': 'King of Comedy', 'year': '1999'},
-        {'title': 'Devils on the Doorstep', 'year': '1999'},
-        {'title': 'WALL-E', 'year': '2008'},
-        {'title': 'The Pork of Music', 'year': '2012'},
-    ]
-    user = User(name=name)
+    user = User(name=FORGE_NAME)
     db.session.add(user)
-    for m in movies:
-        movie = Movie(title=m['title'],year=m['year'])
-        db.session.add(movie)
     db.session.commit()
-    click.echo("Done")
\ No newline at end of file
+    total = insert_movies(owned_by(fake_movies(count), user.id), progress=progress)
+    user_cache.invalidate()
+    invalidate_pages()
+    return total
+
+
+#给电影字典加上所属用户
+def owned_by(movies, user_id):
+    for movie in movies:
+        yield dict(movie, user_id=user_id)
+
+
+#按用户名查找用户，不传用户名时返回第一个用户，找不到时命令报错退出
+def find_user(username=None):
+    if username:
+        user = User.query.filter_by(username=username).first()
+    else:
+        user = User.query.order_by(User.id).first()
+    if user is None:
+        raise click.ClickException('User %s not found' % username if username else 'No user yet, run flask admin first')
+    return user
+
+
+#把可迭代对象按chunk_size切分成列表，每次只在内存中保留一块
+def chunked(rows, chunk_size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+#批量写入电影，每块使用一次executemany和一个事务，返回写入的条数
+def insert_movies(movies, chunk_size=5000, progress=None):
+    total = 0
+    insert = Movie.__table__.insert()
+    for chunk in chunked(movies, chunk_size):
+        db.session.execute(insert, chunk)
+        db.session.commit()
+        total += len(chunk)
+        if progress is not None:
+            progress(total)
+    invalidate_catalogue()
+    invalidate_pages()
+    return total
+
+
+#逐行读取CSV/JSONL，生成电影字典；格式不对或数据不合法的行跳过，每跳过一行调用一次skip()
+def read_movies(f, fmt, skip=None):
+    rows = csv.DictReader(f) if fmt == 'csv' else (json_row(line) for line in f if line.strip())
+    for row in rows:
+        movie = movie_fields(row)
+        if movie is not None:
+            yield movie
+        elif skip is not None:
+            skip()
+
+
+#解析JSONL的一行，不是合法的JSON时返回None
+def json_row(line):
+    try:
+        return json.loads(line)
+    except ValueError:  # JSONDecodeError是ValueError的子类
+        return None
+
+
+#从一行数据中取出合法的标题和年份，JSON中的数字转换为字符串；不是对象的行、值为列表或对象、数据不合法时返回None
+def movie_fields(row):
+    if not isinstance(row, dict):
+        return None
+    values = []
+    for key in ('title', 'year'):
+        value = row.get(key)
+        if isinstance(value, (list, dict)):
+            return None
+        values.append(str(value).strip() if value is not None else '')
+    title, year = values
+    return {'title': title, 'year': year} if valid_movie(title, year) else None
+
+
+#逐行写出CSV/JSONL，返回写出的条数
+def write_movies(f, rows, fmt, progress=None, every=5000):
+    if fmt == 'csv':
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(('id', 'title', 'year'))
+        write = writer.writerow
+    else:
+        def write(row):
+            f.write(json.dumps({'id': row[0], 'title': row[1], 'year': row[2]}, ensure_ascii=False) + '\n')
+    total = 0
+    for row in rows:
+        write(row)
+        total += 1
+        if progress is not None and total % every == 0:
+            progress(total)
+    return total
+
+
+def guess_format(f, fmt):
+    if fmt is None:
+        fmt = 'jsonl' if f.name.endswith(('.jsonl', '.json')) else 'csv'
+    return fmt
+
+
+#进度和吞吐量输出到stderr，不会混进导出的数据
+class Progress(object):
+    def __init__(self, action):
+        self.action = action
+        self.start = time.time()
+        self.skipped = 0
+
+    def skip(self):
+        self.skipped += 1
+
+    def __call__(self, total):
+        elapsed = max(time.time() - self.start, 1e-6)
+        skipped = ", %d skipped" % self.skipped if self.skipped else ""
+        click.echo("\r%s %d movies (%.0f rows/s%s)" % (self.action, total, total / elapsed, skipped), err=True, nl=False)
+
+    def done(self, total):
+        self(total)
+        click.echo(err=True)
+
+
+#从CSV/JSONL批量导入电影
+@click.command('import-movies')
+@with_appcontext
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='File format, guessed from the file name by default.')
+@click.option('--chunk-size', default=5000, show_default=True, help='Rows inserted per transaction.')
+@click.option('--username', help='Owner of the imported movies, defaults to the first user.')
+def import_movies(source, fmt, chunk_size, username):
+    """Import movies from a CSV or JSONL file"""
+    db.create_all()
+    user = find_user(username)
+    progress = Progress('Imported')
+    total = insert_movies(owned_by(read_movies(source, guess_format(source, fmt), progress.skip), user.id), chunk_size, progress)
+    progress.done(total)
+    click.echo("Done")
+
+
+#把电影导出为CSV/JSONL，使用yield_per分批读取
+@click.command('export-movies')
+@with_appcontext
+@click.argument('target', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='File format, guessed from the file name by default.')
+@click.option('--chunk-size', default=5000, show_default=True, help='Rows fetched per round trip.')
+@click.option('--username', help='Only export the movies of this user.')
+def export_movies(target, fmt, chunk_size, username):
+    """Export movies to a CSV or JSONL file"""
+    query = db.session.query(Movie.id, Movie.title, Movie.year)
+    if username:
+        query = query.filter(Movie.user_id == find_user(username).id)
+    rows = query.order_by(Movie.id).yield_per(chunk_size)
+    progress = Progress('Exported')
+    total = write_movies(target, rows, guess_format(target, fmt), progress, chunk_size)
+    progress.done(total)
+
+
+#按movie表重新生成全文搜索索引，用于修复索引；建立索引由flask db upgrade完成(迁移1)
+@click.command('reindex-search')
+@with_appcontext
+def reindex_search():
+    """Rebuild the movie full-text search index"""
+    if db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'movie_fts'")).scalar() is None:
+        raise click.ClickException('No search index yet, run flask db upgrade first')
+    db.session.execute(text("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    click.echo("Done")
+
+
+#数据库结构的版本管理，说明见watchlist/migrations.py
+@click.group('db')
+def db_group():
+    """Upgrade the database schema"""
+
+
+@db_group.command('status')
+@with_appcontext
+def db_status():
+    """Show the schema version and pending migrations"""
+    with migrations.connect(db.engine) as m:
+        click.echo("Version %d, latest %d" % (m.version, migrations.head()))
+        for version, upgrade in m.pending():
+            click.echo("  pending %d: %s" % (version, upgrade.__doc__))
+
+
+@db_group.command('upgrade')
+@with_appcontext
+@click.option('--to', 'target', type=int, help='Stop at this version, defaults to the latest.')
+@click.option('--owner', help='Username that owns movies without an owner, defaults to the first user.')
+@click.option('--batch-size', type=int, help='Rows per transaction, defaults to MIGRATION_BATCH_SIZE.')
+@click.option('--rows-per-second', type=int, help='Throttle for backfills and copies, 0 for no limit.')
+def db_upgrade(target, owner, batch_size, rows_per_second):
+    """Apply pending migrations, resuming an interrupted one"""
+    config = current_app.config
+    db.session.remove()  # 迁移使用自己的事务，先归还会话占用的连接
+    if batch_size is None:
+        batch_size = config['MIGRATION_BATCH_SIZE']
+    if rows_per_second is None:
+        rows_per_second = config['MIGRATION_ROWS_PER_SECOND']
+
+    progress_line = []  # 进度输出在stderr的同一行，输出其他信息之前先换行
+
+    def progress(name, total):
+        click.echo("\r%s: %d rows" % (name, total), err=True, nl=False)
+        progress_line[:] = [True]
+
+    def echo(message=None):
+        if progress_line:
+            click.echo(err=True)
+            del progress_line[:]
+        if message is not None:
+            click.echo(message)
+
+    with migrations.connect(db.engine, batch_size=batch_size, rows_per_second=rows_per_second,
+                            options=dict(owner=owner), echo=echo, progress=progress) as m:
+        try:
+            done = m.upgrade(target)
+        except migrations.MigrationError as e:
+            echo()
+            raise click.ClickException(str(e))
+        version = m.version
+    echo()
+    user_cache.invalidate()
+    invalidate_catalogue()  # 迁移可能修改了电影的数据
+    invalidate_pages()
+    click.echo("Upgraded to version %d" % version if done else "Already at version %d" % version)
+
+
+#预先编译模板，TEMPLATES_MODE为compiled或bytecode时worker直接加载编译结果，说明见watchlist/jinja.py
+@click.command('compile-templates')
+@click.option('--mode', type=click.Choice(['compiled', 'bytecode']),
+              help='Defaults to TEMPLATES_MODE, or compiled when it is source.')
+@with_appcontext
+def compile_templates(mode):
+    """Precompile the templates"""
+    config = current_app.config
+    if mode is None:
+        mode = 'bytecode' if config['TEMPLATES_MODE'] == 'bytecode' else 'compiled'
+    # 始终从源文件编译，不使用已经编译过的结果
+    env = current_app.jinja_env.overlay(loader=current_app.create_global_jinja_loader(), cache_size=0)
+    names = env.list_templates(extensions=['html'])
+    if mode == 'compiled':
+        target = config['TEMPLATES_COMPILED_DIR']
+        if os.path.isdir(target):  # 删除已经不存在的模板留下的模块
+            for name in os.listdir(target):
+                if name.startswith('tmpl_') and name.endswith('.py'):
+                    os.remove(os.path.join(target, name))
+        env.compile_templates(target, extensions=['html'], zip=None, ignore_errors=False)
+    else:
+        target = config['TEMPLATES_CACHE_DIR']
+        os.makedirs(target, exist_ok=True)
+        env.bytecode_cache = FileSystemBytecodeCache(target)
+        for name in names:
+            env.get_template(name)
+    click.echo("Compiled %d templates into %s" % (len(names), target))
+
+
+#构建带内容哈希的静态文件，说明见watchlist/assets.py
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Fingerprint and precompress the static files"""
+    manifest = build_assets(current_app.static_folder, current_app.config['ASSETS_DIR'])
+    invalidate_pages()  # 缓存的页面中还是原来的静态文件URL
+    compressed = sum(1 for entry in manifest.values() if entry['encodings'])
+    click.echo("Built %d assets (%d precompressed) into %s" % (len(manifest), compressed, current_app.config['ASSETS_DIR']))
+    click.echo("Restart the workers to serve them")
+
+
+#分批重新计算统计表，说明见watchlist/stats.py
+@click.command('rebuild-stats')
+@with_appcontext
+@click.option('--batch-size', type=int, help='Movies per transaction, defaults to MIGRATION_BATCH_SIZE.')
+@click.option('--rows-per-second', type=int, help='Throttle, 0 for no limit.')
+@click.option('--background', is_flag=True, help='Queue it for flask worker.')
+def rebuild_stats_command(batch_size, rows_per_second, background):
+    """Recompute the movie statistics"""
+    if background:
+        return run_in_background('rebuild-stats', batch_size=batch_size, rows_per_second=rows_per_second)
+
+    def progress(name, total):
+        click.echo("\r%s: %d rows" % (name, total), err=True, nl=False)
+
+    total = recompute_stats(batch_size, rows_per_second, progress)
+    click.echo(err=True)
+    click.echo("Counted %d movies" % total)
+
+
+def recompute_stats(batch_size=None, rows_per_second=None, progress=None):
+    config = current_app.config
+    db.session.remove()
+    if batch_size is None:
+        batch_size = config['MIGRATION_BATCH_SIZE']
+    if rows_per_second is None:
+        rows_per_second = config['MIGRATION_ROWS_PER_SECOND']
+    with migrations.connect(db.engine, batch_size=batch_size, rows_per_second=rows_per_second, progress=progress) as m:
+        total = rebuild_stats(m)
+    invalidate_pages()
+    return total
+
+
+#让一个用户在所有地方退出登录，需要服务端会话(SESSION_BACKEND=sqlite)
+@click.command('revoke-sessions')
+@with_appcontext
+@click.argument('username')
+def revoke_sessions_command(username):
+    """Log a user out everywhere"""
+    if current_app.config['SESSION_BACKEND'] != 'sqlite':
+        raise click.ClickException('Sessions can only be revoked from the command line with SESSION_BACKEND=sqlite')
+    click.echo("Revoked %d sessions" % revoke_sessions(find_user(username).id))
+
+
+#预先生成主页使用的电影目录，说明见watchlist/catalogue.py
+@click.command('build-catalogue')
+@with_appcontext
+@click.option('--background', is_flag=True, help='Queue it for flask worker.')
+def build_catalogue(background):
+    """Build the movie catalogue read by the index page"""
+    if background:
+        return run_in_background('build-catalogue')
+    store = get_catalogue_store()
+    if store is None:
+        raise click.ClickException('The catalogue needs CATALOGUE=1 and a database file')
+    count = store.rebuild()
+    click.echo("Built catalogue of %d movies into %s" % (count, store.path))
+
+
+#执行后台任务，说明见watchlist/jobs.py
+@click.command('worker')
+@with_appcontext
+@click.option('--threads', type=int, help='Jobs run at the same time, defaults to JOB_THREADS.')
+@click.option('--burst', is_flag=True, help='Exit once no job is due.')
+def worker(threads, burst):
+    """Run queued background jobs"""
+    db.session.remove()  # 每个线程使用自己的会话
+    runner = Worker(current_app._get_current_object(), threads)
+    signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())  # 和Ctrl-C一样，做完手上的任务再退出
+    click.echo("Worker %s running %d threads" % (runner.name, runner.threads))
+    runner.run(burst)
+    click.echo("Finished %d jobs, %d failed" % (runner.done, runner.failed))
+
+
+#测量冷启动耗时的脚本，在新的Python进程中运行
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from watchlist import create_app, db
+imported = time.perf_counter()
+app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:', 'PROFILE_ENABLED': False})
+created = time.perf_counter()
+with app.app_context():
+    db.create_all()
+client = app.test_client()
+ready = time.perf_counter()
+client.get('/login')
+first = time.perf_counter()
+client.get('/login')
+second = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'first_request': first - ready, 'second_request': second - first}))
+"""
+
+
+#测量导入、创建程序实例和第一个请求(导入视图、编译模板)的耗时
+@click.command('startup-time')
+@click.option('--repeat', default=5, show_default=True, help='Number of fresh processes to measure.')
+def startup_time(repeat):
+    """Measure cold start time"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], cwd=root)
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    for phase in ('import', 'create_app', 'first_request', 'second_request'):
+        values = sorted(run[phase] for run in runs)
+        click.echo("%-15s median %8.2fms  min %8.2fms" % (phase, values[len(values) // 2] * 1000, values[0] * 1000))
+
+
+def register_commands(app):
+    for command in (initdb, admin, forge, import_movies, export_movies, db_group, reindex_search,
+                    compile_templates, build_assets_command, build_catalogue,
+                    rebuild_stats_command, revoke_sessions_command, worker, startup_time):
+        app.cli.add_command(command)
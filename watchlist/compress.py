@@ -0,0 +1,229 @@
+# 响应压缩，WSGI中间件，在create_app()中包在app.wsgi_app外面
+#
+# 按COMPRESS_ALGORITHMS的顺序选择客户端(Accept-Encoding)支持的压缩方式，
+# br和zstd分别需要安装brotli和zstandard，没有安装的会被跳过。
+# 只压缩COMPRESS_MIMETYPES中的类型，小于COMPRESS_MIN_SIZE字节的响应不压缩，已经压缩过的响应(预压缩的静态文件)不处理。
+# 有Content-Length的响应本来就在内存中，一次压缩完并重新计算Content-Length；
+# 流式响应(比如?stream=1的主页)边生成边压缩，每积累COMPRESS_FLUSH_SIZE字节的输入flush一次，
+# 浏览器不用等整个页面生成完就能解压显示，中间件也不会缓存整个响应。
+# 压缩后的ETag加上"-gzip"这样的后缀，请求的If-None-Match中的后缀在交给程序之前去掉，条件GET依然可以返回304。
+# COMPRESS_MIMETYPES中的类型即使这次没有压缩(太小、客户端不支持)也加上Vary: Accept-Encoding，
+# 代理不会把未压缩的版本缓存给支持压缩的客户端，反过来也一样。
+# 生成器形式的WSGI程序在第一次迭代时才调用start_response，这时先取出第一块数据再处理响应头。
+import itertools
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator
+
+try:
+    import brotli
+except ImportError:  # 可选依赖
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖
+    zstandard = None
+
+BUFFER_LIMIT = 1024 * 1024  # 超过这个大小的响应即使有Content-Length也按流式压缩
+
+
+class GzipCompressor(object):
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor(object):
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdCompressor(object):
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+#Content-Encoding对应的压缩类和压缩级别的配置项
+COMPRESSORS = {'gzip': (GzipCompressor, 'COMPRESS_LEVEL_GZIP')}
+if brotli is not None:
+    COMPRESSORS['br'] = (BrotliCompressor, 'COMPRESS_LEVEL_BR')
+if zstandard is not None:
+    COMPRESSORS['zstd'] = (ZstdCompressor, 'COMPRESS_LEVEL_ZSTD')
+
+
+class CompressMiddleware(object):
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        encoding = self._negotiate(environ)
+        suffix = '-%s"' % encoding
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if encoding is not None and if_none_match and suffix in if_none_match:
+            environ['HTTP_IF_NONE_MATCH'] = if_none_match.replace(suffix, '"')
+
+        response = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]
+
+        result = _start(self.wsgi_app(environ, capture), response)
+        status, headers, exc_info = response
+        code = int(status.split(' ', 1)[0])
+        if encoding is not None and code == 304 and if_none_match and suffix in if_none_match:
+            headers = self._compressed_headers(headers, encoding)
+            headers.remove('Content-Encoding')  # 304没有响应体，只需要把ETag对应到压缩后的版本
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return result
+        if encoding is None or not self._compressible(environ, code, headers):
+            start_response(status, self._vary(headers), exc_info)
+            return result  # 原样返回，保留send_file的wsgi.file_wrapper
+
+        compressed = self._compressed_headers(headers, encoding)
+        compressor_class, level_key = COMPRESSORS[encoding]
+        compressor = compressor_class(self.config[level_key])
+        length = compressed.get('Content-Length', type=int)
+        compressed.remove('Content-Length')
+        if length is not None and length <= BUFFER_LIMIT:
+            try:
+                data = compressor.compress(b''.join(result)) + compressor.finish()
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            compressed['Content-Length'] = str(len(data))
+            start_response(status, compressed.to_wsgi_list(), exc_info)
+            return [data]
+        return self._stream(result, compressor, start_response, status, headers, compressed.to_wsgi_list(), exc_info)
+
+    def _negotiate(self, environ):
+        accept = environ.get('HTTP_ACCEPT_ENCODING')
+        if not accept:
+            return None
+        accept = parse_accept_header(accept)
+        for encoding in self.config['COMPRESS_ALGORITHMS']:
+            if encoding in COMPRESSORS and accept.quality(encoding) > 0:
+                return encoding
+        return None
+
+    def _compressible(self, environ, code, headers):
+        if environ['REQUEST_METHOD'] == 'HEAD' or code < 200 or code in (204, 206, 304):
+            return False
+        headers = Headers(headers)
+        if 'Content-Encoding' in headers or 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        if self._mimetype(headers) not in self.config['COMPRESS_MIMETYPES']:
+            return False
+        length = headers.get('Content-Length', type=int)
+        return length is None or length >= self.config['COMPRESS_MIN_SIZE']
+
+    def _mimetype(self, headers):
+        return headers.get('Content-Type', '').split(';', 1)[0].strip()
+
+    #没有压缩的响应：可以压缩的类型也加上Vary
+    def _vary(self, headers):
+        headers = Headers(headers)
+        if self._mimetype(headers) in self.config['COMPRESS_MIMETYPES'] and 'Content-Encoding' not in headers:
+            _add_vary(headers)
+        return headers.to_wsgi_list()
+
+    def _compressed_headers(self, headers, encoding):
+        headers = Headers(headers)
+        headers['Content-Encoding'] = encoding
+        _add_vary(headers)
+        etag = headers.get('ETag')
+        if etag and etag.endswith('"'):
+            headers['ETag'] = etag[:-1] + '-%s"' % encoding
+        return headers
+
+    def _stream(self, result, compressor, start_response, status, headers, compressed, exc_info):
+        min_size = self.config['COMPRESS_MIN_SIZE']
+        flush_size = self.config['COMPRESS_FLUSH_SIZE']
+        try:
+            # 先读够min_size字节再决定是否压缩
+            iterator = iter(result)
+            head, size = [], 0
+            for chunk in iterator:
+                head.append(chunk)
+                size += len(chunk)
+                if size >= min_size:
+                    break
+            else:
+                start_response(status, self._vary(headers), exc_info)
+                yield b''.join(head)
+                return
+            start_response(status, compressed, exc_info)
+            yield compressor.compress(b''.join(head)) + compressor.flush()  # 尽快发出第一块
+            pending = 0
+            for chunk in iterator:
+                data = compressor.compress(chunk)
+                pending += len(chunk)
+                if pending >= flush_size:
+                    data += compressor.flush()
+                    pending = 0
+                if data:
+                    yield data
+            yield compressor.finish()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+def _add_vary(headers):
+    vary = headers.get('Vary')
+    if not vary:
+        headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        headers['Vary'] = vary + ', Accept-Encoding'
+
+
+#Flask(werkzeug的Response)在返回之前就已经调用了start_response；生成器形式的程序在第一次迭代时才调用，
+#这时先取出数据直到调用了start_response，再把取出的数据放回响应体的开头，close()仍然调用原来的result.close()
+def _start(result, response):
+    if response:
+        return result
+    iterator = iter(result)
+    head = []
+    try:
+        for chunk in iterator:
+            head.append(chunk)
+            if response:
+                break
+    except BaseException:
+        if hasattr(result, 'close'):
+            result.close()
+        raise
+    return ClosingIterator(itertools.chain(head, iterator), getattr(result, 'close', None))
+
+
+def init_compression(app):
+    app.wsgi_app = CompressMiddleware(app.wsgi_app, app.config)
@@ -0,0 +1,98 @@
+# 数据库引擎设置，针对SQLite文件数据库做调优
+#
+# 读写并发模式(SQLITE_WRITE_LOCK)：
+#   immediate  写请求(POST等非GET请求)的事务以BEGIN IMMEDIATE开始，一开始就拿到写锁，
+#              拿不到时按busy_timeout排队等待；GET请求和命令行使用普通的BEGIN。
+#              配合WAL模式，读不阻塞写、写不阻塞读，写与写之间排队，
+#              多线程gunicorn在读写混合负载下不会再出现"database is locked"。
+#              用@read_transaction装饰的视图(比如login，主要是读取并且耗时较长)仍然使用普通的BEGIN，
+#              避免在整个请求期间占住写锁。请求之外需要写锁的代码(比如写合并的写线程)在程序上下文中设置g.write_transaction。
+#   deferred   保持pysqlite默认的事务行为，事务在第一条写语句时才升级为写锁，
+#              两个事务同时升级时其中一个会直接失败。
+#
+# SQLITE_PRAGMAS中的设置在每个连接建立时执行，连接池大小(SQLITE_POOL_SIZE)按每个worker计算，
+# 一般设置为gunicorn的--threads数量。内存数据库不做任何改动。
+from functools import wraps
+
+from flask import g, has_app_context, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.pool import QueuePool
+
+#不会修改数据的请求方法，这些请求的事务不需要提前拿写锁
+READ_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+def read_transaction(view):
+    """标记视图的事务以普通BEGIN开始，即使是POST请求也不提前拿写锁"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_transaction = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            g.pop('read_transaction', None)
+    return wrapper
+
+
+def _needs_write_lock():
+    if has_request_context():
+        return request.method not in READ_METHODS and not g.get('read_transaction')
+    return has_app_context() and g.get('write_transaction', False)
+
+
+def setup_sqlite_engine(engine, pragmas, write_lock='immediate'):
+    """在engine上注册连接事件，设置PRAGMA和事务的加锁方式"""
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        if write_lock == 'immediate':
+            dbapi_connection.isolation_level = None  # 由下面的begin事件自己发出BEGIN
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    if write_lock == 'immediate':
+        @event.listens_for(engine, 'begin')
+        def on_begin(conn):
+            if _needs_write_lock():
+                conn.exec_driver_sql('BEGIN IMMEDIATE')
+            else:
+                conn.exec_driver_sql('BEGIN')
+    return engine
+
+
+#读请求的查询交给读副本，flush和增删改语句总是使用主库，见watchlist/replica.py
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and not isinstance(clause, UpdateBase):
+            from watchlist.replica import read_engine
+            engine = read_engine()
+            if engine is not None:
+                return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+#在Flask-SQLAlchemy创建引擎时加入SQLite的连接池和PRAGMA设置
+class SQLAlchemy(_SQLAlchemy):
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super(SQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite') and sa_url.database not in (None, '', ':memory:'):
+            options['poolclass'] = QueuePool
+            options.setdefault('pool_size', app.config['SQLITE_POOL_SIZE'])
+            options.setdefault('max_overflow', app.config['SQLITE_POOL_OVERFLOW'])
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['check_same_thread'] = False  # 连接会在线程之间复用
+            options['sqlite_setup'] = (dict(app.config['SQLITE_PRAGMAS']), app.config['SQLITE_WRITE_LOCK'])
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        sqlite_setup = engine_opts.pop('sqlite_setup', None)
+        engine = super(SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if sqlite_setup is not None:
+            setup_sqlite_engine(engine, *sqlite_setup)
+        return engine
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -1,17 +1,24 @@
-# 错误处理函数
+# 错误处理函数，在watchlist/urls.py中注册
 from flask import render_template
 
-from watchlist import app
+from watchlist.cache import cached_page
 
-@app.errorhandler(400) #使用errorhandle注册一个错误处理函数
+#400错误处理函数
 def bad_request(e):   #e为异常对象
-    return render_template('errors/400.html'),400   #返回模板和错误码，普通视图默认为200，所以不用写
+    return cached_page(render_template, 'errors/400.html', status=400)   #错误页面同样走页面缓存，返回模板和错误码
 
-@app.errorhandler(404) #使用errorhandle注册一个错误处理函数
+#404错误处理函数
 def page_not_found(e):   #e为异常对象
-    return render_template('errors/404.html'),404   #返回模板和错误码，普通视图默认为200，所以不用写
+    return cached_page(render_template, 'errors/404.html', status=404)   #错误页面同样走页面缓存，返回模板和错误码
 
-@app.errorhandler(500) #使用errorhandle注册一个错误处理函数
+#429错误处理函数，请求过多，告诉客户端多久之后重试
+def too_many_requests(e):
+    response = cached_page(render_template, 'errors/429.html', status=429)
+    if getattr(e, 'retry_after', None) is not None:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+#500错误处理函数
 def internal_server_error(e):   #e为异常对象
-    return render_template('errors/500.html'),500   #返回模板和错误码，普通视图默认为200，所以不用写
+    return cached_page(render_template, 'errors/500.html', status=500)   #错误页面同样走页面缓存，返回模板和错误码
 
@@ -0,0 +1,88 @@
+# 模板的加载方式和片段缓存
+#
+# TEMPLATES_MODE：
+#   source    每个worker第一次用到模板时解析和编译(默认)
+#   bytecode  编译结果保存在TEMPLATES_CACHE_DIR(FileSystemBytecodeCache)，多个worker和重启之后共用，
+#             模板源文件修改后按校验和自动失效
+#   compiled  从flask compile-templates生成的Python模块(TEMPLATES_COMPILED_DIR)加载模板，完全跳过解析和编译；
+#             修改模板或升级Jinja2之后需要重新执行该命令，没有编译过的模板仍然从源文件加载
+# 非debug模式下渲染时不检查模板文件是否被修改，需要时用TEMPLATES_AUTO_RELOAD=1打开。
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import quote_plus
+
+from flask import current_app, request
+from flask_login import current_user
+from jinja2 import ChoiceLoader, FileSystemBytecodeCache, ModuleLoader
+from markupsafe import Markup
+
+from watchlist.urls import cached_url_for
+
+IMDB_SEARCH_URL = 'https://www.imdb.com/find?q='
+
+
+#渲染好的HTML片段，超出容量时淘汰最久未使用的片段
+class FragmentCache(object):
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._fragments = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            html = self._fragments.get(key)
+            if html is not None:
+                self._fragments.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            self._fragments[key] = html
+            while len(self._fragments) > self.max_entries:
+                self._fragments.popitem(last=False)
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+def get_fragment_cache():
+    cache = current_app.extensions.get('fragment_cache')
+    if cache is None:
+        cache = current_app.extensions['fragment_cache'] = FragmentCache(current_app.config['FRAGMENT_CACHE_SIZE'])
+    return cache
+
+
+#主页中的一个电影条目，键包含了影响输出的所有数据，电影被修改后自然会用到新的键，不需要主动失效
+def movie_row(movie):
+    # 只有自己的电影显示编辑和删除按钮，写合并模式下还没提交的新电影没有id，也不显示
+    editable = movie.id is not None and current_user.is_authenticated and movie.user_id == current_user.id
+    key = (editable, request.script_root, movie.id, movie.title, movie.year)
+    cache = get_fragment_cache()
+    html = cache.get(key)
+    if html is None:
+        template = current_app.jinja_env.get_template('movie_row.html')
+        html = Markup(template.render(movie=movie, editable=editable))
+        cache.set(key, html)
+    return html
+
+
+#电影的IMDB搜索链接，标题做URL编码，按标题缓存
+@lru_cache(maxsize=10000)
+def imdb_url(title):
+    return IMDB_SEARCH_URL + quote_plus(title or '')
+
+
+def init_templates(app):
+    config = app.config
+    options = dict(app.jinja_options)
+    if config['TEMPLATES_MODE'] == 'bytecode':
+        os.makedirs(config['TEMPLATES_CACHE_DIR'], exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(config['TEMPLATES_CACHE_DIR'])
+    elif config['TEMPLATES_MODE'] == 'compiled':
+        options['loader'] = ChoiceLoader([ModuleLoader(config['TEMPLATES_COMPILED_DIR']), app.create_global_jinja_loader()])
+    app.jinja_options = options
+    app.add_template_global(movie_row)
+    app.add_template_global(imdb_url)
+    app.add_template_global(cached_url_for, 'url_for')  # 替换Flask的url_for，见watchlist/urls.py
@@ -0,0 +1,255 @@
+# 后台任务：耗时的命令和批量操作放进SQLite中的job表，由flask worker启动的线程池执行，不再占住终端和请求线程
+#
+# 任务函数用@task(名字)注册(见watchlist/tasks.py)，调用方式为f(job, **args)，参数和返回值都要能序列化为JSON。
+# enqueue()只插入一行就返回任务id，执行情况可以从/jobs/<id>查询(见api.job_status)。
+#
+# worker取任务时在一个BEGIN IMMEDIATE事务中把一行queued改为running，多个worker进程不会取到同一个任务。
+# running任务的run_at是租约到期的时间，worker每JOB_LEASE/3秒续约一次，进程被杀掉后租约过期，
+# 任务回到队列由其他worker重新执行，所以任务函数要能重复执行(中途提交过的数据再做一次不会出错)。
+# 任务抛出异常时按JOB_RETRY_DELAY指数退避(加随机抖动)后重试，执行满max_attempts次仍然失败时标记为failed；
+# 抛出JobError表示重试也不会成功(比如参数不合法)，直接标记为failed。
+# job.progress(done, total)报告进度，同时续约，进度用单独的连接写入，要在任务的两个事务之间调用，不能在事务中间调用。
+# 结束超过JOB_KEEP秒的任务由worker的心跳线程删除。
+# 取任务和写结果时数据库出错(比如database is locked)只记录日志，线程按指数退避后继续；
+# 结果没有写进去的任务不再续约，租约过期后由worker重新执行。
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+from flask import current_app, g
+from sqlalchemy import text
+
+from watchlist import db
+
+#任务名 -> 任务函数
+TASKS = {}
+#进度写入数据库的最小间隔秒数
+PROGRESS_INTERVAL = 0.5
+#取任务或写结果出错后等待的秒数，连续出错时加倍，最多JOB_RETRY_MAX_DELAY
+ERROR_DELAY = 1.0
+
+
+class JobError(Exception):
+    """任务失败并且不再重试"""
+
+
+def task(name):
+    def decorator(f):
+        TASKS[name] = f
+        return f
+    return decorator
+
+
+def enqueue(name, user_id=None, delay=0, max_attempts=None, **args):
+    """把任务放进队列，返回任务id"""
+    now = time.time()
+    if max_attempts is None:
+        max_attempts = current_app.config['JOB_MAX_ATTEMPTS']
+    result = db.session.execute(text(
+        'INSERT INTO job (name, args, user_id, max_attempts, run_at, created_at) '
+        'VALUES (:name, :args, :user_id, :max_attempts, :run_at, :now)'),
+        dict(name=name, args=json.dumps(args), user_id=user_id, max_attempts=max_attempts, run_at=now + delay, now=now))
+    db.session.commit()
+    return result.lastrowid
+
+
+def get_job(job_id):
+    """任务的状态，字段见job_dict()，不存在时返回None"""
+    row = db.session.execute(text('SELECT * FROM job WHERE id = :id'), dict(id=job_id)).fetchone()
+    return job_dict(row) if row is not None else None
+
+
+def job_dict(row):
+    data = dict(id=row.id, name=row.name, state=row.state, user_id=row.user_id, attempts=row.attempts,
+                max_attempts=row.max_attempts, progress=dict(done=row.done, total=row.total),
+                result=json.loads(row.result) if row.result is not None else None, error=row.error,
+                created_at=row.created_at, started_at=row.started_at, finished_at=row.finished_at)
+    if row.state == 'queued':
+        data['run_at'] = row.run_at
+    return data
+
+
+#传给任务函数的第一个参数
+class Job(object):
+    def __init__(self, worker, id, name, user_id, attempts, max_attempts):
+        self.worker = worker
+        self.id = id
+        self.name = name
+        self.user_id = user_id  # 放进队列的用户，命令行放进队列时为None
+        self.attempts = attempts  # 包括这一次
+        self.max_attempts = max_attempts
+        self._reported = 0
+
+    def progress(self, done, total=None):
+        now = time.time()
+        if now - self._reported < PROGRESS_INTERVAL and (total is None or done < total):
+            return
+        self._reported = now
+        # 用单独的连接写入，不会提交任务在会话中还没有提交的修改
+        with db.engine.begin() as connection:
+            connection.execute(text('UPDATE job SET done = :done, total = coalesce(:total, total), run_at = :run_at '
+                                    'WHERE id = :id AND worker = :worker'),
+                               dict(done=done, total=total, run_at=now + self.worker.lease, id=self.id,
+                                    worker=self.worker.name))
+
+
+class Worker(object):
+    def __init__(self, app, threads=None, poll_interval=None, name=None):
+        config = app.config
+        self.app = app
+        self.threads = threads or config['JOB_THREADS']
+        self.poll_interval = config['JOB_POLL_INTERVAL'] if poll_interval is None else poll_interval
+        self.lease = config['JOB_LEASE']
+        self.retry_delay = config['JOB_RETRY_DELAY']
+        self.retry_max_delay = config['JOB_RETRY_MAX_DELAY']
+        self.keep = config['JOB_KEEP']
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self._stop = threading.Event()
+        self._running = set()  # 本进程正在执行的任务id，心跳只给这些任务续约
+        self._running_lock = threading.Lock()
+        self.done = 0
+        self.failed = 0
+        self.errors = 0
+
+    def run(self, burst=False):
+        """启动线程池执行任务，直到stop()；burst为True时队列中没有可以执行的任务后退出"""
+        from watchlist import tasks  # noqa: F401 注册任务函数
+        stop = self._stop = threading.Event()
+        workers = [threading.Thread(target=self._loop, args=(stop, burst), name='job-worker-%d' % n)
+                   for n in range(self.threads)]
+        heartbeat = threading.Thread(target=self._heartbeat, args=(stop,), name='job-heartbeat', daemon=True)
+        for thread in workers:
+            thread.start()
+        heartbeat.start()
+        try:
+            while any(thread.is_alive() for thread in workers):
+                for thread in workers:
+                    thread.join(0.5)  # 带超时等待，主线程才能响应Ctrl-C
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in workers:
+                thread.join()  # 正在执行的任务做完再退出
+        finally:
+            stop.set()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self, stop, burst):
+        with self.app.app_context():
+            g.write_transaction = True  # 以BEGIN IMMEDIATE开始，见watchlist/database.py
+            errors = 0
+            while not stop.is_set():
+                try:
+                    ran = self._run_next()
+                except Exception:
+                    db.session.remove()
+                    self.app.logger.exception('Job worker error')
+                    self.errors += 1
+                    errors += 1
+                    stop.wait(min(ERROR_DELAY * 2 ** (errors - 1), self.retry_max_delay))
+                    continue
+                errors = 0
+                if not ran:
+                    if burst:
+                        return
+                    stop.wait(self.poll_interval)
+
+    def _run_next(self):
+        claimed = self._claim()
+        if claimed is None:
+            return False
+        if claimed is False:
+            return True  # 未知的任务已经标记为failed
+        job, args = claimed
+        with self._running_lock:
+            self._running.add(job.id)
+        try:
+            result = TASKS[job.name](job, **args)
+        except Exception as e:
+            db.session.rollback()
+            self.app.logger.exception('Job %d (%s) failed', job.id, job.name)
+            self._failed(job, '%s: %s' % (type(e).__name__, e), retry=not isinstance(e, JobError))
+        else:
+            db.session.rollback()  # 任务没有提交的修改不保留
+            self._finish(job, "state = 'done', result = :result", dict(result=json.dumps(result, default=str)))
+            self.done += 1
+        finally:
+            with self._running_lock:
+                self._running.discard(job.id)
+            db.session.remove()
+        return True
+
+    #取一个到期的任务改为running，返回(Job, 参数)；没有任务时返回None，取到未知的任务时标记为failed并返回False
+    def _claim(self):
+        now = time.time()
+        try:
+            # 租约过期的任务回到队列，已经用完次数的直接失败
+            db.session.execute(text(
+                "UPDATE job SET state = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END, "
+                "error = 'Worker ' || worker || ' stopped responding', "
+                "finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE :now END "
+                "WHERE state = 'running' AND run_at < :now"), dict(now=now))
+            row = db.session.execute(text("SELECT id, name, args, user_id, attempts, max_attempts FROM job "
+                                          "WHERE state = 'queued' AND run_at <= :now ORDER BY run_at, id LIMIT 1"),
+                                     dict(now=now)).fetchone()
+            if row is not None:
+                if row.name not in TASKS:
+                    db.session.execute(text("UPDATE job SET state = 'failed', error = :error, finished_at = :now "
+                                            "WHERE id = :id"), dict(error='Unknown task %s' % row.name, now=now, id=row.id))
+                else:
+                    db.session.execute(text(
+                        "UPDATE job SET state = 'running', attempts = attempts + 1, worker = :worker, run_at = :run_at, "
+                        "started_at = coalesce(started_at, :now) WHERE id = :id"),
+                        dict(worker=self.name, run_at=now + self.lease, now=now, id=row.id))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if row is None:
+            return None
+        if row.name not in TASKS:
+            return False
+        return Job(self, row.id, row.name, row.user_id, row.attempts + 1, row.max_attempts), json.loads(row.args)
+
+    def _failed(self, job, error, retry):
+        if retry and job.attempts < job.max_attempts:
+            delay = min(self.retry_delay * 2 ** (job.attempts - 1), self.retry_max_delay)
+            delay *= random.uniform(0.5, 1)  # 同时失败的任务错开重试的时间
+            self._finish(job, "state = 'queued', run_at = :run_at, error = :error",
+                         dict(run_at=time.time() + delay, error=error), finished=False)
+        else:
+            self._finish(job, "state = 'failed', error = :error", dict(error=error))
+            self.failed += 1
+
+    def _finish(self, job, assignments, params, finished=True):
+        if finished:
+            assignments += ', finished_at = :now'
+        db.session.execute(text('UPDATE job SET %s WHERE id = :id AND worker = :worker' % assignments),
+                           dict(params, now=time.time(), id=job.id, worker=self.name))
+        db.session.commit()
+
+    def _heartbeat(self, stop):
+        interval = self.lease / 3.0
+        while not stop.wait(interval):
+            try:
+                self._beat()
+            except Exception:
+                self.app.logger.exception('Job heartbeat failed')
+
+    #续约正在执行的任务，顺便删除过期的任务记录
+    def _beat(self):
+        now = time.time()
+        with self._running_lock:
+            running = sorted(self._running)
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                if running:
+                    connection.execute(text("UPDATE job SET run_at = :run_at WHERE state = 'running' AND worker = :worker "
+                                            "AND id IN (%s)" % ', '.join(str(job_id) for job_id in running)),
+                                       dict(run_at=now + self.lease, worker=self.name))
+                connection.execute(text("DELETE FROM job WHERE state IN ('done', 'failed') "
+                                        "AND finished_at < :before"), dict(before=now - self.keep))
@@ -0,0 +1,339 @@
+# 数据库结构的版本管理，命令见commands.py中的flask db upgrade/status
+#
+# 数据库的版本号保存在SQLite的PRAGMA user_version中，MIGRATIONS按版本号列出每一次结构变化。
+# flask db upgrade依次执行还没有执行过的迁移，整个迁移完成后才更新版本号，
+# 每个迁移都可以重复执行，中途中断(Ctrl-C、进程被杀)后重新执行会从断点继续。
+# 新建的数据库(create_all()建出movie表时)直接是最新的结构，自动标记为最新版本。不支持降级。
+#
+# 大表上的操作都分批进行，每批一个BEGIN IMMEDIATE短事务，批与批之间释放写锁，网站的写请求可以插进来；
+# 每批的行数(MIGRATION_BATCH_SIZE)和每秒最多处理的行数(MIGRATION_ROWS_PER_SECOND)限制了对线上请求的影响：
+#   backfill()       分批UPDATE，进度和数据在同一个事务中写入migration_progress表，中断后从上次的位置继续
+#   rebuild_table()  SQLite不能修改列的类型和约束，只能新建表、复制数据、替换旧表。
+#                    这里先建影子表(<table>__new)和它的索引，在旧表上加触发器把新的写入同步到影子表，
+#                    再按rowid分批复制已有的数据，最后在一个短事务中把影子表换名成正式表并重建旧表上的触发器，
+#                    旧表改名为<table>__old之后再分批删除。只有换名的那一个事务需要持有写锁，时间与数据量无关。
+#                    换名时其他表指向这张表的外键保持原来的表名，不会跟着旧表改成<table>__old。
+#                    SQLite的索引名在整个数据库中唯一并且不能改名，影子表上的索引要用新的名字(同时修改模型中的名字)，
+#                    或者用drop_indexes在建影子表时删掉旧表上的同名索引(复制期间用到这些索引的查询会变慢)。
+#   create_index()   直接CREATE INDEX会在建索引的整个过程中持有写锁，超过一批数据的表改用rebuild_table()，
+#                    把新索引和表上已有的索引都建在影子表上，索引名不变。
+import re
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from watchlist.models import JOB_DDL, MOVIE_FTS_DDL, MOVIE_STATS_DDL, Movie
+from watchlist.stats import rebuild_stats
+
+PROGRESS_TABLE = 'migration_progress'
+
+
+class MigrationError(Exception):
+    pass
+
+
+#版本号 -> 迁移函数，函数的文档字符串作为说明显示在flask db status中
+MIGRATIONS = {}
+
+
+def migration(version):
+    def decorator(f):
+        MIGRATIONS[version] = f
+        return f
+    return decorator
+
+
+def head():
+    """最新的版本号"""
+    return max(MIGRATIONS)
+
+
+@contextmanager
+def connect(engine, **kwargs):
+    """从engine的连接池中取一个连接创建Migrator，事务全部由Migrator自己控制"""
+    connection = engine.raw_connection()
+    dbapi_connection = connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None  # 关闭pysqlite的隐式事务
+    try:
+        yield Migrator(dbapi_connection, **kwargs)
+    finally:
+        dbapi_connection.isolation_level = isolation_level
+        connection.close()
+
+
+#str.format()之前转义SQL中原有的花括号
+def _escape_braces(sql):
+    return sql.replace('{', '{{').replace('}', '}}')
+
+
+class Migrator(object):
+    """在一个SQLite连接上执行迁移，事务由自己控制(BEGIN IMMEDIATE)，不经过SQLAlchemy的会话"""
+
+    def __init__(self, connection, batch_size=1000, rows_per_second=0, options=None, echo=None, progress=None):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.rows_per_second = rows_per_second
+        self.options = options or {}
+        self.echo = echo or (lambda message: None)
+        self.progress = progress  # progress(name, rows)，每批之后调用
+
+    def execute(self, sql, params=()):
+        return self.connection.execute(sql, params)
+
+    def scalar(self, sql, params=()):
+        row = self.execute(sql, params).fetchone()
+        return row[0] if row is not None else None
+
+    @contextmanager
+    def transaction(self):
+        self.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.execute('ROLLBACK')
+            raise
+        self.execute('COMMIT')
+
+    @property
+    def version(self):
+        return self.scalar('PRAGMA user_version')
+
+    def set_version(self, version):
+        self.execute('PRAGMA user_version = %d' % version)
+
+    def table_exists(self, name):
+        return self.scalar("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)) is not None
+
+    def columns(self, table):
+        return [row[1] for row in self.execute('PRAGMA table_info("%s")' % table)]
+
+    def pending(self):
+        return [(version, MIGRATIONS[version]) for version in sorted(MIGRATIONS) if version > self.version]
+
+    def upgrade(self, target=None):
+        """执行版本号不超过target的所有迁移，返回执行了的版本号"""
+        done = []
+        for version, upgrade in self.pending():
+            if target is not None and version > target:
+                break
+            self.echo('Upgrading to %d: %s' % (version, upgrade.__doc__))
+            upgrade(self)
+            self.set_version(version)
+            done.append(version)
+        return done
+
+    # 按速度限制在两批之间等待，即使不限速也让出写锁给排队的写请求
+    def throttle(self, rows, elapsed):
+        delay = rows / float(self.rows_per_second) - elapsed if self.rows_per_second else 0
+        time.sleep(max(delay, 0.001))
+
+    def _create_progress_table(self):
+        self.execute('CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY KEY, position INTEGER NOT NULL)' % PROGRESS_TABLE)
+
+    def _get_progress(self, name):
+        self._create_progress_table()
+        return self.scalar('SELECT position FROM %s WHERE name = ?' % PROGRESS_TABLE, (name,))
+
+    def _set_progress(self, name, position):
+        self._create_progress_table()
+        if position is None:
+            self.execute('DELETE FROM %s WHERE name = ?' % PROGRESS_TABLE, (name,))
+        else:
+            self.execute('INSERT OR REPLACE INTO %s (name, position) VALUES (?, ?)' % PROGRESS_TABLE, (name, position))
+
+    #按rowid把表分成batch_size行一批，依次调用step(lower, upper)处理rowid在(lower, upper]之间的行
+    def _batches(self, name, table, step):
+        position = self._get_progress(name) or 0
+        total = 0
+        while True:
+            upper = self.scalar('SELECT max(rowid) FROM (SELECT rowid FROM "%s" WHERE rowid > ? ORDER BY rowid LIMIT ?)'
+                                % table, (position, self.batch_size))
+            if upper is None:
+                break
+            start = time.time()
+            with self.transaction():
+                rows = step(position, upper)
+                self._set_progress(name, upper)  # 进度和数据在同一个事务中提交
+            position = upper
+            total += rows
+            if self.progress is not None:
+                self.progress(name, total)
+            self.throttle(self.batch_size, time.time() - start)
+        return total
+
+    def backfill(self, name, table, assignments, where='1', params=None):
+        """分批执行UPDATE table SET assignments WHERE where，返回修改的行数，name用于保存进度"""
+        sql = 'UPDATE "%s" SET %s WHERE rowid > :lower AND rowid <= :upper AND (%s)' % (table, assignments, where)
+
+        def step(lower, upper):
+            return self.execute(sql, dict(params or {}, lower=lower, upper=upper)).rowcount
+
+        total = self._batches('backfill:' + name, table, step)
+        self._set_progress('backfill:' + name, None)
+        return total
+
+    def rebuild_table(self, table, create_sql, indexes=(), columns=None, drop_indexes=()):
+        """在线重建表：create_sql和indexes中的{table}会替换为影子表的名字，
+        columns把新表的列映射为旧表上的SQL表达式，没有列出的列按同名复制，旧表中没有的列使用默认值，
+        drop_indexes中旧表上的索引在建影子表的事务中删除，indexes中可以使用它们的名字"""
+        shadow, old = table + '__new', table + '__old'
+        name = 'rebuild:' + table
+        if not self.table_exists(old):
+            if not self.table_exists(shadow):
+                with self.transaction():
+                    for index in drop_indexes:
+                        self.execute('DROP INDEX "%s"' % index)
+                    self.execute(create_sql.format(table=shadow))
+                    for sql in indexes:
+                        self.execute(sql.format(table=shadow))
+                    self._sync_triggers(table, shadow, columns or {})
+                    self._set_progress(name, None)
+            select = self._select(table, shadow, columns or {})
+            copy = 'INSERT OR IGNORE INTO "%s" %s WHERE rowid > ? AND rowid <= ?' % (shadow, select)
+            self._batches(name, table, lambda lower, upper: self.execute(copy, (lower, upper)).rowcount)
+            self._swap(table, shadow, old)
+            self._set_progress(name, None)
+        self._drop(old)
+
+    def create_index(self, name, table, sql):
+        """建立索引，sql中的{table}替换为表名，索引已经存在时什么也不做。
+        不超过一批数据的表直接建立，更大的表按原来的结构用rebuild_table()重建，建索引期间不阻塞写入"""
+        shadow, old = table + '__new', table + '__old'
+        if self.table_exists(shadow) or self.table_exists(old):
+            return self.rebuild_table(table, None)  # 上次中断的重建，影子表上已经有这个索引
+        if self.scalar("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)) is not None:
+            return
+        rows = self.scalar('SELECT count(*) FROM (SELECT 1 FROM "%s" LIMIT ?)' % table, (self.batch_size + 1,))
+        if rows <= self.batch_size:
+            with self.transaction():
+                self.execute(sql.format(table=table))
+            return
+        # 用sqlite_master中保存的建表和建索引语句，换上{table}占位符
+        table_name = r'("?)%s\1' % re.escape(table)
+        create_sql = self.scalar("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        create_sql = re.sub(r'^CREATE TABLE\s+' + table_name, 'CREATE TABLE "{table}"', _escape_braces(create_sql))
+        existing = self.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                                "AND sql IS NOT NULL", (table,)).fetchall()  # 主键和UNIQUE约束的自动索引没有sql
+        indexes = [re.sub(r'\bON\s+' + table_name + r'\s*\(', 'ON "{table}" (', _escape_braces(index_sql), count=1)
+                   for _, index_sql in existing]
+        self.echo('Rebuilding %s to index it without blocking writes' % table)
+        self.rebuild_table(table, create_sql, indexes + [sql], drop_indexes=[index for index, _ in existing])
+
+    #新表的列和对应的旧表表达式
+    def _select(self, table, shadow, columns):
+        existing = set(self.columns(table))
+        names = [c for c in self.columns(shadow) if c in columns or c in existing]
+        return '(%s) SELECT %s FROM "%s"' % (', '.join('"%s"' % c for c in names),
+                                            ', '.join(columns.get(c, '"%s"' % c) for c in names), table)
+
+    #复制期间旧表上的写入由触发器同步到影子表，已经复制过的行被覆盖，还没复制的行复制时被忽略(INSERT OR IGNORE)
+    def _sync_triggers(self, table, shadow, columns):
+        select = self._select(table, shadow, columns)
+        self.execute('CREATE TRIGGER "%s__sync_ai" AFTER INSERT ON "%s" BEGIN '
+                     'INSERT OR REPLACE INTO "%s" %s WHERE rowid = new.rowid; END' % (table, table, shadow, select))
+        self.execute('CREATE TRIGGER "%s__sync_au" AFTER UPDATE ON "%s" BEGIN '
+                     'DELETE FROM "%s" WHERE rowid = old.rowid; '
+                     'INSERT OR REPLACE INTO "%s" %s WHERE rowid = new.rowid; END' % (table, table, shadow, shadow, select))
+        self.execute('CREATE TRIGGER "%s__sync_ad" AFTER DELETE ON "%s" BEGIN '
+                     'DELETE FROM "%s" WHERE rowid = old.rowid; END' % (table, table, shadow))
+
+    #换名的短事务：删除同步触发器，旧表上的其他触发器(比如全文搜索)移到新表上。
+    #SQLite默认在改表名时把其他表中REFERENCES旧名字的外键一起改掉，movie表的外键会指向随后被删除的user__old，
+    #所以换名期间打开legacy_alter_table并关闭foreign_keys(这两个设置都不能在事务中修改)，其他表的外键保持原来的表名
+    def _swap(self, table, shadow, old):
+        foreign_keys = self.scalar('PRAGMA foreign_keys')
+        self.execute('PRAGMA foreign_keys = OFF')
+        self.execute('PRAGMA legacy_alter_table = ON')
+        try:
+            with self.transaction():
+                triggers = self.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?",
+                                        (table,)).fetchall()
+                for trigger, _ in triggers:
+                    self.execute('DROP TRIGGER "%s"' % trigger)
+                self.execute('ALTER TABLE "%s" RENAME TO "%s"' % (table, old))
+                self.execute('ALTER TABLE "%s" RENAME TO "%s"' % (shadow, table))
+                for trigger, sql in triggers:
+                    if not trigger.startswith(table + '__sync_'):
+                        self.execute(sql)
+        finally:
+            self.execute('PRAGMA legacy_alter_table = OFF')
+            self.execute('PRAGMA foreign_keys = %d' % foreign_keys)
+
+    #分批删除旧表中的数据，最后删除空表，每一步都只持有很短时间的写锁
+    def _drop(self, old):
+        if not self.table_exists(old):
+            return
+        while True:
+            start = time.time()
+            with self.transaction():
+                rows = self.execute('DELETE FROM "%s" WHERE rowid IN (SELECT rowid FROM "%s" LIMIT ?)'
+                                    % (old, old), (self.batch_size,)).rowcount
+            if not rows:
+                break
+            self.throttle(rows, time.time() - start)
+        with self.transaction():
+            self.execute('DROP TABLE "%s"' % old)
+
+
+@migration(1)
+def search_index(m):
+    """Add the year index and the full-text search index"""
+    m.create_index('ix_movie_year', 'movie', 'CREATE INDEX ix_movie_year ON {table} (year)')
+    with m.transaction():
+        created = not m.table_exists('movie_fts')
+        for ddl in MOVIE_FTS_DDL:
+            m.execute(ddl)
+        if created:
+            m.execute("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')")
+
+
+@migration(2)
+def movie_owners(m):
+    """Give every movie an owner"""
+    if 'user_id' not in m.columns('movie'):
+        m.execute('ALTER TABLE movie ADD COLUMN user_id INTEGER REFERENCES user(id)')
+    duplicates = [row[0] for row in m.execute(
+        'SELECT username FROM user WHERE username IS NOT NULL GROUP BY username HAVING count(*) > 1')]
+    if duplicates:
+        raise MigrationError('Duplicate usernames, rename them first: %s' % ', '.join(duplicates))
+    m.create_index('ix_user_username', 'user', 'CREATE UNIQUE INDEX ix_user_username ON {table} (username)')
+    m.create_index('ix_movie_user_id_id', 'movie', 'CREATE INDEX ix_movie_user_id_id ON {table} (user_id, id)')
+    if m.scalar('SELECT 1 FROM movie WHERE user_id IS NULL LIMIT 1') is None:
+        return
+    owner = m.options.get('owner')
+    if owner:
+        row = m.execute('SELECT id, coalesce(username, name) FROM user WHERE username = ?', (owner,)).fetchone()
+    else:
+        row = m.execute('SELECT id, coalesce(username, name) FROM user ORDER BY id LIMIT 1').fetchone()
+    if row is None:
+        raise MigrationError('User %s not found' % owner if owner else 'No user yet, run flask admin first')
+    total = m.backfill('movie_owners', 'movie', 'user_id = :owner', 'user_id IS NULL', dict(owner=row[0]))
+    m.echo('Assigned %d movies to %s' % (total, row[1]))
+
+
+@migration(3)
+def year_stats(m):
+    """Add the summary table behind the stats page"""
+    with m.transaction():
+        for ddl in MOVIE_STATS_DDL:
+            m.execute(ddl)
+    # 触发器建好之后再计算已有的数据，计算期间的写入由触发器计入
+    total = rebuild_stats(m)
+    m.echo('Counted %d movies' % total)
+
+
+@migration(4)
+def job_queue(m):
+    """Add the background job queue"""
+    with m.transaction():
+        for ddl in JOB_DDL:
+            m.execute(ddl)
+
+
+#create_all()新建的数据库已经是最新的结构，不需要再执行迁移
+@event.listens_for(Movie.__table__, 'after_create')
+def stamp_new_database(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('PRAGMA user_version = %d' % head())
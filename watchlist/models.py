@@ -1,5 +1,11 @@
 # 模型类
+import re
+
+from flask import current_app
+from sqlalchemy import DDL, event, text
+
 from watchlist import db
+from watchlist.passwords import hash_params
 from werkzeug.security import generate_password_hash,check_password_hash  # 用于生成和校验passwd
 from flask_login import  UserMixin
 
@@ -8,17 +14,117 @@ class User(db.Model,UserMixin):   #表名是user，自动处理成小写
     #UserMixin由Flask-Login提供，继承这个类会拥有几个判断认证属性的方法，current_user.is_authenticated在用户登录时会返回True
     id = db.Column(db.Integer,primary_key=True)
     name = db.Column(db.String(20))
-    username = db.Column(db.String(20))
+    username = db.Column(db.String(20), unique=True, index=True)  # 登录时按用户名查询
+    movies = db.relationship('Movie', backref='user', lazy='dynamic')
     passwd_hash = db.Column(db.String(128))
 
     def set_passwd(self,passwd):
-        self.passwd_hash = generate_password_hash(passwd)
+        self.passwd_hash = generate_password_hash(passwd, method=current_app.config['PASSWORD_HASH_METHOD'])
+
+    def passwd_needs_rehash(self):
+        # 哈希的格式为 方法$盐$哈希值，方法或迭代次数与配置不同时需要重新计算，两边都先规范化再比较
+        stored = self.passwd_hash.split('$', 1)[0]
+        return hash_params(stored) != hash_params(current_app.config['PASSWORD_HASH_METHOD'])
 
     def check_passwd(self,passwd):
         return check_password_hash(self.passwd_hash,passwd)
 
-#电影信息
+#电影信息，每部电影属于一个用户
 class Movie(db.Model):
+    # 按(user_id, id)建复合索引，一个用户的电影列表按id分页时只扫描该用户的一页数据，与总数据量无关
+    __table_args__ = (db.Index('ix_movie_user_id_id', 'user_id', 'id'),)
+
     id = db.Column(db.Integer,primary_key=True)
     title = db.Column(db.String(60))
-    year = db.Column(db.String(4))
\ No newline at end of file
+    year = db.Column(db.String(4), index=True)  # 年份上建B树索引，用于按年份范围筛选
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 旧数据库用flask db upgrade补上(迁移2)
+
+    @staticmethod
+    def search(q, year_from=None, year_to=None, limit=20, user_id=None):
+        """按标题全文搜索，每个词都做前缀匹配，结果按相关度(bm25)排序，指定user_id时只搜索该用户的电影"""
+        params = dict(limit=limit)
+        conditions = []
+        if user_id is not None:
+            conditions.append('movie.user_id = :user_id')
+            params['user_id'] = user_id
+        # year是字符串，按4位数字补齐后比较
+        if year_from:
+            conditions.append('movie.year >= :year_from')
+            params['year_from'] = '%04d' % int(year_from)
+        if year_to:
+            conditions.append('movie.year <= :year_to')
+            params['year_to'] = '%04d' % int(year_to)
+        query = fts_query(q)
+        if query:
+            params['q'] = query
+            sql = ('SELECT movie.id, movie.title, movie.year FROM movie_fts JOIN movie ON movie.id = movie_fts.rowid '
+                   'WHERE movie_fts MATCH :q %s ORDER BY movie_fts.rank LIMIT :limit')
+            conditions = ''.join(' AND ' + c for c in conditions)
+        else:  # 没有关键词时只按年份筛选，走year索引
+            sql = 'SELECT id, title, year FROM movie %s ORDER BY year, id LIMIT :limit'
+            conditions = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        return db.session.execute(text(sql % conditions), params).fetchall()
+
+
+#验证电影数据：标题和年份都必须是非空字符串(JSON中可能传入数字或列表)，并且不超过字段长度
+def valid_movie(title, year):
+    if not isinstance(title, str) or not isinstance(year, str):
+        return False
+    return bool(title) and bool(year) and len(year) <= 4 and len(title) <= 60
+
+
+#把用户输入转换为FTS5查询：每个词加上双引号避免FTS语法注入，再加*做前缀匹配
+def fts_query(q):
+    return ' '.join('"%s"*' % word for word in re.findall(r'\w+', q or ''))
+
+
+#全文搜索：FTS5外部内容表movie_fts只索引标题，由触发器与movie表保持同步
+MOVIE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5(title, content='movie', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_ai AFTER INSERT ON movie BEGIN "
+    "INSERT INTO movie_fts(rowid, title) VALUES (new.id, new.title); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_ad AFTER DELETE ON movie BEGIN "
+    "INSERT INTO movie_fts(movie_fts, rowid, title) VALUES ('delete', old.id, old.title); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_au AFTER UPDATE OF title ON movie BEGIN "
+    "INSERT INTO movie_fts(movie_fts, rowid, title) VALUES ('delete', old.id, old.title); "
+    "INSERT INTO movie_fts(rowid, title) VALUES (new.id, new.title); END",
+]
+for ddl in MOVIE_FTS_DDL:
+    event.listen(Movie.__table__, 'after_create', DDL(ddl).execute_if(dialect='sqlite'))
+event.listen(Movie.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS movie_fts').execute_if(dialect='sqlite'))
+
+
+#统计：movie_year_stat按(用户, 年份)保存电影数，由触发器随movie表的增删改增量维护，
+#统计页面只读取这张表，代价与分组数有关而与电影数无关。年份为NULL时记为空字符串，没有所属用户的电影不计入
+MOVIE_STATS_DDL = [
+    "CREATE TABLE IF NOT EXISTS movie_year_stat (user_id INTEGER NOT NULL, year TEXT NOT NULL, "
+    "count INTEGER NOT NULL, PRIMARY KEY (user_id, year)) WITHOUT ROWID",
+    "CREATE TRIGGER IF NOT EXISTS movie_stat_ai AFTER INSERT ON movie WHEN new.user_id IS NOT NULL BEGIN "
+    "INSERT INTO movie_year_stat (user_id, year, count) VALUES (new.user_id, coalesce(new.year, ''), 1) "
+    "ON CONFLICT (user_id, year) DO UPDATE SET count = count + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS movie_stat_ad AFTER DELETE ON movie WHEN old.user_id IS NOT NULL BEGIN "
+    "UPDATE movie_year_stat SET count = count - 1 WHERE user_id = old.user_id AND year = coalesce(old.year, ''); "
+    "DELETE FROM movie_year_stat WHERE user_id = old.user_id AND year = coalesce(old.year, '') AND count <= 0; END",
+    "CREATE TRIGGER IF NOT EXISTS movie_stat_au AFTER UPDATE OF year, user_id ON movie "
+    "WHEN old.year IS NOT new.year OR old.user_id IS NOT new.user_id BEGIN "
+    "UPDATE movie_year_stat SET count = count - 1 WHERE user_id = old.user_id AND year = coalesce(old.year, ''); "
+    "DELETE FROM movie_year_stat WHERE user_id = old.user_id AND year = coalesce(old.year, '') AND count <= 0; "
+    "INSERT INTO movie_year_stat (user_id, year, count) SELECT new.user_id, coalesce(new.year, ''), 1 "
+    "WHERE new.user_id IS NOT NULL ON CONFLICT (user_id, year) DO UPDATE SET count = count + 1; END",
+]
+for ddl in MOVIE_STATS_DDL:
+    event.listen(Movie.__table__, 'after_create', DDL(ddl).execute_if(dialect='sqlite'))
+event.listen(Movie.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS movie_year_stat').execute_if(dialect='sqlite'))
+
+
+#后台任务队列，说明见watchlist/jobs.py。state为queued时run_at是最早开始的时间，为running时是租约到期的时间。
+#随movie表一起建立，但drop_all()时保留，flask initdb --drop本身作为后台任务执行时不会删掉自己
+JOB_DDL = [
+    "CREATE TABLE IF NOT EXISTS job (id INTEGER PRIMARY KEY, name TEXT NOT NULL, args TEXT NOT NULL, "
+    "user_id INTEGER, state TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, "
+    "max_attempts INTEGER NOT NULL, run_at REAL NOT NULL, worker TEXT, done INTEGER NOT NULL DEFAULT 0, "
+    "total INTEGER, result TEXT, error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL)",
+    "CREATE INDEX IF NOT EXISTS ix_job_state_run_at ON job (state, run_at)",
+]
+for ddl in JOB_DDL:
+    event.listen(Movie.__table__, 'after_create', DDL(ddl).execute_if(dialect='sqlite'))
@@ -0,0 +1,71 @@
+# 密码校验：在有界的线程池/进程池中执行，登录请求过多时直接拒绝。
+# 请求线程仍然阻塞在future.result()上等待结果，并没有被释放出来处理其他请求；
+# 线程池只是限制了同时计算哈希的数量：等待中的登录最多占用LOGIN_VERIFY_WORKERS+LOGIN_VERIFY_QUEUE个请求线程，
+# 再多的登录请求立即返回429，其余的请求线程不会都卡在登录上。
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+
+class PasswordVerifier(object):
+    def __init__(self, workers, queue_size, executor='thread'):
+        if executor == 'process':  # 多进程绕开GIL，适合CPU核数较多的机器
+            self._executor = ProcessPoolExecutor(workers)
+        else:
+            self._executor = ThreadPoolExecutor(workers)
+        # 正在执行和排队的校验总数上限，超出时立即拒绝，不让登录风暴占满所有worker线程
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def verify(self, passwd_hash, passwd):
+        return self._run(check_password_hash, passwd_hash, passwd)
+
+    def hash(self, passwd, method):
+        return self._run(generate_password_hash, passwd, method)
+
+    def _run(self, f, *args):
+        if not self._slots.acquire(blocking=False):
+            raise TooManyRequests(retry_after=current_app.config['LOGIN_RETRY_AFTER'])
+        try:
+            future = self._executor.submit(f, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda done: self._slots.release())
+        return future.result()
+
+
+def get_password_verifier():
+    verifier = current_app.extensions.get('password_verifier')
+    if verifier is None:
+        verifier = PasswordVerifier(current_app.config['LOGIN_VERIFY_WORKERS'], current_app.config['LOGIN_VERIFY_QUEUE'],
+                                    current_app.config['LOGIN_VERIFY_EXECUTOR'])
+        current_app.extensions['password_verifier'] = verifier
+    return verifier
+
+
+#校验用户密码，等同于user.check_passwd(passwd)
+def verify_passwd(user, passwd):
+    return get_password_verifier().verify(user.passwd_hash, passwd)
+
+
+#登录成功后用PASSWORD_HASH_METHOD重新计算密码哈希，同样受线程池的数量限制；池已满时返回False，等下次登录再算
+def rehash_passwd(user, passwd):
+    try:
+        user.passwd_hash = get_password_verifier().hash(passwd, current_app.config['PASSWORD_HASH_METHOD'])
+    except TooManyRequests:
+        return False
+    return True
+
+
+#把哈希方法规范为元组，pbkdf2省略的摘要算法和迭代次数按werkzeug的默认值补上，
+#这样配置写成pbkdf2:sha256时与保存的pbkdf2:sha256:260000被看作相同的参数
+def hash_params(method):
+    parts = method.split(':')
+    if parts[0] != 'pbkdf2':
+        return tuple(parts)
+    digest = parts[1] if len(parts) > 1 and parts[1] else 'sha256'
+    iterations = int(parts[2]) if len(parts) > 2 and parts[2] else DEFAULT_PBKDF2_ITERATIONS
+    return 'pbkdf2', digest, iterations
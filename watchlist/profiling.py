@@ -0,0 +1,188 @@
+# 请求性能分析：记录每个请求的耗时、SQL语句数量和耗时、模板渲染耗时以及内存分配
+#
+# PROFILE_ENABLED打开后按PROFILE_SAMPLE_RATE的比例抽样请求，结果写入Server-Timing响应头，
+# 同时汇总到进程内的滚动统计表，由/_metrics以Prometheus文本格式输出。
+# PROFILE_TRACEMALLOC打开后用tracemalloc统计内存分配，开销较大，只建议在排查问题时使用。
+import random
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+from flask import current_app, g, has_request_context, request, Response
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from watchlist.cache import user_cache
+
+
+#单个请求的计时数据
+class Profile(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_start = None
+        self.alloc_start = None
+        if tracemalloc.is_tracing():
+            self.alloc_start = tracemalloc.get_traced_memory()[0]
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self.start
+        self.allocated = None
+        if self.alloc_start is not None and tracemalloc.is_tracing():
+            self.allocated = max(tracemalloc.get_traced_memory()[0] - self.alloc_start, 0)
+        return self
+
+
+#按endpoint汇总的滚动统计表，分位数只根据最近window个请求计算
+class RequestStats(object):
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, profile):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = dict(count=0, wall=0.0, sql_count=0, sql_time=0.0,
+                                                         template=0.0, allocated=0, recent=deque(maxlen=self.window))
+            stats['count'] += 1
+            stats['wall'] += profile.wall_time
+            stats['sql_count'] += profile.sql_count
+            stats['sql_time'] += profile.sql_time
+            stats['template'] += profile.template_time
+            stats['allocated'] += profile.allocated or 0
+            stats['recent'].append(profile.wall_time)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((endpoint, dict(stats, recent=sorted(stats['recent'])))
+                        for endpoint, stats in self._endpoints.items())
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+request_stats = RequestStats()
+
+
+def current_profile():
+    return g.get('profile') if has_request_context() else None
+
+
+def start_profile():
+    g.pop('profile', None)  # 程序上下文可能被多个请求共用(比如测试中)，不沿用上一个请求的记录
+    config = current_app.config
+    if not config['PROFILE_ENABLED'] or request.endpoint == 'metrics':
+        return
+    if random.random() >= config['PROFILE_SAMPLE_RATE']:  # 没有抽中的请求不做任何记录
+        return
+    if config['PROFILE_TRACEMALLOC'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    g.profile = Profile()
+
+
+def finish_profile(response):
+    profile = current_profile()
+    if profile is None:
+        return response
+    profile.finish()
+    timings = ['app;dur=%.2f' % (profile.wall_time * 1000),
+               'db;dur=%.2f;desc="%d queries"' % (profile.sql_time * 1000, profile.sql_count),
+               'tpl;dur=%.2f' % (profile.template_time * 1000)]
+    if profile.allocated is not None:
+        timings.append('alloc;desc="%d bytes"' % profile.allocated)
+    response.headers.add('Server-Timing', ', '.join(timings))
+    request_stats.record(request.endpoint or 'unknown', profile)
+    return response
+
+
+#SQL计时，监听所有Engine，没有抽中的请求只多一次属性查找
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile() is not None:
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    if profile is not None and conn.info.get('profile_start'):
+        profile.sql_count += 1
+        profile.sql_time += time.perf_counter() - conn.info['profile_start'].pop()
+
+
+#模板渲染计时，使用Flask的模板信号
+def on_before_render(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None:
+        profile.template_start = time.perf_counter()
+
+
+def on_rendered(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None and profile.template_start is not None:
+        profile.template_time += time.perf_counter() - profile.template_start
+        profile.template_start = None
+
+
+def _quantile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+#Prometheus文本格式
+def render_metrics():
+    lines = [
+        '# HELP watchlist_request_duration_seconds Wall time of sampled requests.',
+        '# TYPE watchlist_request_duration_seconds summary',
+    ]
+    snapshot = request_stats.snapshot()
+    for endpoint, stats in sorted(snapshot.items()):
+        for q in (0.5, 0.95, 0.99):
+            lines.append('watchlist_request_duration_seconds{endpoint="%s",quantile="%s"} %.6f'
+                         % (endpoint, q, _quantile(stats['recent'], q)))
+        lines.append('watchlist_request_duration_seconds_sum{endpoint="%s"} %.6f' % (endpoint, stats['wall']))
+        lines.append('watchlist_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, stats['count']))
+    counters = [
+        ('watchlist_sql_queries_total', 'SQL statements executed by sampled requests.', 'sql_count', '%d'),
+        ('watchlist_sql_duration_seconds_total', 'SQL time of sampled requests.', 'sql_time', '%.6f'),
+        ('watchlist_template_duration_seconds_total', 'Template render time of sampled requests.', 'template', '%.6f'),
+        ('watchlist_allocated_bytes_total', 'Bytes allocated by sampled requests (tracemalloc).', 'allocated', '%d'),
+    ]
+    for name, doc, key, fmt in counters:
+        lines.append('# HELP %s %s' % (name, doc))
+        lines.append('# TYPE %s counter' % name)
+        for endpoint, stats in sorted(snapshot.items()):
+            lines.append(('%s{endpoint="%s"} ' + fmt) % (name, endpoint, stats[key]))
+    cache = user_cache.stats()
+    for name, value in (('hits', cache['hits']), ('misses', cache['misses'])):
+        lines.append('# HELP watchlist_user_cache_%s_total User cache %s.' % (name, name))
+        lines.append('# TYPE watchlist_user_cache_%s_total counter' % name)
+        lines.append('watchlist_user_cache_%s_total %d' % (name, value))
+    lines.append('# HELP watchlist_user_cache_size Users held in the user cache.')
+    lines.append('# TYPE watchlist_user_cache_size gauge')
+    lines.append('watchlist_user_cache_size %d' % cache['size'])
+    writes = current_app.extensions.get('write_queue')
+    if writes is not None:
+        for name, doc, value in (('writes', 'Write-behind changes committed.', writes.writes),
+                                 ('failed', 'Write-behind changes that could not be written.', writes.failed)):
+            lines.append('# HELP watchlist_write_behind_%s_total %s' % (name, doc))
+            lines.append('# TYPE watchlist_write_behind_%s_total counter' % name)
+            lines.append('watchlist_write_behind_%s_total %d' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def init_profiling(app):
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    before_render_template.connect(on_before_render, app)
+    template_rendered.connect(on_rendered, app)
@@ -0,0 +1,209 @@
+# 限流和准入控制
+#
+# 令牌桶限流：RATELIMIT_RULES为endpoint指定限额，比如'10/minute'表示桶里最多10个令牌，每6秒补充一个。
+# 只对修改数据的请求(POST、PATCH、DELETE)计数，登录用户按用户ID计数(换IP也共用一个桶)，匿名用户按IP计数。
+# 令牌用完时返回429和Retry-After，API返回JSON。令牌桶保存在RATELIMIT_BACKEND中：
+#   memory  进程内，每个worker各自计数，实际限额是worker数的倍数。补满了的桶和不存在一样，按时间淘汰
+#   sqlite  多个worker共享的SQLite文件(RATELIMIT_DB)，与data.db分开，不和网站的写入争抢写锁
+#   none    关闭限流
+#
+# 并发上限：正在处理的请求数达到MAX_CONCURRENT_REQUESTS，或者正在处理的写请求数达到MAX_CONCURRENT_WRITES时，
+# 新的请求直接返回503和Retry-After，不在线程池和SQLite的写锁上排队——排队越长每个请求越慢，最后所有请求一起超时。
+# WSGI中间件在create_app()中包在最外层，以ASGI方式运行时在进入线程池之前检查(见watchlist/asgi.py)。0表示不限制。
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.wsgi import ClosingIterator
+
+from watchlist.database import READ_METHODS
+
+ADMITTED_KEY = 'watchlist.admitted'  # ASGI入口已经占用了名额，中间件不再重复计数
+PERIODS = dict(second=1, minute=60, hour=3600, day=86400)
+
+
+def parse_limit(limit):
+    """'10/minute' -> (桶的容量, 每秒补充的令牌数)"""
+    count, period = limit.split('/', 1)
+    return int(count), int(count) / float(PERIODS[period.strip()])
+
+
+#按经过的时间补充令牌后取一个，返回(剩余令牌数, 需要等待的秒数)，取到时等待0秒
+def _take(tokens, updated, capacity, rate, now):
+    tokens = capacity if tokens is None else min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+#进程内的令牌桶，按最近一次使用的顺序保存，队首的桶补满之后就删除，超出容量时淘汰最久没用过的
+class MemoryBucketStore(object):
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> (令牌数, 更新时间, 补满的时间)
+
+    def take(self, key, capacity, rate, now=None):
+        """从key的桶中取一个令牌，取到时返回0，否则返回需要等待的秒数"""
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._buckets:
+                oldest = next(iter(self._buckets.values()))
+                if oldest[2] > now:
+                    break
+                self._buckets.popitem(last=False)
+            tokens, updated = self._buckets.pop(key, (None, None))[:2]
+            tokens, wait = _take(tokens, updated, capacity, rate, now)
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+#多个worker共享的令牌桶，每个线程一个连接，每次取令牌是一个BEGIN IMMEDIATE短事务
+class SqliteBucketStore(object):
+    def __init__(self, path, sweep_interval=60):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = 0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = OFF')  # 计数丢了也没关系，不需要fsync
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                               'updated REAL NOT NULL, expires REAL NOT NULL) WITHOUT ROWID')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_bucket_expires ON bucket (expires)')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, rate, now=None):
+        now = time.time() if now is None else now
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, wait = _take(row[0] if row else None, row[1] if row else None, capacity, rate, now)
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated, expires) VALUES (?, ?, ?, ?)',
+                               (key, tokens, now, now + (capacity - tokens) / rate))
+            if now >= self._next_sweep:  # 定期删除已经补满的桶
+                connection.execute('DELETE FROM bucket WHERE expires <= ?', (now,))
+                self._next_sweep = now + self.sweep_interval
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return wait
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM bucket').fetchone()[0]
+
+
+def get_bucket_store():
+    if 'ratelimit' not in current_app.extensions:
+        backend = current_app.config['RATELIMIT_BACKEND']
+        if backend == 'sqlite':
+            store = SqliteBucketStore(current_app.config['RATELIMIT_DB'])
+        elif backend == 'memory':
+            store = MemoryBucketStore(current_app.config['RATELIMIT_SIZE'])
+        else:
+            store = None
+        current_app.extensions['ratelimit'] = store
+    return current_app.extensions['ratelimit']
+
+
+#before_request钩子，按endpoint的限额检查修改数据的请求
+def check_rate_limit():
+    if request.method in READ_METHODS:
+        return None
+    limit = current_app.config['RATELIMIT_RULES'].get(request.endpoint)
+    store = get_bucket_store() if limit else None
+    if store is None:
+        return None
+    capacity, rate = parse_limit(limit)
+    if current_user.is_authenticated:
+        client = 'user:%s' % current_user.get_id()
+    else:
+        client = 'ip:%s' % request.remote_addr
+    wait = store.take('%s %s' % (request.endpoint, client), capacity, rate)
+    if not wait:
+        return None
+    retry_after = int(math.ceil(wait))
+    if request.endpoint.startswith('api_'):
+        from watchlist.api import api_error
+        response = api_error(429, 'Too many requests', retry_after=retry_after)
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    raise TooManyRequests(retry_after=retry_after)
+
+
+#正在处理的请求数和写请求数
+class Admission(object):
+    def __init__(self, max_requests, max_writes, retry_after):
+        self.retry_after = retry_after
+        self._requests = threading.BoundedSemaphore(max_requests) if max_requests else None
+        self._writes = threading.BoundedSemaphore(max_writes) if max_writes else None
+
+    def enter(self, method):
+        """占用名额，成功时返回交给leave()的名额列表，已满时返回None，不会等待"""
+        slots = []
+        for semaphore in (self._requests, self._writes if method not in READ_METHODS else None):
+            if semaphore is None:
+                continue
+            if not semaphore.acquire(blocking=False):
+                self.leave(slots)
+                return None
+            slots.append(semaphore)
+        return slots
+
+    def leave(self, slots):
+        for semaphore in slots:
+            semaphore.release()
+
+    def overloaded(self):
+        return ServiceUnavailable(retry_after=self.retry_after).get_response()
+
+
+class AdmissionMiddleware(object):
+    def __init__(self, wsgi_app, admission):
+        self.wsgi_app = wsgi_app
+        self.admission = admission
+
+    def __call__(self, environ, start_response):
+        if environ.get(ADMITTED_KEY):
+            return self.wsgi_app(environ, start_response)
+        slots = self.admission.enter(environ['REQUEST_METHOD'])
+        if slots is None:
+            return self.admission.overloaded()(environ, start_response)
+        try:
+            result = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.admission.leave(slots)
+            raise
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(result, file_wrapper):
+            self.admission.leave(slots)  # 静态文件由服务器发送，不再占用名额，也保留sendfile
+            return result
+        # 响应发送完(流式响应可能很长)或者客户端断开时，服务器调用close()，这时才释放名额
+        return ClosingIterator(result, lambda: self.admission.leave(slots))
+
+
+def init_ratelimit(app):
+    app.before_request(check_rate_limit)
+    config = app.config
+    if config['MAX_CONCURRENT_REQUESTS'] or config['MAX_CONCURRENT_WRITES']:
+        admission = Admission(config['MAX_CONCURRENT_REQUESTS'], config['MAX_CONCURRENT_WRITES'],
+                              config['OVERLOAD_RETRY_AFTER'])
+        app.extensions['admission'] = admission
+        app.wsgi_app = AdmissionMiddleware(app.wsgi_app, admission)
@@ -0,0 +1,243 @@
+# 读副本：GET请求(包括inject_user等上下文处理器)从只读连接读取，修改数据的请求和请求之外的代码使用主库
+#
+# SQLITE_READ_REPLICA：
+#   none      所有请求都使用主库(默认)
+#   readonly  以mode=ro打开data.db的单独连接池，读到的总是已经提交的最新数据，
+#             读请求不占用写请求的连接，也不可能拿到写锁
+#   snapshot  用SQLite的备份API把主库复制成快照文件(SQLITE_SNAPSHOT_DIR)，以immutable方式打开，读取时完全不加锁。
+#             快照在后台线程中刷新，超过SQLITE_REPLICA_MAX_AGE秒的快照不再使用(改读主库)，
+#             已经用了一半时间时开始刷新。所有worker共用目录中的同一份快照：刷新时拿到snapshot.lock文件锁，
+#             LATEST中的快照还够新(其他worker刚复制过)就直接使用；主库和-wal文件的修改时间、大小都没有变化时，
+#             原来的快照仍然是最新的数据，只更新LATEST中的时间；都不满足时才复制一份新的。
+#             被替换的快照再过2*SQLITE_REPLICA_MAX_AGE秒(没有worker还会打开它)后删除。
+#
+# 写过数据的用户：登录用户的请求成功并且提交了数据(或者放进了写合并的队列)之后在会话中记下时间，
+# 之后该用户只读比这个时间晚SQLITE_REPLICA_STICKY秒以上的副本，在那之前读主库，自己的修改马上就能看到
+# (写合并模式下修改在请求之后才提交，所以要留出一点余量)。匿名、被拒绝和失败的请求不记录，也不会因此设置cookie。
+# 同一个请求的所有查询都使用同一个副本。用旧快照渲染的页面不写入页面缓存，见cache.cached_page()。
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request, session
+from flask_login import current_user
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+from watchlist.database import READ_METHODS, RoutingSession, setup_sqlite_engine
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，各个worker可能同时复制
+    fcntl = None
+
+WROTE_AT_KEY = '_wrote_at'
+
+
+class ReadReplica(object):
+    def __init__(self, path, mode, max_age, pragmas, pool_size, max_overflow, snapshot_dir=None, logger=None):
+        self.path = path
+        self.logger = logger
+        self.mode = mode
+        self.max_age = max_age
+        self.snapshot_dir = snapshot_dir
+        self._pragmas = dict((k, v) for k, v in pragmas.items() if k != 'journal_mode')  # 只读连接不能修改日志模式
+        self._pool = dict(pool_size=pool_size, max_overflow=max_overflow)
+        self._lock = threading.Lock()
+        self._snapshot = None     # (引擎, 快照时间, 文件名)
+        self._refreshing = False
+        self.refreshes = 0
+        if mode == 'readonly':
+            self._engine = self._create_engine(path, immutable=False)
+
+    def engine(self):
+        """返回(只读引擎, 数据的时间)，快照太旧时返回(None, None)，改读主库"""
+        if self.mode == 'readonly':
+            return self._engine, time.time()
+        now = time.time()
+        snapshot = self._snapshot
+        if snapshot is None or now - snapshot[1] >= self.max_age / 2.0:
+            self._start_refresh()
+        if snapshot is None or now - snapshot[1] > self.max_age:
+            return None, None
+        return snapshot[0], snapshot[1]
+
+    def refresh(self):
+        """切换到最新的共享快照，需要时复制一份新的"""
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        with file_lock(os.path.join(self.snapshot_dir, 'snapshot.lock')):
+            latest = self._read_latest()
+            now = time.time()  # 先取时间再检查文件，检查之后的写入会让下一次检查发现变化
+            stamp = self._stamp()
+            if latest is not None and latest['stamp'] == stamp:
+                latest['taken'] = now  # 主库没有变化
+            elif latest is None or now - latest['taken'] >= self.max_age / 2.0:
+                latest = self._copy(latest, now, stamp)
+            self._remove_retired(latest, now)
+            self._write_latest(latest)
+        filename = os.path.join(self.snapshot_dir, latest['file'])
+        with self._lock:
+            current = self._snapshot
+            if current is not None and current[2] == filename:
+                self._snapshot = (current[0], latest['taken'], filename)
+                return
+        engine = self._create_engine(filename, immutable=True)
+        with self._lock:
+            old, self._snapshot = self._snapshot, (engine, latest['taken'], filename)
+        if old is not None:
+            old[0].dispose()  # 正在使用的连接归还时关闭
+
+    def close(self):
+        with self._lock:
+            old, self._snapshot = self._snapshot, None
+        if old is not None:
+            old[0].dispose()  # 快照文件由其他worker继续使用，不删除
+
+    #复制一份新的快照，taken是开始复制的时间，快照中的数据不会比它更旧
+    def _copy(self, latest, taken, stamp):
+        self.refreshes += 1
+        name = 'snapshot-%d-%d.db' % (os.getpid(), self.refreshes)
+        filename = os.path.join(self.snapshot_dir, name)
+        source = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)
+        target = sqlite3.connect(filename + '.tmp')
+        try:
+            source.backup(target)
+            target.execute('PRAGMA journal_mode = DELETE')  # 快照是一个完整的文件，不需要-wal和-shm
+        finally:
+            target.close()
+            source.close()
+        os.replace(filename + '.tmp', filename)  # 其他worker不会打开复制了一半的文件
+        retired = dict(latest['retired']) if latest is not None else {}
+        if latest is not None:
+            retired[latest['file']] = taken
+        return dict(file=name, taken=taken, stamp=stamp, retired=retired)
+
+    def _remove_retired(self, latest, now):
+        for name, retired_at in list(latest['retired'].items()):
+            if now - retired_at > 2 * self.max_age:
+                try:
+                    os.remove(os.path.join(self.snapshot_dir, name))
+                except OSError:
+                    pass
+                del latest['retired'][name]
+
+    #主库和-wal文件的修改时间和大小，有提交时至少一项会变化
+    def _stamp(self):
+        stamp = []
+        for filename in (self.path, self.path + '-wal'):
+            try:
+                st = os.stat(filename)
+            except OSError:
+                stamp.extend([None, None])
+            else:
+                stamp.extend([st.st_mtime_ns, st.st_size])
+        return stamp
+
+    def _read_latest(self):
+        try:
+            with open(os.path.join(self.snapshot_dir, 'LATEST')) as f:
+                latest = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(os.path.join(self.snapshot_dir, latest['file'])):
+            return None
+        return latest
+
+    def _write_latest(self, latest):
+        filename = os.path.join(self.snapshot_dir, 'LATEST')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(latest, f)
+        os.replace(filename + '.tmp', filename)
+
+    def _start_refresh(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._run_refresh, name='replica-refresh', daemon=True).start()
+
+    def _run_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            if self.logger is not None:
+                self.logger.exception('Failed to refresh read replica')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _create_engine(self, path, immutable):
+        url = 'sqlite:///file:%s?mode=ro%s&uri=true' % (path, '&immutable=1' if immutable else '')
+        engine = create_engine(url, poolclass=QueuePool, connect_args=dict(check_same_thread=False), **self._pool)
+        return setup_sqlite_engine(engine, self._pragmas, 'deferred')
+
+
+def read_engine():
+    """当前请求读取数据使用的引擎，返回None时使用主库"""
+    if not has_request_context() or request.method not in READ_METHODS:
+        return None
+    if 'read_engine' not in g:
+        replica = current_app.extensions.get('read_replica')
+        engine, data_time = None, None
+        if replica is not None:
+            engine, data_time = replica.engine()
+            wrote_at = session.get(WROTE_AT_KEY)
+            sticky = current_app.config['SQLITE_REPLICA_STICKY']
+            if engine is not None and wrote_at is not None and data_time < wrote_at + sticky:
+                engine, data_time = None, None  # 副本中还没有该用户刚写入的数据
+        g.read_engine, g.read_data_time = engine, data_time
+    return g.read_engine
+
+
+def read_data_time():
+    """当前请求读到的数据的时间，读主库时返回None"""
+    return g.get('read_data_time') if has_request_context() else None
+
+
+#快照目录中的文件锁，多个worker依次刷新
+@contextmanager
+def file_lock(path):
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)  # 关闭文件时释放
+        yield
+
+
+def note_write():
+    """当前请求修改了数据，请求成功时该用户暂时读主库"""
+    if has_request_context():
+        g.wrote_data = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def on_commit(session):
+    note_write()
+
+
+#after_request钩子，登录用户成功修改数据的请求之后该用户暂时读主库
+def remember_write(response):
+    if g.pop('wrote_data', False) and response.status_code < 400 and current_user.is_authenticated:
+        session[WROTE_AT_KEY] = time.time()
+    return response
+
+
+def init_replica(app):
+    config = app.config
+    mode = config['SQLITE_READ_REPLICA']
+    if mode not in ('readonly', 'snapshot'):
+        return
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.drivername != 'sqlite' or url.database in (None, '', ':memory:'):
+        return  # 内存数据库没有副本
+    replica = ReadReplica(os.path.abspath(url.database), mode, config['SQLITE_REPLICA_MAX_AGE'],
+                          config['SQLITE_PRAGMAS'], config['SQLITE_POOL_SIZE'], config['SQLITE_POOL_OVERFLOW'],
+                          config['SQLITE_SNAPSHOT_DIR'], app.logger)
+    app.extensions['read_replica'] = replica
+    app.after_request(remember_write)
+    if mode == 'snapshot':
+        atexit.register(replica.close)
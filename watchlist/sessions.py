@@ -0,0 +1,271 @@
+# 会话和登录用户的加载方式(SESSION_BACKEND)：
+#   cookie  Flask默认的签名cookie会话，每个请求按会话中的用户ID从user_cache读取用户(缓存过期后查询用户表)
+#   token   仍然是签名cookie，登录时把用户的显示字段(id、name、username)和版本戳写进会话，
+#           GET请求直接用这些字段构造current_user，不读取用户表也不占用户缓存；
+#           修改数据的请求和字段超过SESSION_USER_TTL秒的GET请求重新读取用户并核对版本戳，
+#           版本戳由密码哈希和用户名计算，改了密码(flask admin)之后其他地方登录的会话随之失效
+#   memory  服务端会话：cookie中只有签名的会话id，会话数据(包括flash消息)保存在进程内的LRU中(SESSION_STORE_SIZE)，
+#           只适合单个worker
+#   sqlite  服务端会话，保存在本地SQLite文件SESSION_DB中，多个worker共享。
+#           服务端会话可以撤销：flask revoke-sessions删除一个用户的全部会话，flask admin修改密码时也会撤销
+# 服务端会话同样在会话中保存用户字段，GET请求只读一次会话存储。
+# 会话在PERMANENT_SESSION_LIFETIME之后过期，剩余时间不到一半时延长；登录和登出时更换会话id，旧的会话删除。
+import hashlib
+import hmac
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from flask_login import user_logged_in, user_logged_out
+from itsdangerous import BadSignature, Signer
+
+from watchlist.database import READ_METHODS
+
+#会话中保存用户字段的键
+USER_KEY = '_user'
+USER_FIELDS = ('id', 'name', 'username')
+SERVER_BACKENDS = ('memory', 'sqlite')
+
+
+def _embeds_user():
+    return current_app.config['SESSION_BACKEND'] in ('token',) + SERVER_BACKENDS
+
+
+def user_stamp(user):
+    """用户的版本戳，密码或用户名改变后随之改变；用密钥做HMAC，cookie中看不出密码哈希的任何信息"""
+    message = '%s\0%s' % (user.passwd_hash or '', user.username or '')
+    return hmac.new(current_app.secret_key.encode('utf-8'), message.encode('utf-8'), hashlib.sha1).hexdigest()[:16]
+
+
+def remember_user(user):
+    """把用户字段写进会话，登录和修改用户信息之后调用，cookie模式下什么也不做"""
+    if not _embeds_user():
+        return
+    data = dict((field, getattr(user, field)) for field in USER_FIELDS)
+    data.update(stamp=user_stamp(user), at=int(time.time()))
+    session[USER_KEY] = data
+
+
+def session_user(user_id):
+    """Flask-Login的user_loader，见watchlist/__init__.py"""
+    from watchlist.cache import attach_user, user_cache
+    data = session.get(USER_KEY) if _embeds_user() else None
+    if data is None or data['id'] != user_id:
+        return user_cache.get(user_id)
+    if request.method in READ_METHODS and time.time() - data['at'] < current_app.config['SESSION_USER_TTL']:
+        return attach_user(dict((field, data[field]) for field in USER_FIELDS))  # 其他列用到时才查询
+    user = user_cache.get(user_id)
+    if user is None or user_stamp(user) != data['stamp']:
+        # 用户已经删除或者改了密码，退出登录，之后的GET请求也不再使用会话中的字段
+        session.pop(USER_KEY, None)
+        session.pop('_user_id', None)
+        return None
+    remember_user(user)
+    return user
+
+
+def _logged_in(app, user):
+    if isinstance(session, ServerSession):
+        session.regenerate()
+    remember_user(user)
+
+
+def _logged_out(app, user):
+    session.pop(USER_KEY, None)
+    if isinstance(session, ServerSession):
+        session.regenerate()
+
+
+class ServerSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None, expires=None):
+        SecureCookieSession.__init__(self, initial)
+        self.sid = sid
+        self.expires = expires
+        self.old_sid = None
+
+    def regenerate(self):
+        """换一个新的会话id，保存时删除旧的，防止会话固定攻击"""
+        if self.sid is not None:
+            self.old_sid, self.sid = self.sid, None
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()  # 与Flask的cookie会话相同，flash消息中的元组可以原样保存
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='watchlist-session') if app.secret_key else None
+
+    def open_session(self, app, request):
+        signer = self._signer(app)
+        if signer is None:
+            return None
+        value = request.cookies.get(self.get_cookie_name(app))
+        if value:
+            try:
+                sid = signer.unsign(value).decode('ascii')
+            except BadSignature:
+                sid = None
+            entry = self.store.get(sid) if sid else None
+            if entry is not None:
+                return ServerSession(self.serializer.loads(entry[0]), sid, entry[1])
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        if session.old_sid is not None:
+            self.store.delete(session.old_sid)
+            session.old_sid = None
+        if not session:
+            if session.sid is not None:  # 会话被清空
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite,
+                                       httponly=httponly)
+            return
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if not session.modified and session.sid is not None and session.expires - now > lifetime / 2:
+            return  # 没有修改，离过期还早，不写存储
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(24)
+        user_id = session.get('_user_id')
+        self.store.set(session.sid, int(user_id) if user_id is not None else None,
+                       self.serializer.dumps(dict(session)), now + lifetime)
+        response.set_cookie(name, self._signer(app).sign(session.sid).decode('ascii'),
+                            expires=self.get_expiration_time(app, session), httponly=httponly, domain=domain,
+                            path=path, secure=secure, samesite=samesite)
+        response.vary.add('Cookie')
+
+
+#进程内的会话存储，超出容量时淘汰最久未使用的会话
+class MemorySessionStore(object):
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # sid -> (user_id, 数据, 过期时间)
+
+    def get(self, sid):
+        """返回(数据, 过期时间)，不存在或者已经过期时返回None"""
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self._sessions[sid]
+                return None
+            self._sessions.move_to_end(sid)
+            return entry[1], entry[2]
+
+    def set(self, sid, user_id, data, expires):
+        with self._lock:
+            self._sessions[sid] = (user_id, data, expires)
+            self._sessions.move_to_end(sid)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def delete_user(self, user_id):
+        """删除一个用户的全部会话，返回删除的个数"""
+        with self._lock:
+            sids = [sid for sid, entry in self._sessions.items() if entry[0] == user_id]
+            for sid in sids:
+                del self._sessions[sid]
+            return len(sids)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+#多个worker共享的会话存储，每个线程一个连接，过期的会话定期删除
+class SqliteSessionStore(object):
+    def __init__(self, path, sweep_interval=60):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = 0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS session (sid TEXT PRIMARY KEY, user_id INTEGER, '
+                               'data TEXT NOT NULL, expires REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_session_user_id ON session (user_id)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_session_expires ON session (expires)')
+            self._local.connection = connection
+        return connection
+
+    def get(self, sid):
+        row = self._connection().execute('SELECT data, expires FROM session WHERE sid = ? AND expires > ?',
+                                         (sid, time.time())).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def set(self, sid, user_id, data, expires):
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO session (sid, user_id, data, expires) VALUES (?, ?, ?, ?)',
+                           (sid, user_id, data, expires))
+        now = time.time()
+        if now >= self._next_sweep:
+            connection.execute('DELETE FROM session WHERE expires <= ?', (now,))
+            self._next_sweep = now + self.sweep_interval
+
+    def delete(self, sid):
+        self._connection().execute('DELETE FROM session WHERE sid = ?', (sid,))
+
+    def delete_user(self, user_id):
+        return self._connection().execute('DELETE FROM session WHERE user_id = ?', (user_id,)).rowcount
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM session').fetchone()[0]
+
+
+def get_session_store():
+    """服务端会话的存储，cookie和token模式下返回None"""
+    if 'session_store' not in current_app.extensions:
+        current_app.extensions['session_store'] = _create_store(current_app.config)
+    return current_app.extensions['session_store']
+
+
+def _create_store(config):
+    if config['SESSION_BACKEND'] == 'sqlite':
+        return SqliteSessionStore(config['SESSION_DB'])
+    if config['SESSION_BACKEND'] == 'memory':
+        return MemorySessionStore(config['SESSION_STORE_SIZE'])
+    return None
+
+
+def revoke_sessions(user_id):
+    """删除一个用户的全部服务端会话，返回删除的个数，没有服务端会话时返回None"""
+    store = get_session_store()
+    return store.delete_user(user_id) if store is not None else None
+
+
+def init_sessions(app):
+    backend = app.config['SESSION_BACKEND']
+    if backend not in ('token',) + SERVER_BACKENDS:
+        return
+    if backend in SERVER_BACKENDS:
+        store = app.extensions['session_store'] = _create_store(app.config)
+        app.session_interface = ServerSessionInterface(store)
+    user_logged_in.connect(_logged_in, app)
+    user_logged_out.connect(_logged_out, app)
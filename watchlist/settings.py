@@ -0,0 +1,113 @@
+# 默认配置，create_app()中通过app.config.from_object加载，大部分可以用环境变量覆盖
+import os
+import sys
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#判断系统类型并做出前缀的改变
+WIN = sys.platform.startswith('win')
+if WIN:
+    prefix = "sqlite:///"
+else:
+    prefix = "sqlite:////"
+
+SECRET_KEY = os.getenv('SECRET_KEY', 'dev') # app.secrect_key = 'dev',从环境变量中读取密钥
+# windows系统sqlite:///，其他系统sqlite:////
+SQLALCHEMY_DATABASE_URI = prefix + os.path.join(basedir, os.getenv('DATABASE_FILE', 'data.db'))
+SQLALCHEMY_TRACK_MODIFICATIONS = False  # 关闭对模型修改的监控
+# SQLite调优，说明见watchlist/database.py
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',       # 读写互不阻塞
+    'synchronous': 'NORMAL',     # WAL模式下只在checkpoint时fsync
+    'cache_size': -64000,        # 每个连接64MB页缓存
+    'mmap_size': 268435456,      # 256MB内存映射读取
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)),  # 等待锁的毫秒数
+}
+SQLITE_WRITE_LOCK = os.getenv('SQLITE_WRITE_LOCK', 'immediate')  # immediate或deferred
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', 5))  # 每个worker的连接数，与线程数一致
+SQLITE_POOL_OVERFLOW = int(os.getenv('SQLITE_POOL_OVERFLOW', 5))
+# 读副本，说明见watchlist/replica.py
+SQLITE_READ_REPLICA = os.getenv('SQLITE_READ_REPLICA', 'none')  # none、readonly或snapshot
+SQLITE_REPLICA_MAX_AGE = float(os.getenv('SQLITE_REPLICA_MAX_AGE', 5))  # 快照最多落后主库的秒数
+SQLITE_REPLICA_STICKY = float(os.getenv('SQLITE_REPLICA_STICKY', 1))  # 写入之后，副本至少要新这么多秒才给该用户读
+SQLITE_SNAPSHOT_DIR = os.getenv('SQLITE_SNAPSHOT_DIR', os.path.join(basedir, '.snapshots'))
+# 结构迁移每批处理的行数和每秒最多处理的行数(0表示不限速)，说明见watchlist/migrations.py
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', 1000))
+MIGRATION_ROWS_PER_SECOND = int(os.getenv('MIGRATION_ROWS_PER_SECOND', 20000))
+# 写合并：网页上的修改由一个写线程每隔WRITE_BATCH_INTERVAL毫秒合并提交，说明见watchlist/writes.py
+WRITE_BEHIND = os.getenv('WRITE_BEHIND') == '1'
+WRITE_BATCH_INTERVAL = int(os.getenv('WRITE_BATCH_INTERVAL', 10))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 500))  # 攒够这么多个修改时不再等待
+# 后台任务：flask worker启动的线程数和队列为空时查询的间隔秒数，说明见watchlist/jobs.py
+JOB_THREADS = int(os.getenv('JOB_THREADS', 2))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))  # 包括第一次执行
+JOB_RETRY_DELAY = float(os.getenv('JOB_RETRY_DELAY', 5))  # 第一次重试之前等待的秒数，之后每次翻倍
+JOB_RETRY_MAX_DELAY = float(os.getenv('JOB_RETRY_MAX_DELAY', 600))
+JOB_LEASE = float(os.getenv('JOB_LEASE', 60))  # worker这么多秒没有心跳时，它正在执行的任务交给其他worker
+JOB_KEEP = float(os.getenv('JOB_KEEP', 7 * 24 * 3600))  # 结束的任务保留的秒数
+MOVIES_PER_PAGE = int(os.getenv('MOVIES_PER_PAGE', 50))  # 主页每页显示的电影条数
+INDEX_STREAM = os.getenv('INDEX_STREAM') == '1'  # 主页默认使用流式渲染
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))  # 用户缓存的过期秒数，0表示不缓存；命令行修改用户后网页最多这么久才生效
+# 会话：cookie、token、memory或sqlite，说明见watchlist/sessions.py
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'cookie')
+SESSION_USER_TTL = int(os.getenv('SESSION_USER_TTL', 300))  # 会话中的用户字段超过这么多秒后重新核对
+SESSION_STORE_SIZE = int(os.getenv('SESSION_STORE_SIZE', 100000))  # memory模式最多保存的会话数量
+SESSION_DB = os.getenv('SESSION_DB', os.path.join(basedir, '.sessions.db'))
+# 电影目录：主页的列表和总数从内存映射文件中读取，说明见watchlist/catalogue.py
+CATALOGUE = os.getenv('CATALOGUE') == '1'
+CATALOGUE_DIR = os.getenv('CATALOGUE_DIR', os.path.join(basedir, '.catalogue'))
+CATALOGUE_DELTA_SIZE = int(os.getenv('CATALOGUE_DELTA_SIZE', 10000))  # 增量部分超过这么多部电影时重新生成
+# 页面缓存：memory为进程内缓存，file为多个worker共享的文件缓存，none关闭缓存；
+# 两种缓存的版本号都保存在PAGE_CACHE_DIR中，一个worker修改数据后所有worker的缓存都失效
+PAGE_CACHE_BACKEND = os.getenv('PAGE_CACHE_BACKEND', 'memory')
+PAGE_CACHE_DIR = os.getenv('PAGE_CACHE_DIR', os.path.join(basedir, '.page_cache'))
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', 256))  # 最多缓存的页面数量
+# 密码哈希方法和迭代次数，修改后旧的哈希会在用户下次登录时重新计算
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+LOGIN_VERIFY_WORKERS = int(os.getenv('LOGIN_VERIFY_WORKERS', 2))  # 同时校验密码的数量
+LOGIN_VERIFY_QUEUE = int(os.getenv('LOGIN_VERIFY_QUEUE', 8))  # 排队等待校验的数量，超出时返回429
+LOGIN_VERIFY_EXECUTOR = os.getenv('LOGIN_VERIFY_EXECUTOR', 'thread')  # thread或process
+LOGIN_RETRY_AFTER = int(os.getenv('LOGIN_RETRY_AFTER', 1))  # 429响应的Retry-After秒数
+# 模板加载方式：source、bytecode或compiled，说明见watchlist/jinja.py
+TEMPLATES_MODE = os.getenv('TEMPLATES_MODE', 'source')
+TEMPLATES_CACHE_DIR = os.getenv('TEMPLATES_CACHE_DIR', os.path.join(basedir, '.template_cache'))
+TEMPLATES_COMPILED_DIR = os.getenv('TEMPLATES_COMPILED_DIR', os.path.join(basedir, '.compiled_templates'))
+TEMPLATES_AUTO_RELOAD = {'1': True, '0': False}.get(os.getenv('TEMPLATES_AUTO_RELOAD'))  # 缺省时只在debug模式下检查
+FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', 10000))  # 缓存的电影条目片段数量
+URL_CACHE = os.getenv('URL_CACHE') != '0'  # 模板中的url_for使用缓存的URL模板，见watchlist/urls.py
+# 构建后的静态文件，说明见watchlist/assets.py
+ASSETS_DIR = os.getenv('ASSETS_DIR', os.path.join(basedir, '.assets'))
+ASSETS_MAX_AGE = int(os.getenv('ASSETS_MAX_AGE', 31536000))  # 带哈希的静态文件缓存一年
+# 响应压缩，说明见watchlist/compress.py
+COMPRESS_ALGORITHMS = [a for a in os.getenv('COMPRESS_ALGORITHMS', 'br,zstd,gzip').split(',') if a]  # 按优先级排列，为空时关闭
+COMPRESS_MIMETYPES = frozenset(['text/html', 'text/css', 'text/plain', 'text/xml', 'application/json',
+                                'application/javascript', 'image/svg+xml'])
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 500))  # 小于这个字节数的响应不压缩
+COMPRESS_FLUSH_SIZE = int(os.getenv('COMPRESS_FLUSH_SIZE', 16384))  # 流式响应每积累这么多字节flush一次
+COMPRESS_LEVEL_GZIP = int(os.getenv('COMPRESS_LEVEL_GZIP', 6))
+COMPRESS_LEVEL_BR = int(os.getenv('COMPRESS_LEVEL_BR', 4))
+COMPRESS_LEVEL_ZSTD = int(os.getenv('COMPRESS_LEVEL_ZSTD', 3))
+# 限流和并发上限，说明见watchlist/ratelimit.py
+RATELIMIT_BACKEND = os.getenv('RATELIMIT_BACKEND', 'memory')  # memory、sqlite或none
+RATELIMIT_DB = os.getenv('RATELIMIT_DB', os.path.join(basedir, '.ratelimit.db'))
+RATELIMIT_SIZE = int(os.getenv('RATELIMIT_SIZE', 100000))  # 进程内最多保存的令牌桶数量
+RATELIMIT_RULES = {  # endpoint -> 限额，只限制修改数据的请求
+    'login': '10/minute',
+    'index': '30/minute',
+    'edit': '60/minute',
+    'delete': '60/minute',
+    'settings': '10/minute',
+    'api_create_movie': '120/minute',
+    'api_update_movie': '120/minute',
+    'api_delete_movie': '120/minute',
+    'api_batch': '10/minute',
+}
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', 128))  # 同时处理的请求数上限，0表示不限制
+MAX_CONCURRENT_WRITES = int(os.getenv('MAX_CONCURRENT_WRITES', 16))  # 同时处理的写请求数上限
+OVERLOAD_RETRY_AFTER = int(os.getenv('OVERLOAD_RETRY_AFTER', 1))  # 503响应的Retry-After秒数
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 32))  # 以ASGI方式运行时执行视图的线程数，见watchlist/asgi.py
+# 请求性能分析，说明见watchlist/profiling.py
+PROFILE_ENABLED = os.getenv('PROFILE_ENABLED') == '1'
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0.01))  # 抽样比例
+PROFILE_TRACEMALLOC = os.getenv('PROFILE_TRACEMALLOC') == '1'  # 统计内存分配
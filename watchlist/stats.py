@@ -0,0 +1,79 @@
+# 观影统计：按年份和年代的电影数、最近添加的电影
+#
+# 按年份的计数保存在movie_year_stat表中，由触发器增量维护(见models.MOVIE_STATS_DDL)，
+# 年代由年份的计数在Python中汇总，最近添加的电影按(user_id, id)索引倒序读取前几条，
+# 所以统计页面的代价与年份的个数和显示的条数有关，与电影总数无关。
+# 触发器出错或者直接改过数据库之后，用flask rebuild-stats分批重新计算。
+import time
+
+from sqlalchemy import text
+
+from watchlist import db
+
+RECENT_MOVIES = 10
+
+
+def year_counts(user_id):
+    """[(年份, 电影数)]，按年份排序"""
+    return [tuple(row) for row in db.session.execute(
+        text('SELECT year, count FROM movie_year_stat WHERE user_id = :user_id ORDER BY year'), dict(user_id=user_id))]
+
+
+def decade_of(year):
+    """'1994' -> '1990s'，不是四位数字的年份归为'Other'"""
+    return year[:3] + '0s' if len(year) == 4 and year.isdigit() else 'Other'
+
+
+def decade_counts(years):
+    decades = {}
+    for year, count in years:
+        decade = decade_of(year)
+        decades[decade] = decades.get(decade, 0) + count
+    return sorted(decades.items())
+
+
+def recent_movies(user_id, limit=RECENT_MOVIES):
+    return db.session.execute(text('SELECT id, title, year FROM movie WHERE user_id = :user_id ORDER BY id DESC '
+                                   'LIMIT :limit'), dict(user_id=user_id, limit=limit)).fetchall()
+
+
+def owner_stats(user_id, recent=RECENT_MOVIES):
+    """一个用户的全部统计，供统计页面和API使用"""
+    years = year_counts(user_id) if user_id is not None else []
+    return dict(total=sum(count for year, count in years), years=years, decades=decade_counts(years),
+                recent=recent_movies(user_id, recent) if user_id is not None else [])
+
+
+def rebuild_stats(m):
+    """在Migrator上分批重新计算movie_year_stat，返回计入的电影数
+    每个用户的统计在一个事务中整体重算，和触发器的增量更新不会冲突；
+    一个事务中依次处理多个用户，直到累计超过batch_size部电影"""
+    position, total = None, 0
+    while True:
+        start = time.time()
+        rows = 0
+        with m.transaction():
+            while rows < m.batch_size:
+                user_id = _next_user(m, position)
+                if user_id is None:
+                    break
+                m.execute('DELETE FROM movie_year_stat WHERE user_id = ?', (user_id,))
+                m.execute("INSERT INTO movie_year_stat (user_id, year, count) SELECT user_id, coalesce(year, ''), count(*) "
+                          "FROM movie WHERE user_id = ? GROUP BY coalesce(year, '')", (user_id,))
+                rows += m.scalar('SELECT coalesce(sum(count), 0) FROM movie_year_stat WHERE user_id = ?', (user_id,))
+                position = user_id
+        total += rows
+        if m.progress is not None:
+            m.progress('stats', total)
+        if user_id is None:
+            return total
+        m.throttle(rows, time.time() - start)
+
+
+#下一个有电影或者有统计的用户，两边都按索引查找
+def _next_user(m, position):
+    if position is None:
+        return m.scalar('SELECT min(user_id) FROM (SELECT min(user_id) AS user_id FROM movie '
+                        'UNION ALL SELECT min(user_id) FROM movie_year_stat)')
+    return m.scalar('SELECT min(user_id) FROM (SELECT min(user_id) AS user_id FROM movie WHERE user_id > ? '
+                    'UNION ALL SELECT min(user_id) FROM movie_year_stat WHERE user_id > ?)', (position, position))
@@ -0,0 +1,37 @@
+# 后台任务函数，由flask worker执行(见watchlist/jobs.py)，
+# 放进队列的地方：flask initdb/forge/rebuild-stats/build-catalogue的--background选项，以及API批量操作的?background=1
+from watchlist.api import BatchError, apply_batch
+from watchlist.catalogue import get_catalogue_store
+from watchlist.commands import forge_data, init_database, recompute_stats
+from watchlist.jobs import JobError, task
+
+
+@task('initdb')
+def initdb_task(job, drop=False):
+    init_database(drop)
+
+
+@task('forge')
+def forge_task(job, count):
+    return dict(movies=forge_data(count, progress=lambda done: job.progress(done, count)))
+
+
+@task('rebuild-stats')
+def rebuild_stats_task(job, batch_size=None, rows_per_second=None):
+    return dict(movies=recompute_stats(batch_size, rows_per_second, lambda name, total: job.progress(total)))
+
+
+@task('build-catalogue')
+def build_catalogue_task(job):
+    store = get_catalogue_store()
+    if store is None:
+        raise JobError('The catalogue needs CATALOGUE=1 and a database file')
+    return dict(movies=store.rebuild())
+
+
+@task('batch')
+def batch_task(job, operations):
+    try:
+        return dict(results=apply_batch(job.user_id, operations))
+    except BatchError as e:
+        raise JobError(str(e))  # 操作本身不合法，重试也不会成功
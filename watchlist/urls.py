@@ -0,0 +1,116 @@
+# URL规则和错误处理函数，视图模块在第一次请求时才导入
+from flask import current_app, has_request_context, request, url_for
+from werkzeug.utils import cached_property, import_string
+
+#URL规则：路径、endpoint、视图函数的导入路径、请求方法
+URL_RULES = [
+    ('/', 'index', 'watchlist.views.index', ['GET', 'POST']),
+    ('/user/<username>', 'user_index', 'watchlist.views.user_index', ['GET']),
+    ('/login', 'login', 'watchlist.views.login', ['GET', 'POST']),
+    ('/logout', 'logout', 'watchlist.views.logout', ['GET']),
+    ('/settings', 'settings', 'watchlist.views.settings', ['GET', 'POST']),
+    ('/movie/edit/<int:movie_id>', 'edit', 'watchlist.views.edit', ['GET', 'POST']),
+    ('/movie/delete/<int:movie_id>', 'delete', 'watchlist.views.delete', ['POST']),
+    ('/search', 'search', 'watchlist.views.search', ['GET']),
+    ('/stats', 'stats', 'watchlist.views.stats', ['GET']),
+    ('/api/v1/movies', 'api_list_movies', 'watchlist.api.list_movies', ['GET']),
+    ('/api/v1/movies', 'api_create_movie', 'watchlist.api.create_movie', ['POST']),
+    ('/api/v1/movies/batch', 'api_batch', 'watchlist.api.batch', ['POST']),
+    ('/api/v1/movies/<int:movie_id>', 'api_get_movie', 'watchlist.api.get_movie', ['GET']),
+    ('/api/v1/movies/<int:movie_id>', 'api_update_movie', 'watchlist.api.update_movie', ['PATCH']),
+    ('/api/v1/movies/<int:movie_id>', 'api_delete_movie', 'watchlist.api.delete_movie', ['DELETE']),
+    ('/api/v1/stats', 'api_stats', 'watchlist.api.stats', ['GET']),
+    ('/jobs/<int:job_id>', 'job_status', 'watchlist.api.job_status', ['GET']),
+    ('/_metrics', 'metrics', 'watchlist.profiling.metrics', ['GET']),
+]
+
+#错误码和对应的错误处理函数
+ERROR_HANDLERS = [
+    (400, 'watchlist.errors.bad_request'),
+    (404, 'watchlist.errors.page_not_found'),
+    (429, 'watchlist.errors.too_many_requests'),
+    (500, 'watchlist.errors.internal_server_error'),
+]
+
+
+#延迟导入的视图函数，命令行工具和只做健康检查的worker不需要加载视图和模板
+class LazyView(object):
+    def __init__(self, import_name):
+        self.__module__, self.__name__ = import_name.rsplit('.', 1)
+        self.import_name = import_name
+
+    @cached_property
+    def view(self):
+        return import_string(self.import_name)
+
+    def __call__(self, *args, **kwargs):
+        return self.view(*args, **kwargs)
+
+
+#模板中的url_for：同一个endpoint、同一组参数名只用werkzeug生成一次URL，整数参数先用占位数字生成，
+#再换成%(name)d，之后的调用只做字符串格式化；字符串参数的值作为键的一部分，整个URL缓存下来。
+#URL规则在worker运行期间不变，缓存不需要失效。URL_CACHE=0时关闭，直接调用Flask的url_for
+URL_SENTINEL = 987654321000
+_MISSING = object()
+
+
+class UrlCache(object):
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._templates = {}  # (script_root, endpoint, 参数) -> URL模板，None表示不能缓存
+
+    def build(self, endpoint, values):
+        if not has_request_context():
+            return url_for(endpoint, **values)
+        key = [request.script_root, endpoint]
+        ints = {}
+        for name, value in sorted(values.items()):
+            if type(value) is int:
+                key.append(name)
+                ints[name] = value
+            elif isinstance(value, str) and not name.startswith('_'):  # _external、_anchor等交给url_for
+                key.append((name, value))
+            else:
+                return url_for(endpoint, **values)
+        key = tuple(key)
+        template = self._templates.get(key, _MISSING)
+        if template is _MISSING:
+            template = self._compile(endpoint, values, ints)
+            if len(self._templates) < self.max_entries:
+                self._templates[key] = template
+        if template is None:
+            return url_for(endpoint, **values)
+        return template % ints
+
+    def _compile(self, endpoint, values, ints):
+        sentinels = dict((name, URL_SENTINEL + i) for i, name in enumerate(ints))
+        url = url_for(endpoint, **dict(values, **sentinels)).replace('%', '%%')
+        for name, sentinel in sentinels.items():
+            if url.count(str(sentinel)) != 1:
+                return None  # 转换器改变了数字的写法，不能用占位数字替换
+            url = url.replace(str(sentinel), '%%(%s)d' % name)
+        return url
+
+    def __len__(self):
+        return len(self._templates)
+
+
+def get_url_cache():
+    cache = current_app.extensions.get('url_cache')
+    if cache is None:
+        cache = current_app.extensions['url_cache'] = UrlCache()
+    return cache
+
+
+def cached_url_for(endpoint, **values):
+    """与url_for相同，模板中的url_for使用这个函数"""
+    if not current_app.config['URL_CACHE']:
+        return url_for(endpoint, **values)
+    return get_url_cache().build(endpoint, values)
+
+
+def register_urls(app):
+    for rule, endpoint, import_name, methods in URL_RULES:
+        app.add_url_rule(rule, endpoint, view_func=LazyView(import_name), methods=methods)
+    for code, import_name in ERROR_HANDLERS:
+        app.register_error_handler(code, LazyView(import_name))
@@ -1,13 +1,27 @@
-# 视图函数
+# 视图函数，URL规则见watchlist/urls.py
 
-from flask import render_template, redirect, request, url_for, flash
+from flask import abort, current_app, render_template, redirect, request, url_for, flash, jsonify, Response, stream_with_context
 from flask_login import  login_user, login_required, logout_user, current_user
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+from watchlist import db, page_owner
+from watchlist.models import User, Movie, valid_movie
+from watchlist.database import read_transaction
+from watchlist.passwords import rehash_passwd, verify_passwd
+from watchlist.cache import user_cache, cached_page, invalidate_pages, attach_user
+from watchlist.asgi import prefetched
+from watchlist.writes import get_write_queue, pending_writes, pending_movie, apply_pending
+from watchlist.catalogue import get_catalogue, catalogue_changed
+from watchlist.stats import owner_stats
+from watchlist.sessions import remember_user
+
+#流式渲染模板，模板按块生成，首字节在读完全部数据之前就能发出
+def stream_template(template_name, **context):
+    current_app.update_template_context(context)  # 注入上下文处理器(inject_user等)提供的变量
+    template = current_app.jinja_env.get_template(template_name)
+    return template.generate(context)
 
 #登陆函数
-@app.route('/login',methods=['GET','POST'])
+@read_transaction  # 校验密码比较慢，不在这期间占住SQLite的写锁
 def login():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -17,8 +31,16 @@ def login():
             flash("Invalid input")
             return redirect(url_for('login'))
 
-        user = User.query.first()
-        if  username == user.username and user.check_passwd(passwd):
+        data = prefetched('user')  # 以ASGI方式运行时已经用异步引擎查询好了
+        if data is not None and data['username'] == username:
+            user = attach_user(data)
+        else:
+            user = User.query.filter_by(username=username).first()  # username上有唯一索引
+        if user is not None and verify_passwd(user, passwd):  # 在有界的线程池中校验密码，请求线程等待结果
+            # 哈希参数已经过时，用新参数重新计算，同样受线程池的数量限制
+            if user.passwd_needs_rehash() and rehash_passwd(user, passwd):
+                db.session.commit()
+                user_cache.invalidate(user.id)
             login_user(user)
             flash("Login success.")
             return redirect(url_for('index'))
@@ -28,14 +50,12 @@ def login():
     return render_template('login.html')
 
 #登出函数
-@app.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash("Goodbye")
     return redirect(url_for('index'))
 
-@app.route('/settings', methods = ['GET','POST'])
 @login_required
 def settings():
     if request.method == 'POST':
@@ -49,11 +69,13 @@ def settings():
         # user = User.query.first()
         # user.name = name
         db.session.commit()
+        user_cache.invalidate(current_user.id)
+        remember_user(current_user)  # 会话中保存的用户名也要更新
+        invalidate_pages()  # 页面标题中显示了用户名
         flash('Settings updated!')
         return redirect(url_for('index'))
     return render_template('settings.html')
 
-@app.route('/',methods=['POST','GET'])
 #@login_required 因为新建条目的函数需要同时处理显示index页面的get请求和新建电影条目的post请求,因此在post请求中处理权限过滤
 def index():
    # user = User.query.first()  #读取第一个用户
@@ -65,43 +87,147 @@ def index():
         title = request.form.get('title')
         year = request.form.get('year')
         #验证数据
-        if not title or not year or len(year) > 4 or len(title) > 60:  #在inut中进行验证不可靠，服务器中追加验证
+        if not valid_movie(title, year):  #在inut中进行验证不可靠，服务器中追加验证
             flash("Invalid input")
             return redirect(url_for('index'))
-        movie = Movie(title=title,year=year)
-        db.session.add(movie)
-        db.session.commit()
+        writes = get_write_queue()
+        if writes is not None:  # 写合并模式，由写线程合并提交
+            writes.submit('create', current_user.id, title=title, year=year)
+        else:
+            movie = Movie(title=title,year=year,user_id=current_user.id)
+            db.session.add(movie)
+            db.session.commit()
+            catalogue_changed(current_user.id, movie.id)
+            invalidate_pages()
         flash("Item created")
         return redirect(url_for('index'))
-    movies = Movie.query.all()  #读取所有的电影
-    return render_template('index.html',movies=movies)
+    return movie_list(page_owner())
+
+#某个用户公开的观影清单
+def user_index(username):
+    owner = User.query.filter_by(username=username).first_or_404()
+    return movie_list(owner)
+
+def movie_list(owner):
+    owner_id = owner.id if owner is not None else None
+    # 流式模式：用yield_per分批从数据库读取，边读边渲染，内存占用与表的大小无关
+    stream = request.args.get('stream', type=int)  # ?stream=1 开启，?stream=0 关闭
+    if stream is None:
+        stream = current_app.config['INDEX_STREAM']  # 缺省时看配置
+    if stream:
+        catalogue = get_catalogue()
+        if catalogue is not None:  # 从电影目录中逐条读取，不查询数据库
+            count, movies = catalogue.count(owner_id), catalogue.movies(owner_id)
+        else:
+            query = Movie.query.filter_by(user_id=owner_id)
+            count = query.count()
+            movies = query.order_by(Movie.id).yield_per(current_app.config['MOVIES_PER_PAGE'])
+        return Response(stream_with_context(stream_template('index.html', user=owner, movies=movies, count=count)),
+                        mimetype='text/html')
+    # 分页模式：渲染结果会被缓存，命中时直接返回缓存的页面或304
+    return cached_page(render_index, owner, request.args.get('after', 0, type=int))
+
+#按(user_id, id)索引做游标(keyset)分页，只读取一页数据，翻页代价与页码和其他用户的数据量无关
+def render_index(owner, after):
+    owner_id = owner.id if owner is not None else None
+    per_page = current_app.config['MOVIES_PER_PAGE']
+    writes = pending_writes(owner_id)  # 在读取数据库之前取出，说明见watchlist/writes.py
+    data = prefetched('index') if get_write_queue() is None else None
+    catalogue = get_catalogue()
+    if catalogue is not None:  # 列表和总数都从电影目录中读取，见watchlist/catalogue.py
+        count, movies = catalogue.count(owner_id), catalogue.page(owner_id, after, per_page + 1)
+    elif data is not None and data[:2] == (owner_id, after):
+        count, movies = data[2], [Movie(**row) for row in data[3]]
+    else:
+        query = Movie.query.filter_by(user_id=owner_id)
+        count = query.count()  # 只扫描索引中该用户的范围
+        movies = query.filter(Movie.id > after).order_by(Movie.id).limit(per_page + 1).all()
+    next_cursor = None
+    if len(movies) > per_page:  # 多读一条用来判断是否还有下一页
+        movies = movies[:per_page]
+        next_cursor = movies[-1].id
+    if writes:  # 叠加自己还没提交的修改
+        movies, count = apply_pending(writes, movies, count, next_cursor is None)
+    return render_template('index.html', user=owner, movies=movies, count=count, after=after, next_cursor=next_cursor)
 
 #编辑电影条目
-@app.route('/movie/edit/<int:movie_id>',methods=['POST','GET'])
 @login_required
 def edit(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
+    writes = get_write_queue()  # 写合并模式下请求只读取，不需要写锁，见writes.queued_requests_read_only()
+    data = prefetched('movie') if request.method == 'GET' and writes is None else None
+    if data is not None and data['user_id'] == current_user.id:
+        movie = Movie(**data)  # 预先查询的对象只用于显示
+    else:
+        pending = pending_writes(current_user.id)
+        movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()  # 只能编辑自己的电影
+        if pending and request.method == 'GET':
+            movie = pending_movie(pending, movie) or abort(404)
 
     if request.method == "POST":
         title = request.form.get('title')
         year = request.form.get('year')
-        if not title or not year or len(year) > 4 or len(title) > 60:
+        if not valid_movie(title, year):
             flash("Invalid input")
             return redirect(url_for('edit',movie_id=movie_id))
-        movie.title = title
-        movie.year = year
-        db.session.commit()
+        if writes is not None:
+            writes.submit('update', current_user.id, movie_id, title=title, year=year)
+        else:
+            movie.title = title
+            movie.year = year
+            db.session.commit()
+            catalogue_changed(current_user.id, movie_id)
+            invalidate_pages()
         flash("Item updated")
         return redirect(url_for("index"))
     return render_template('edit.html',movie=movie)
 
 #删除电影条目
-@app.route('/movie/delete/<int:movie_id>',methods=["POST"])
 @login_required
 def delete(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
-    db.session.delete(movie)
-    db.session.commit()
+    writes = get_write_queue()
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
+    if writes is not None:
+        writes.submit('delete', current_user.id, movie_id)
+    else:
+        db.session.delete(movie)
+        db.session.commit()
+        catalogue_changed(current_user.id, movie_id)
+        invalidate_pages()
     flash("Item deleted")
     return redirect(url_for("index"))
 
+
+#年份按字符串比较，只接受4位数字，其他值(比如99)的比较结果不对，返回400
+def year_arg(name):
+    value = request.args.get(name, '').strip()
+    if not value:
+        return None
+    if len(value) != 4 or not value.isascii() or not value.isdigit():
+        abort(400)
+    return int(value)
+
+#在当前页面所属用户的电影中搜索，支持HTML和JSON两种格式
+def search():
+    q = request.args.get('q', '').strip()
+    year_from = year_arg('from')
+    year_to = year_arg('to')
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))  # SQLite中负数的LIMIT表示不限制
+    if request.args.get('format') == 'json':
+        owner = page_owner()
+        movies = Movie.search(q, year_from, year_to, limit, owner.id if owner is not None else None)
+        return jsonify(q=q, movies=[dict(id=m.id, title=m.title, year=m.year) for m in movies])
+    return cached_page(render_search, q, year_from, year_to, limit)
+
+def render_search(q, year_from, year_to, limit):
+    owner = page_owner()
+    owner_id = owner.id if owner is not None else None
+    movies = Movie.search(q, year_from, year_to, limit, owner_id) if q or year_from or year_to else []
+    return render_template('search.html', q=q, year_from=year_from, year_to=year_to, movies=movies)
+
+#观影统计，只读取统计表和最近的几条电影，JSON格式见api.stats()
+def stats():
+    return cached_page(render_stats, page_owner())
+
+def render_stats(owner):
+    data = owner_stats(owner.id if owner is not None else None)
+    return render_template('stats.html', user=owner, **data)
@@ -0,0 +1,275 @@
+# 写合并(write-behind)：WRITE_BEHIND打开后，网页上的新建、编辑和删除电影不再各自提交一个事务，
+# 而是放入队列，由一个写线程每WRITE_BATCH_INTERVAL毫秒或者攒够WRITE_BATCH_SIZE个修改合并成一个事务提交，
+# 很多人同时编辑时，fsync从每次点击一次变成每批一次。
+#
+# 请求把修改放入队列后立即返回。还没有提交的修改按用户保存在覆盖层中，
+# 该用户的主页和编辑页面在读取数据库之后叠加这些修改，自己的修改马上就能看到；其他人和页面缓存在提交之后才看到。
+# 覆盖层在读取数据库之前取出，修改可以重复叠加(新建的电影提交后记下id，已经读到的不会再加一次)，
+# 这个顺序保证不会漏掉读取期间刚好提交的修改，所以这个模式下不使用ASGI入口预先查询的数据。
+#
+# 事务遇到database is locked/busy时退避后重试(最多RETRY_ATTEMPTS次)；合并的事务失败时逐个重试，
+# 仍然失败的修改记入日志并计数(failed，/_metrics中输出)，该用户的下一个页面上提示修改没有保存
+# (表单已经在请求中验证过，一般不会失败)。
+# API需要立即返回结果，仍然同步读写，之前先等当前用户在队列中的修改写完，保证读到自己的修改、修改的先后顺序不变。
+# 进程正常退出(atexit)和ASGI的lifespan shutdown时先把队列写完；进程被强制杀掉时，队列中还没提交的修改会丢失。
+import atexit
+import queue
+import threading
+import time
+
+from flask import current_app, flash, g, request
+from flask_login import current_user
+from sqlalchemy.exc import OperationalError
+
+from watchlist import db
+from watchlist.catalogue import changed_movies
+from watchlist.models import Movie
+from watchlist.replica import note_write
+
+#database is locked/busy时的重试次数和第一次重试前等待的秒数，之后每次加倍
+RETRY_ATTEMPTS = 3
+RETRY_DELAY = 0.05
+#提示用户时使用的动作名称
+FAILED_MESSAGES = dict(create='Item could not be created', update='Item could not be updated',
+                       delete='Item could not be deleted')
+
+
+#队列中的一个修改，action为create、update或delete，新建的电影提交后movie_id才有值
+class Write(object):
+    __slots__ = ('action', 'user_id', 'movie_id', 'values', 'committed')
+
+    def __init__(self, action, user_id, movie_id, values):
+        self.action = action
+        self.user_id = user_id
+        self.movie_id = movie_id
+        self.values = values
+        self.committed = False
+
+
+class WriteQueue(object):
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['WRITE_BATCH_INTERVAL'] / 1000.0
+        self.batch_size = app.config['WRITE_BATCH_SIZE']
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}  # user_id -> 还没有提交的Write列表
+        self._failures = {}  # user_id -> 没能写入、还没有提示用户的Write列表
+        self._thread = None
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+
+    def submit(self, action, user_id, movie_id=None, **values):
+        """把修改放入队列，立即返回"""
+        with self._lock:
+            write = Write(action, user_id, movie_id, values)
+            self._pending.setdefault(user_id, []).append(write)
+            if self._thread is None:  # 第一次写入时才启动写线程，命令行工具不需要
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        self._queue.put(write)
+        note_write()  # 读副本中暂时还没有这个修改
+        return write
+
+    def pending(self, user_id):
+        """该用户还没有提交的修改，按提交顺序排列"""
+        with self._lock:
+            return list(self._pending.get(user_id, ()))
+
+    def take_failures(self, user_id):
+        """取出该用户没能写入的修改"""
+        if not self._failures:
+            return []
+        with self._lock:
+            return self._failures.pop(user_id, [])
+
+    def flush(self, timeout=None):
+        """等待此前放入队列的修改全部提交"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        """写完队列中的修改，然后停止写线程"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        with self.app.app_context():
+            g.write_transaction = True  # 以BEGIN IMMEDIATE开始，见watchlist/database.py
+            while True:
+                batch, waiters, stop = self._collect()
+                if batch:
+                    self._write(batch)
+                for done in waiters:
+                    done.set()
+                if stop:
+                    return
+
+    #取出一批修改：等到第一个修改之后，再最多等interval秒或者攒够batch_size个，遇到flush和close时立即提交
+    def _collect(self):
+        batch, waiters = [], []
+        item = self._queue.get()
+        deadline = time.monotonic() + self.interval
+        while True:
+            if item is None:
+                return batch, waiters, True
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+                return batch, waiters, False
+            batch.append(item)
+            timeout = deadline - time.monotonic()
+            if len(batch) >= self.batch_size or timeout <= 0:
+                return batch, waiters, False
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                return batch, waiters, False
+
+    def _write(self, batch):
+        try:
+            try:
+                self._retry(batch)
+            except Exception:
+                db.session.rollback()
+                for write in batch:  # 逐个重试，找出失败的修改
+                    try:
+                        self._retry([write])
+                    except Exception:
+                        db.session.rollback()
+                        self.app.logger.exception('Failed to %s movie %s of user %s',
+                                                  write.action, write.movie_id, write.user_id)
+                        with self._lock:
+                            self._failures.setdefault(write.user_id, []).append(write)
+                            self.failed += 1
+        finally:
+            db.session.remove()
+            # 先更新电影目录再移出覆盖层，读取时不会两边都看不到
+            changed_movies([(write.user_id, write.movie_id) for write in batch if write.movie_id is not None])
+            with self._lock:
+                for write in batch:
+                    writes = self._pending.get(write.user_id)
+                    if writes is not None:
+                        writes.remove(write)
+                        if not writes:
+                            del self._pending[write.user_id]
+        from watchlist.cache import invalidate_pages
+        invalidate_pages()
+
+    #数据库暂时被锁住时退避后重试，其他错误直接抛出
+    def _retry(self, batch):
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                return self._apply(batch)
+            except OperationalError as e:
+                db.session.rollback()
+                message = str(e.orig).lower()
+                if attempt == RETRY_ATTEMPTS - 1 or ('locked' not in message and 'busy' not in message):
+                    raise
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+
+    def _apply(self, batch):
+        table = Movie.__table__
+        created = []
+        try:
+            for write in batch:
+                if write.action == 'create':
+                    # 提交之前就记下id，读取期间刚好提交时覆盖层能认出已经读到的电影
+                    result = db.session.execute(table.insert().values(user_id=write.user_id, **write.values))
+                    write.movie_id = result.inserted_primary_key[0]
+                    created.append(write)
+                elif write.action == 'update':
+                    db.session.execute(table.update().values(**write.values)
+                                       .where(table.c.id == write.movie_id, table.c.user_id == write.user_id))
+                else:
+                    db.session.execute(table.delete().where(table.c.id == write.movie_id, table.c.user_id == write.user_id))
+            db.session.commit()
+        except Exception:
+            for write in created:
+                write.movie_id = None
+            raise
+        for write in batch:
+            write.committed = True
+        self.batches += 1
+        self.writes += len(batch)
+
+
+def get_write_queue():
+    """WRITE_BEHIND打开时返回写队列，否则返回None"""
+    return current_app.extensions.get('write_queue')
+
+
+def pending_writes(user_id):
+    writes = get_write_queue()
+    return writes.pending(user_id) if writes is not None and user_id is not None else []
+
+
+def flush_writes(user_id):
+    """等待该用户还没提交的修改写完，同步读写数据库之前调用"""
+    writes = get_write_queue()
+    if writes is not None and writes.pending(user_id):
+        writes.flush()
+
+
+#把修改放进队列的网页视图，请求本身只读取数据库
+QUEUED_ENDPOINTS = frozenset(['index', 'edit', 'delete'])
+
+
+#before_request钩子：写合并模式下这些请求的事务以普通BEGIN开始(同@read_transaction)。
+#要在限流检查和login_required加载用户之前设置，用户缓存未命中时的查询已经开始了事务
+def queued_requests_read_only():
+    if request.endpoint in QUEUED_ENDPOINTS and get_write_queue() is not None:
+        g.read_transaction = True
+
+
+#before_request钩子：该用户有没能写入的修改时在这个页面上提示
+def report_failed_writes():
+    writes = get_write_queue()
+    if writes is None or not writes._failures or not current_user.is_authenticated:
+        return
+    for write in writes.take_failures(current_user.id):
+        flash(FAILED_MESSAGES[write.action])
+
+
+def init_writes(app):
+    if app.config['WRITE_BEHIND']:
+        app.extensions['write_queue'] = WriteQueue(app)
+    app.before_request(queued_requests_read_only)  # 在init_ratelimit()注册的钩子之前执行
+    app.before_request(report_failed_writes)  # 加载用户，在queued_requests_read_only之后
+
+
+#在一页电影上叠加还没提交的修改，返回(电影列表, 总数)，新建的电影只出现在最后一页
+def apply_pending(writes, movies, count, last_page):
+    movies = list(movies)
+    for write in writes:
+        if write.action == 'create':
+            if not write.committed:
+                count += 1
+            if last_page and (write.movie_id is None or write.movie_id not in [m.id for m in movies]):
+                movies.append(Movie(id=write.movie_id, user_id=write.user_id, **write.values))
+        elif write.action == 'update':
+            movies = [pending_movie([write], m) if m.id == write.movie_id else m for m in movies]
+        else:
+            if not write.committed:
+                count -= 1
+            movies = [m for m in movies if m.id != write.movie_id]
+    return movies, count
+
+
+#叠加还没提交的修改后的电影，已经被删除时返回None，有修改时返回新的对象，不改动会话中的对象
+def pending_movie(writes, movie):
+    for write in writes:
+        if write.movie_id != movie.id:
+            continue
+        if write.action == 'delete':
+            return None
+        if write.action == 'update':
+            data = dict(id=movie.id, user_id=movie.user_id, title=movie.title, year=movie.year)
+            data.update(write.values)
+            movie = Movie(**data)
+    return movie
@@ -5,4 +5,6 @@ dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
 
-from watchlist import app
\ No newline at end of file
+from watchlist import create_app
+
+app = create_app()